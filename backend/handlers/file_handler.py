@@ -1,6 +1,6 @@
 from fastapi import APIRouter, HTTPException, UploadFile
 
-from operators.file_operator import upload_file_to_s3
+from operators.file_operator import is_gzip_stream, structure_extension, upload_file_to_s3
 from job_queue import enqueue_job
 
 router = APIRouter(prefix="/file", tags=["file"])
@@ -8,8 +8,13 @@ router = APIRouter(prefix="/file", tags=["file"])
 
 @router.post("/upload")
 async def upload_file(file: UploadFile):
-    if not file.filename.endswith(".pdb"):
-        raise HTTPException(status_code=400, detail="Only .pdb files are allowed")
+    extension = structure_extension(file.filename)
+
+    if not extension:
+        raise HTTPException(status_code=400, detail="Only .pdb, .cif, .pdb.gz and .cif.gz files are allowed")
+
+    if extension.endswith(".gz") and not is_gzip_stream(file.file):
+        raise HTTPException(status_code=400, detail=f"{file.filename} is not gzip-compressed")
 
     try:
         upload_file_to_s3(file.file, file.filename, file.content_type)
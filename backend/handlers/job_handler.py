@@ -11,7 +11,12 @@ from db.database import get_db
 from db.models import Job, User
 from utils.deps import get_current_user
 from job_queue import enqueue_job
-from operators.file_operator import get_s3_client
+from operators.file_operator import (
+    STRUCTURE_CONTENT_TYPES,
+    get_s3_client,
+    is_gzip_stream,
+    structure_extension,
+)
 from schemas.job import (
     AdvancedParams,
     JobDetail,
@@ -42,8 +47,14 @@ async def create_job(
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
-    if not pdb_file.filename or not pdb_file.filename.endswith(".pdb"):
-        raise HTTPException(status_code=400, detail="Only .pdb files are allowed")
+    extension = structure_extension(pdb_file.filename)
+
+    if not extension:
+        raise HTTPException(status_code=400, detail="Only .pdb, .cif, .pdb.gz and .cif.gz files are allowed")
+
+    # compressed uploads are stored as-is and decompressed by the runner while parsing
+    if extension.endswith(".gz") and not is_gzip_stream(pdb_file.file):
+        raise HTTPException(status_code=400, detail=f"{pdb_file.filename} is not gzip-compressed")
 
     parsed_advanced = None
 
@@ -71,7 +82,7 @@ async def create_job(
     await db.commit()
     await db.refresh(job)
 
-    s3_key = f"{job.job_id}.pdb"
+    s3_key = f"{job.job_id}{extension}"
 
     try:
         s3_client = get_s3_client()
@@ -80,13 +91,13 @@ async def create_job(
             pdb_file.file,
             INPUT_BUCKET,
             s3_key,
-            ExtraArgs={"ContentType": "chemical/x-pdb"},
+            ExtraArgs={"ContentType": STRUCTURE_CONTENT_TYPES[extension]},
         )
 
     except Exception as e:
         await db.delete(job)
         await db.commit()
-        raise HTTPException(status_code=500, detail=f"Failed to upload PDB file: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to upload structure file: {e}")
 
     active_count_result = await db.execute(
         select(func.count(Job.job_id)).where(
@@ -204,7 +215,7 @@ async def get_job_status(
 @router.get("/{job_id}/download/{file_type}")
 async def download_file(
     job_id: UUID,
-    file_type: Literal["trajectory", "log", "vtf"],
+    file_type: Literal["trajectory", "log", "vtf", "analysis", "profile"],
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
@@ -221,6 +232,8 @@ async def download_file(
         "trajectory": f"{job_id}-results/{job_id}.run.up",
         "log": f"{job_id}-results/{job_id}.run.log",
         "vtf": f"{job_id}-results/{job_id}.vtf",
+        "analysis": f"{job_id}-results/{job_id}.analysis.json",
+        "profile": f"{job_id}-results/{job_id}.profile.json",
     }
 
     s3_key = file_map[file_type]
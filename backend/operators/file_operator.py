@@ -4,6 +4,35 @@ import boto3
 from botocore.config import Config
 from botocore.exceptions import ClientError
 
+STRUCTURE_CONTENT_TYPES = {
+    ".pdb": "chemical/x-pdb",
+    ".cif": "chemical/x-mmcif",
+    ".pdb.gz": "application/gzip",
+    ".cif.gz": "application/gzip",
+}
+
+
+def structure_extension(filename: str | None) -> str | None:
+    """Return the accepted structure file extension of filename, or None."""
+    if not filename:
+        return None
+
+    name = filename.lower()
+
+    for ext in sorted(STRUCTURE_CONTENT_TYPES, key=len, reverse=True):
+        if name.endswith(ext):
+            return ext
+
+    return None
+
+
+def is_gzip_stream(file) -> bool:
+    """Check the gzip magic number at the start of a seekable file, leaving it at the start."""
+    file.seek(0)
+    magic = file.read(2)
+    file.seek(0)
+    return magic == b"\x1f\x8b"
+
 
 def get_s3_client():
     region = os.getenv("AWS_REGION", "us-east-2")
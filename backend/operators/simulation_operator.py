@@ -57,6 +57,12 @@ def submit_simulation_job(
             command.extend(["--env-scale", str(advanced_params["env_scale"])])
         if advanced_params.get("rot_scale"):
             command.extend(["--rot-scale", str(advanced_params["rot_scale"])])
+        if advanced_params.get("integrator") == "mv":
+            command.extend(["--integrator", "mv"])
+            if advanced_params.get("inner_step"):
+                command.extend(["--inner-step", str(advanced_params["inner_step"])])
+            if advanced_params.get("integrator_levels"):
+                command.extend(["--integrator-levels", advanced_params["integrator_levels"]])
 
     try:
         response = batch_client.submit_job(
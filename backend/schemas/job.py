@@ -11,7 +11,13 @@ class AdvancedParams(BaseModel):
     env_scale: float = Field(default=1.0, description="Environment energy scale")
     rot_scale: float = Field(default=1.0, description="Rotamer energy scale")
     time_step: Optional[float] = Field(default=None, description="Integration time step")
-    integrator: str = Field(default="verlet", description="Integrator type")
+    integrator: Literal["verlet", "mv"] = Field(default="verlet", description="Integrator type")
+    inner_step: int = Field(default=3, ge=1, le=20, description="Fast time steps per slow time step (mv only)")
+    integrator_levels: str = Field(
+        default="",
+        pattern=r"^\s*([\w*?\[\]]+\s*=\s*[01]\s*(,\s*[\w*?\[\]]+\s*=\s*[01]\s*)*)?$",
+        description="Comma-separated POTENTIAL=LEVEL assignments for the mv integrator (0 fast, 1 slow)",
+    )
     dynamic_rotamer: bool = Field(default=True, description="Dynamic rotamer 1-body")
 
     enable_replica_exchange: bool = Field(default=False, description="Enable replica exchange")
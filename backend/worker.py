@@ -102,14 +102,18 @@ def parse_simulation_log(log_content: str) -> dict:
     return results
 
 
+def get_s3_client():
+    return boto3.client(
+        "s3",
+        aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+        aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+        region_name=os.getenv("AWS_REGION", "us-east-2"),
+    )
+
+
 async def fetch_and_parse_log(job_id: str) -> dict:
     try:
-        s3_client = boto3.client(
-            "s3",
-            aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-            aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-            region_name=os.getenv("AWS_REGION", "us-east-2"),
-        )
+        s3_client = get_s3_client()
 
         log_key = f"{job_id}-results/{job_id}.run.log"
         response = s3_client.get_object(Bucket=OUTPUT_BUCKET, Key=log_key)
@@ -121,6 +125,29 @@ async def fetch_and_parse_log(job_id: str) -> dict:
         return {}
 
 
+async def fetch_analysis_summary(job_id: str) -> dict:
+    try:
+        s3_client = get_s3_client()
+
+        summary_key = f"{job_id}-results/{job_id}.analysis.json"
+        response = s3_client.get_object(Bucket=OUTPUT_BUCKET, Key=summary_key)
+        summary = json.loads(response["Body"].read().decode("utf-8"))
+    except Exception as e:
+        print(f"[Worker] No analysis summary for job {job_id}: {e}")
+        return {}
+
+    results = {}
+
+    for key in ("residue_count", "frame_count", "final_potential", "final_rg"):
+        if summary.get(key) is not None:
+            results[key] = summary[key]
+
+    if summary.get("final_hbonds") is not None:
+        results["final_hbonds"] = round(summary["final_hbonds"])
+
+    return results
+
+
 async def promote_user_queued_job(user_id, db: AsyncSession, redis_client: redis.Redis) -> None:
     active_count_result = await db.execute(
         select(func.count(Job.job_id)).where(
@@ -171,6 +198,7 @@ async def check_running_jobs(db: AsyncSession, redis_client: redis.Redis) -> Non
 
             if mapped_status == "completed":
                 results = await fetch_and_parse_log(str(job.job_id))
+                results.update(await fetch_analysis_summary(str(job.job_id)))
 
                 await db.execute(
                     update(Job)
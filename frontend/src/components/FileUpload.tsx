@@ -1,7 +1,7 @@
 import { useState, useCallback } from "react";
 import { HugeiconsIcon } from "@hugeicons/react";
 import { CloudUploadIcon, Loading03Icon } from "@hugeicons/core-free-icons";
-import { cn } from "@/lib/utils";
+import { cn, STRUCTURE_FILE_ACCEPT } from "@/lib/utils";
 
 interface FileUploadProps {
   onFileSelect?: (files: File[]) => void;
@@ -33,7 +33,7 @@ const API_URL = import.meta.env.VITE_API_URL || "http://localhost:8000";
 
 export default function FileUpload({
   onFileSelect,
-  accept = ".pdb",
+  accept = STRUCTURE_FILE_ACCEPT,
   multiple = true,
   uploadUrl = `${API_URL}/file/upload`,
 }: FileUploadProps) {
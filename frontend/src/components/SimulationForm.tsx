@@ -17,6 +17,8 @@ export interface SimulationParams {
     hb_scale: number;
     env_scale: number;
     rot_scale: number;
+    integrator: "verlet" | "mv";
+    inner_step: number;
   };
 }
 
@@ -42,6 +44,8 @@ export default function SimulationForm({
   const [hbScale, setHbScale] = useState(1.0);
   const [envScale, setEnvScale] = useState(1.0);
   const [rotScale, setRotScale] = useState(1.0);
+  const [integrator, setIntegrator] = useState<"verlet" | "mv">("verlet");
+  const [innerStep, setInnerStep] = useState(3);
 
   const handleSubmit = (e: React.FormEvent) => {
     e.preventDefault();
@@ -59,6 +63,8 @@ export default function SimulationForm({
         hb_scale: hbScale,
         env_scale: envScale,
         rot_scale: rotScale,
+        integrator,
+        inner_step: innerStep,
       };
     }
 
@@ -202,6 +208,34 @@ export default function SimulationForm({
                   disabled={disabled}
                 />
               </div>
+
+              <div className="space-y-2">
+                <Label htmlFor="integrator">Integrator</Label>
+                <Select
+                  id="integrator"
+                  value={integrator}
+                  onChange={(e) => setIntegrator(e.target.value as "verlet" | "mv")}
+                  disabled={disabled}
+                >
+                  <option value="verlet">verlet</option>
+                  <option value="mv">mv (multiple time step)</option>
+                </Select>
+              </div>
+
+              {integrator === "mv" && (
+                <div className="space-y-2">
+                  <Label htmlFor="innerStep">Inner Steps per Slow Step</Label>
+                  <Input
+                    type="number"
+                    id="innerStep"
+                    value={innerStep}
+                    onChange={(e) => setInnerStep(parseInt(e.target.value, 10) || 1)}
+                    min={1}
+                    max={20}
+                    disabled={disabled}
+                  />
+                </div>
+              )}
             </div>
           </CardContent>
         </Card>
@@ -4,3 +4,12 @@ import { twMerge } from "tailwind-merge";
 export function cn(...inputs: ClassValue[]) {
   return twMerge(clsx(inputs));
 }
+
+export const STRUCTURE_FILE_EXTENSIONS = [".pdb", ".cif", ".pdb.gz", ".cif.gz"];
+
+export const STRUCTURE_FILE_ACCEPT = STRUCTURE_FILE_EXTENSIONS.join(",");
+
+export function isStructureFile(name: string) {
+  const lower = name.toLowerCase();
+  return STRUCTURE_FILE_EXTENSIONS.some((ext) => lower.endsWith(ext));
+}
@@ -10,7 +10,7 @@ import {
 import { Button } from "@/components/ui/button";
 import { Card, CardContent, CardHeader, CardTitle } from "@/components/ui/card";
 import { Alert, AlertDescription } from "@/components/ui/alert";
-import { cn } from "@/lib/utils";
+import { cn, isStructureFile, STRUCTURE_FILE_ACCEPT } from "@/lib/utils";
 import { apiFetch } from "@/lib/api";
 import { useAuth } from "@/contexts/AuthContext";
 import SimulationForm from "../components/SimulationForm";
@@ -38,11 +38,11 @@ export default function HomePage() {
     e.preventDefault();
     setIsDragging(false);
     const files = Array.from(e.dataTransfer.files);
-    if (files.length > 0 && files[0].name.endsWith(".pdb")) {
+    if (files.length > 0 && isStructureFile(files[0].name)) {
       setSelectedFile(files[0]);
       setError(null);
     } else {
-      setError("Please upload a .pdb file");
+      setError("Please upload a .pdb, .cif, .pdb.gz or .cif.gz file");
     }
   }, []);
 
@@ -148,7 +148,7 @@ export default function HomePage() {
               <input
                 type="file"
                 onChange={handleFileInput}
-                accept=".pdb"
+                accept={STRUCTURE_FILE_ACCEPT}
                 className="absolute inset-0 w-full h-full opacity-0 cursor-pointer"
               />
               <div className="flex flex-col items-center gap-3">
@@ -180,7 +180,7 @@ export default function HomePage() {
                       Drag and drop or click to upload
                     </p>
                     <p className="text-xs text-muted-foreground mt-1">
-                      Only .pdb files are accepted
+                      Accepts .pdb and .cif files, optionally gzip-compressed
                     </p>
                   </div>
                 )}
@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-import sys
+import sys, os
 
 nb_path = '/content/drive/MyDrive/DynaLab_Dev/Packages'
 sys.path.insert(1,nb_path)
@@ -105,38 +105,155 @@ def read_residues(chain):
     return residues, ignored_restypes
 
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('pdb', help='input .pdb file')
-    parser.add_argument('basename', help='output basename')
-    parser.add_argument('--model', default=None, help='Choose only a specific model in the .pdb')
-    parser.add_argument('--chains', default='', 
-            help='Comma-separated list of chains to parse (e.g. --chains=A,C,E). Default is all chains.')
-    parser.add_argument('--allow-unexpected-chain-breaks', default=False, action='store_true', 
-            help='Do not fail on unexpected chain breaks (dangerous)')
-    parser.add_argument('--record-chain-breaks', action='store_true', help='Record index of chain first residues to help automate generation of system files for multiple chains.')
-    parser.add_argument('--rl-chains', default='', help='Comma-separated list of number of receptor and ligand chains. Default is no info.')
-    parser.add_argument('--disable-recentering', action='store_true',
-            help='If turned on, disable recentering of the structure.')
-    args = parser.parse_args()
-    
-    if args.rl_chains:
-        rl_chains = [int(num) for num in args.rl_chains.split(',')]
+def _prody_dihedral(c1, c2, c3, c4):
+    '''Dihedral angles in degrees of stacked coordinates, computed as prody.measure.getDihedral
+    computes a single angle'''
+    a1 = c2 - c1
+    a2 = c3 - c2
+    a3 = c4 - c3
+
+    v1 = np.cross(a1, a2)
+    v1 = np.divide(v1, np.power((v1 * v1).sum(-1), 0.5).reshape(-1,1))
+    v2 = np.cross(a2, a3)
+    v2 = np.divide(v2, np.power((v2 * v2).sum(-1), 0.5).reshape(-1,1))
+    porm = np.sign((v1 * a3).sum(-1))
+    rad = np.arccos((v1*v2).sum(-1) / ((v1**2).sum(-1) * (v2**2).sum(-1))**0.5)
+    rad = np.where(porm == 0, rad, rad * porm)
+    return rad * prody.measure.measure.RAD2DEG
+
+
+def read_structure_residues(structure, chain_ids=()):
+    ''' Residues of every chain of structure (or only those in chain_ids) as a list of
+    (chain_id, (residues, ignored_restypes)), the same as calling read_residues on each chain.
+    Atom coordinates and dihedrals are computed for all residues at once from the atom arrays. '''
+    hv = structure.getHierView()
+    n_res = hv.numResidues()
+
+    resindex = structure.getResindices()
+    names    = structure.getNames()
+    xyz      = structure.getCoords()
+    first_atom = np.unique(resindex, return_index=True)[1]
+    resnames = structure.getResnames()[first_atom]
+    resnums  = structure.getResnums() [first_atom]
+    is_aa    = np.bincount(resindex, weights=~structure.getFlags('aminoacid'), minlength=n_res) == 0
+
+    def atom_coords(atom_mask, last):
+        # coordinates of the first or last matching atom of each residue, nan if none
+        idx = np.nonzero(atom_mask)[0]
+        if last: idx = idx[::-1]
+        res, pos = np.unique(resindex[idx], return_index=True)
+        x = np.full((n_res,3), np.nan)
+        x[res] = xyz[idx[pos]]
+        return x
+
+    # prody looks up atoms by name with the first match, while read_residues keeps the last
+    first = dict((nm, atom_coords(names==nm, False)) for nm in ('N','CA','C'))
+    last  = dict((nm, atom_coords(names==nm, True )) for nm in ('N','CA','C','CB'))
+
+    unique_names, name_id = np.unique(names, return_inverse=True)
+    name_id = name_id.reshape(-1)
+    def side_chain(pattern):
+        # coordinates of the matching atom and the number of distinct matching names per residue
+        atom_mask = np.array([bool(re.match(pattern, nm)) for nm in unique_names])[name_id]
+        res_name = np.unique(np.column_stack((resindex[atom_mask], name_id[atom_mask])), axis=0)
+        return atom_coords(atom_mask, True), np.bincount(res_name[:,0], minlength=n_res)
+    CG, n_cg = side_chain("[^H]G1?$")
+    CD, n_cd = side_chain("[^H]D1?$")
+
+    has = lambda x: np.all(np.isfinite(x), axis=-1)
+    ca_dist = np.sqrt(((first['CA'][1:]-first['CA'][:-1])**2).sum(-1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # residue i and i+1 count as bonded as in prody.calcOmega (CA-CA distance at most 4.1 A)
+        bonded = has(first['CA'][1:]) & has(first['CA'][:-1]) & ~(ca_dist > 4.1)
+
+        phi   = np.full(n_res, np.nan)
+        psi   = np.full(n_res, np.nan)
+        omega = np.full(n_res, np.nan)
+        ok = bonded & is_aa[:-1] & has(first['C'][:-1]) & has(first['N'][1:]) & has(first['C'][1:])
+        phi[1:][ok]   = _prody_dihedral(first['C'][:-1][ok], first['N'][1:][ok], first['CA'][1:][ok], first['C'][1:][ok]) * deg
+        ok = bonded & is_aa[1:] & has(first['N'][:-1]) & has(first['C'][:-1]) & has(first['N'][1:])
+        psi[:-1][ok]  = _prody_dihedral(first['N'][:-1][ok], first['CA'][:-1][ok], first['C'][:-1][ok], first['N'][1:][ok]) * deg
+        ok = bonded & has(first['C'][:-1]) & has(first['N'][1:])
+        omega[:-1][ok] = _prody_dihedral(first['CA'][:-1][ok], first['C'][:-1][ok], first['N'][1:][ok], first['CA'][1:][ok]) * deg
+
+        chi1 = dihedral(last['N'], last['CA'], last['CB'], CG)
+        chi2 = dihedral(last['CA'], last['CB'], CG, CD)
+
+    chains = []
+    for ch in structure.iterChains():
+        if chain_ids and ch.getChid() not in chain_ids: continue
+        ignored_restypes = dict()
+        residues = []
+        for i in np.unique(ch.getResindices()):
+            restype = nonstandard_restype_conversion.get(resnames[i], resnames[i])
+            if restype not in one_letter_aa:
+                ignored_restypes[restype] = ignored_restypes.get(restype,0) + 1
+                continue
+            if n_cg[i] > 1 or n_cd[i] > 1:
+                return [(c.getChid(),read_residues(c)) for c in structure.iterChains()
+                        if not chain_ids or c.getChid() in chain_ids]  # raises with the details
+
+            residues.append(Residue(
+                resnums[i], ch,
+                restype if not (restype=='PRO' and residues and np.abs(residues[-1].omega)<90.*deg) else 'CPR',
+                phi[i], psi[i], omega[i],
+                last['N'][i], last['CA'][i], last['C'][i], last['CB'][i], CG[i], CD[i],
+                chi1[i], chi2[i]))
+        chains.append((ch.getChid(), (residues, ignored_restypes)))
+
+    return chains
+
+
+def structure_basename(path):
+    '''path without its directory, compression and structure file extensions'''
+    name = os.path.basename(path)
+    if name.lower().endswith('.gz'):
+        name = name[:-3]
+    root, ext = os.path.splitext(name)
+    return root if ext.lower() in ('.pdb', '.ent', '.cif', '.mmcif') else name
+
+
+def read_structure(path, model=None):
+    ''' Parse a PDB or mmCIF file, either of which may be gzip-compressed (read as a stream).
+    mmCIF chains are named by auth_asym_id, so that they match the chains of the PDB format. '''
+    name = path.lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+    if name.endswith('.cif') or name.endswith('.mmcif'):
+        return prody.parseMMCIF(path, model=model, report=False, unite_chains=True)
+    return prody.parsePDB(path, model=model, report=False)
+
+
+class StructureError(ValueError):
+    '''Input structure cannot be converted'''
+    pass
+
+
+def write_initial_structure(pdb, basename, model=None, chains='', allow_unexpected_chain_breaks=False,
+        record_chain_breaks=False, rl_chains=None, disable_recentering=False, stdout=None):
+    ''' Convert pdb (PDB or mmCIF, optionally gzip-compressed) to basename.initial.npy, .fasta,
+    .chi, and (with record_chain_breaks and several chains) .chain_breaks.  rl_chains is a pair
+    of receptor and ligand chain counts or None.  Progress is printed to stdout (sys.stdout if
+    None).  Returns the sequence as a list of three-letter restypes. '''
+    log = lambda *args: print(*args, file=stdout or sys.stdout)
+
+    if rl_chains:
+        rl_chains = list(rl_chains)
         if len(rl_chains) != 2:
-            parser.error('--rl-chains requires exactly two comma-separated numbers')
+            raise StructureError('rl_chains requires exactly two numbers')
         rl_chains_actual = rl_chains[:] # keep record of actual number of chains in case of intra-chain chain breaks
 
-    structure = prody.parsePDB(args.pdb, model=args.model, report=False)
-    print ()
+    structure = read_structure(pdb, model=model)
+    if structure is None:
+        raise StructureError('no atoms read from %s' % pdb)
+    log()
 
-    chain_ids = set(x for x in args.chains.split(',') if x)
-    chains = [(ch.getChid(),read_residues(ch)) for ch in structure.iterChains() 
-        if not chain_ids or ch.getChid() in chain_ids]
+    chain_ids = set(x for x in chains.split(',') if x)
+    chains = read_structure_residues(structure, chain_ids)
 
     missing_chains = chain_ids.difference(x[0] for x in chains)
     if missing_chains:
-        print ( "ERROR: missing chain %s" % ",".join(sorted(missing_chains)), file=sys.stderr )
-        sys.exit(1)
+        raise StructureError("missing chain %s" % ",".join(sorted(missing_chains)))
 
     coords = []
     sequence = []
@@ -147,31 +264,31 @@ def main():
     chain_counts = [] # Keep track of unexpected broken chain membership to actual chains
 
     for ch_num, (chain_id, (res,ignored_restype)) in enumerate(chains):
-        print ("chain %s:" % chain_id)
+        log ("chain %s:" % chain_id)
         chain_counts.append(1)
 
         # only look at residues with complete backbones
         res = [r for r in res if np.all(np.isfinite(np.array((r.N,r.CA,r.C))))]
 
-        print ('    found %i usable residues' % len(res))
-        print ()
+        log ('    found %i usable residues' % len(res))
+        log ()
 
         for k,v in sorted(ignored_restype.items()):
-            print ('    ignored restype %-3s (%i residues)'%(k,v))
-        print ()
+            log ('    ignored restype %-3s (%i residues)'%(k,v))
+        log ()
 
         for i,r in enumerate(res):
             if coords: # residues left by a previous chain
                 dist = vmag(r.N-coords[-1])
                 if dist > 2. or not i: # catch new chain anyway
-                    print ('    %s chain break at residue %i (%4.1f A)' % (('UNEXPECTED' if i else 'expected  '),
+                    log ('    %s chain break at residue %i (%4.1f A)' % (('UNEXPECTED' if i else 'expected  '),
                          len(coords)//3, dist))
                     if i:
                         unexpected_chain_breaks = True
                         chain_counts[ch_num] += 1
 
-                    if args.record_chain_breaks: chain_first_residue.append(len(coords)/3)
-                    if i and args.rl_chains:
+                    if record_chain_breaks: chain_first_residue.append(len(coords)/3)
+                    if i and rl_chains:
                         if ch_num < rl_chains_actual[0]:
                             rl_chains[0] += 1
                         else:
@@ -181,32 +298,31 @@ def main():
             sequence.append(r.restype)
             chi.append((r.chi1,r.chi2))
             chain_resnum.append((str(chain_id),r.resnum))
-        print ()
+        log ()
     coords = np.array(coords)
-    if not args.disable_recentering:
+    if not disable_recentering:
         coords -= coords.mean(axis=0) # move com to origin
     chi = np.array(chi)
 
-    if unexpected_chain_breaks and not args.allow_unexpected_chain_breaks:
-        print( 'ERROR: see above for unexpected chain breaks, probably missing residues in crystal '+
+    if unexpected_chain_breaks and not allow_unexpected_chain_breaks:
+        raise StructureError('see above for unexpected chain breaks, probably missing residues in crystal '+
                 'structure or using a multi-chain PDB w/o proper chain labels '+
-                '(--allow-unexpected-chain-breaks to suppress this error at your own risk)', file=sys.stderr)
-        sys.exit(1)
+                '(--allow-unexpected-chain-breaks to suppress this error at your own risk)')
 
     fasta_seq = ''.join(one_letter_aa[s] for s in sequence)
 
     #with open(args.basename + '.initial.pkl','wb') as f:
     #    cPickle.dump(coords[...,None], f, -1)
     #    f.close()
-    np.save('{}.initial.npy'.format(args.basename), coords) 
+    np.save('{}.initial.npy'.format(basename), coords) 
 
-    with open(args.basename+'.fasta','w') as f:
-        print( '> Created from %s' % args.pdb, file=f)
+    with open(basename+'.fasta','w') as f:
+        print( '> Created from %s' % pdb, file=f)
         nlines = int(np.ceil(len(fasta_seq)/80.))
         for nl in range(nlines):
             print(fasta_seq[80*nl:80*(nl+1)], file=f)
     
-    with open(args.basename+'.chi','w') as f:
+    with open(basename+'.chi','w') as f:
         print ('residue restype  chain  resnum      chi1     chi2', file=f)
         for nr,restype in enumerate(sequence):
             # if np.isnan(chi[nr]): continue  # no chi1 data to write
@@ -221,14 +337,47 @@ def main():
                     nr, restype, chain_resnum[nr][0], chain_resnum[nr][1], chi[nr,0]/deg, chi[nr,1]/deg), file=f)
 
     if chain_first_residue:
-        with open(args.basename+'.chain_breaks','w') as f:
+        with open(basename+'.chain_breaks','w') as f:
             print (' '.join([str(int(i)) for i in chain_first_residue]), file=f)
             print (' '.join([str(int(i)) for i in chain_counts]), file=f)
             
-            if args.rl_chains:
+            if rl_chains:
                 print ('%d %d' % (rl_chains_actual[0], rl_chains_actual[1]), file=f)
                 print ('%d %d' % (rl_chains[0], rl_chains[1]), file=f)
 
+    return sequence
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pdb', help='input .pdb or .cif file, optionally gzip-compressed (.pdb.gz, .cif.gz)')
+    parser.add_argument('basename', help='output basename')
+    parser.add_argument('--model', default=None, type=int, help='Choose only a specific model in the .pdb')
+    parser.add_argument('--chains', default='', 
+            help='Comma-separated list of chains to parse (e.g. --chains=A,C,E). Default is all chains.')
+    parser.add_argument('--allow-unexpected-chain-breaks', default=False, action='store_true', 
+            help='Do not fail on unexpected chain breaks (dangerous)')
+    parser.add_argument('--record-chain-breaks', action='store_true', help='Record index of chain first residues to help automate generation of system files for multiple chains.')
+    parser.add_argument('--rl-chains', default='', help='Comma-separated list of number of receptor and ligand chains. Default is no info.')
+    parser.add_argument('--disable-recentering', action='store_true',
+            help='If turned on, disable recentering of the structure.')
+    args = parser.parse_args()
+    
+    rl_chains = None
+    if args.rl_chains:
+        rl_chains = [int(num) for num in args.rl_chains.split(',')]
+        if len(rl_chains) != 2:
+            parser.error('--rl-chains requires exactly two comma-separated numbers')
+
+    try:
+        write_initial_structure(args.pdb, args.basename, model=args.model, chains=args.chains,
+                allow_unexpected_chain_breaks=args.allow_unexpected_chain_breaks,
+                record_chain_breaks=args.record_chain_breaks, rl_chains=rl_chains,
+                disable_recentering=args.disable_recentering)
+    except StructureError as e:
+        print ( "ERROR: %s" % e, file=sys.stderr )
+        sys.exit(1)
+
 
 if __name__ == '__main__':
     main()
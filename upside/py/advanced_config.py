@@ -1280,6 +1280,11 @@ def main():
             'To do that, you will need to add --disable-recentering or --disable-z-recentering in UPSIDE EXECUTABLE arguments '+
             '(not arguments for upside_config.py or advanced_config.py)')
 
+    parser.add_argument('--freeze', default=False, action='store_true',
+            help='After adding the potentials, replace the nodes whose inputs are all constant (for example ' +
+            'restraints between nailed residues) with constant nodes evaluated on the initial structure, and ' +
+            'report the time per step saved.')
+
     parser.add_argument('--contact-energies', default='',
             help='Path to text file that defines a contact energy function.  The first line of the file should ' +
             'be a header containing "residue1 residue2 energy distance transition_width", and the remaining '+
@@ -1529,5 +1534,9 @@ def main():
 
     t.close()
 
+    if args.freeze:
+        import upside_engine as ue
+        print(ue.format_freeze_report(ue.freeze_constant_nodes(args.config, args.config)))
+
 if __name__ == '__main__':
     main()
@@ -1,11 +1,21 @@
 #!/usr/bin/env python
 
 import tables
-
-def summarize(node, indentation=0, min_name_length=0):
+import hashlib
+import numpy as np
+
+def array_digest(node):
+    '''Short hash of the shape, dtype and contents of an array node'''
+    data = np.ascontiguousarray(node.read())
+    h = hashlib.sha1()
+    h.update(('%s %s ' % (data.shape, data.dtype.str)).encode('ascii'))
+    h.update(data.tobytes())
+    return h.hexdigest()[:12]
+
+def summarize(node, indentation=0, min_name_length=0, show_digest=False):
     print ('%s%-*s' % (' ' * indentation, min_name_length, node._v_name),end='')
     if 'shape' in dir(node):
-        print ('%s %s' % (node.shape, node.dtype))
+        print ('%s %s%s' % (node.shape, node.dtype, ' %s' % array_digest(node) if show_digest else ''))
     else:
         print ()
 
@@ -21,7 +31,7 @@ def summarize(node, indentation=0, min_name_length=0):
         if attr_names: print  ()# extra space to separate the attr_list and the elements
         max_len = max([0] + [len(a) for a in node._v_children.keys()])
         for nm,child in sorted(node._v_children.items()):
-            summarize(child, indentation=indentation, min_name_length=max_len)
+            summarize(child, indentation=indentation, min_name_length=max_len, show_digest=show_digest)
         print () # extra space after groups
 
     indentation -= 4
@@ -29,9 +39,11 @@ def summarize(node, indentation=0, min_name_length=0):
 def main():
     import sys
     fnames = sys.argv[1:]
+    show_digest = '--digest' in fnames
     for fn in fnames:
+        if fn == '--digest': continue
         tbl = tables.open_file(fn)
-        summarize(tbl.root)
+        summarize(tbl.root, show_digest=show_digest)
         tbl.close()
 
 if __name__ == '__main__':
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+''' Prepare Upside configurations for many structures at once.
+
+The manifest is a CSV file with a header row or a JSON-lines file (.jsonl), one entry per
+structure.  Each entry needs a pdb path (PDB or mmCIF, optionally gzip-compressed) and may
+give a name (default: the file name without extensions), the PDB_to_initial_structure options
+model, chains, allow_unexpected_chain_breaks and rl_chains, and any keyword argument of
+run_upside.upside_config, which override the batch-wide defaults for that entry.
+
+Entries are converted and configured in-process by a pool of workers, each of which keeps its
+own copy of the force field tables for the whole batch.  A failed entry is recorded with its
+error and the batch continues.  For each entry NAME the output directory holds NAME.up,
+NAME.log and the PDB_to_initial_structure files, and index.jsonl gets one line per entry
+giving its status. '''
+
+import sys, os
+import csv, json
+import inspect
+import multiprocessing
+import time
+import traceback
+
+import PDB_to_initial_structure as pis
+import run_upside as ru
+import upside_config as uc
+
+structure_options = dict(model=None, chains='', allow_unexpected_chain_breaks=False, rl_chains='')
+config_options = dict((nm, p.default) for nm,p in inspect.signature(ru.upside_config).parameters.items()
+        if nm not in ('fasta','output','initial_structure','chain_break_from_file'))
+
+
+def standard_options(force_field, upside_home=None):
+    '''upside_config keyword arguments for the standard parameter set of force_field (e.g. ff_2.1)'''
+    param_dir = os.path.join(upside_home or os.environ.get('UPSIDE_HOME', os.path.join(ru.py_source_dir,'..')),
+            'parameters')
+    common = os.path.join(param_dir, 'common')
+    ff     = os.path.join(param_dir, force_field)
+    return dict(
+        rama_library             = os.path.join(common, 'rama.dat'),
+        rama_sheet_mix_energy    = os.path.join(ff,     'sheet'),
+        reference_state_rama     = os.path.join(common, 'rama_reference.pkl'),
+        hbond_energy             = os.path.join(ff,     'hbond.h5'),
+        rotamer_placement        = os.path.join(ff,     'sidechain.h5'),
+        dynamic_rotamer_1body    = True,
+        rotamer_interaction      = os.path.join(ff,     'sidechain.h5'),
+        environment_potential    = os.path.join(ff,     'environment.h5'),
+        bb_environment_potential = os.path.join(ff,     'bb_env.dat'),
+        measure_max_n_edge       = True)
+
+
+def _convert(name, value, default):
+    '''Convert a manifest value (CSV gives strings) to the type of the option's default'''
+    if not isinstance(value, str):
+        return value
+    if isinstance(default, bool):
+        if value.lower() in ('1','true','yes','y'):  return True
+        if value.lower() in ('0','false','no','n'): return False
+        raise ValueError('option %s expects a boolean, got %r' % (name, value))
+    if isinstance(default, (int,float)):
+        return type(default)(value)
+    if default is None:  # untyped, e.g. surface_method or model
+        for kind in (int,float):
+            try:
+                return kind(value)
+            except ValueError:
+                pass
+    return value
+
+
+def read_manifest(path):
+    '''List of entry dicts from a CSV (with header) or JSON-lines manifest.  Empty CSV cells
+    are dropped so that they fall back to the batch defaults.'''
+    if path.endswith('.jsonl') or path.endswith('.json'):
+        with open(path) as f:
+            entries = [json.loads(ln) for ln in f if ln.strip()]
+    else:
+        with open(path, newline='') as f:
+            entries = [dict((k.strip(),v.strip()) for k,v in row.items() if k and v is not None and v.strip())
+                    for row in csv.DictReader(f)]
+
+    names = set()
+    for i,e in enumerate(entries):
+        if 'pdb' not in e:
+            raise ValueError('manifest entry %i has no pdb' % i)
+        unknown = set(e).difference(['pdb','name'], structure_options, config_options)
+        if unknown:
+            raise ValueError('manifest entry %i has unknown options %s' % (i, ', '.join(sorted(unknown))))
+        if not os.path.isabs(e['pdb']):
+            e['pdb'] = os.path.join(os.path.dirname(os.path.abspath(path)), e['pdb'])
+        e.setdefault('name', pis.structure_basename(e['pdb']))
+        if e['name'] in names:
+            raise ValueError('manifest entry %i repeats the name %s' % (i, e['name']))
+        names.add(e['name'])
+    return entries
+
+
+def build_entry(entry, output_dir, defaults=dict()):
+    ''' Convert and configure one manifest entry.  Errors are caught and recorded, so the
+    returned record always describes the entry with status "ok" or "failed". '''
+    name = entry['name']
+    base = os.path.join(output_dir, name)
+    record = dict(name=name, pdb=entry['pdb'], config=base+'.up', log=base+'.log')
+    tstart = time.time()
+
+    with open(base+'.log', 'w') as log:
+        try:
+            structure_kwargs = dict((k, _convert(k, entry[k], structure_options[k]))
+                    for k in structure_options if k in entry)
+            if structure_kwargs.get('rl_chains'):
+                structure_kwargs['rl_chains'] = [int(x) for x in str(structure_kwargs['rl_chains']).split(',')]
+            sequence = pis.write_initial_structure(entry['pdb'], base, record_chain_breaks=True,
+                    stdout=log, **structure_kwargs)
+
+            kwargs = dict(defaults)
+            kwargs.update((k, _convert(k, entry[k], config_options[k])) for k in config_options if k in entry)
+            kwargs['initial_structure'] = base+'.initial.npy'
+            if os.path.exists(base+'.chain_breaks'):
+                kwargs['chain_break_from_file'] = base+'.chain_breaks'
+            print(ru.upside_config(base+'.fasta', base+'.up', **kwargs), file=log)
+
+            record.update(status='ok', n_res=len(sequence))
+        except Exception as e:
+            traceback.print_exc(file=log)
+            record.update(status='failed', error='%s: %s' % (e.__class__.__name__, e), config=None)
+            if os.path.exists(base+'.up'):
+                os.remove(base+'.up')  # so that --skip-existing retries the entry
+
+    record['seconds'] = time.time()-tstart
+    return record
+
+
+def _init_worker(preload_files):
+    for path in preload_files:
+        uc.default_library.preload_file(path)
+
+def _build_entry_star(args):
+    return build_entry(*args)
+
+
+def run_batch(entries, output_dir, defaults=dict(), processes=None, skip_existing=False, preload_files=(),
+        index_path=None):
+    ''' Build all entries with a pool of processes (os.cpu_count() if None) and write one JSON
+    line per entry to index_path (output_dir/index.jsonl by default) as entries finish.  Returns
+    the list of records in completion order. '''
+    os.makedirs(output_dir, exist_ok=True)
+    index_path = index_path or os.path.join(output_dir, 'index.jsonl')
+
+    records = []
+    todo = []
+    for e in entries:
+        if skip_existing and os.path.exists(os.path.join(output_dir, e['name']+'.up')):
+            records.append(dict(name=e['name'], pdb=e['pdb'], status='skipped',
+                config=os.path.join(output_dir, e['name']+'.up')))
+        else:
+            todo.append((e, output_dir, defaults))
+
+    with open(index_path, 'w') as index:
+        for r in records:
+            print(json.dumps(r), file=index)
+
+        if processes == 1:
+            results = (_build_entry_star(x) for x in todo)
+            pool = None
+        else:
+            # HDF5 is not thread-safe, so parallelism is by processes
+            pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(list(preload_files),))
+            results = pool.imap_unordered(_build_entry_star, todo)
+
+        try:
+            for r in results:
+                records.append(r)
+                print(json.dumps(r), file=index)
+                index.flush()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    return records
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Prepare Upside configurations for a manifest of structures',
+            usage='use "%(prog)s --help" for more information')
+    parser.add_argument('manifest', help='CSV (with header) or .jsonl manifest; see the module docstring')
+    parser.add_argument('output_dir', help='directory for the per-entry files and index.jsonl')
+    parser.add_argument('--force-field', default='ff_2.1',
+            help='(default ff_2.1) standard parameter set used as the default upside_config options, '
+            'or "none" for no defaults')
+    parser.add_argument('--defaults', default='',
+            help='JSON file of upside_config keyword arguments applied to every entry, on top of --force-field')
+    parser.add_argument('--processes', type=int, default=None, help='(default all cores) worker processes')
+    parser.add_argument('--skip-existing', action='store_true', help='skip entries whose NAME.up already exists')
+    args = parser.parse_args()
+
+    try:
+        entries = read_manifest(args.manifest)
+    except (ValueError, OSError) as e:
+        parser.error(str(e))
+
+    defaults = dict()
+    if args.force_field.lower() != 'none':
+        defaults.update(standard_options(args.force_field))
+    if args.defaults:
+        with open(args.defaults) as f:
+            defaults.update(json.load(f))
+    unknown = set(defaults).difference(config_options)
+    if unknown:
+        parser.error('unknown upside_config options in defaults: %s' % ', '.join(sorted(unknown)))
+
+    # parameter files shared by all entries are read once by each worker before its first entry
+    preload_files = sorted(set(v for v in defaults.values() if isinstance(v, str) and os.path.isfile(v)))
+
+    tstart = time.time()
+    records = run_batch(entries, args.output_dir, defaults, processes=args.processes,
+            skip_existing=args.skip_existing, preload_files=preload_files)
+    elapsed = time.time()-tstart
+
+    counts = dict()
+    for r in records:
+        counts[r['status']] = counts.get(r['status'],0) + 1
+    print('%i entries in %.1f seconds: %s' % (len(records), elapsed,
+        ', '.join('%i %s' % (n,st) for st,n in sorted(counts.items()))))
+    for r in records:
+        if r['status'] == 'failed':
+            print('  failed %s: %s' % (r['name'], r['error']))
+
+    if counts.get('failed'):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
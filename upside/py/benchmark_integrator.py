@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+''' Compare the energy drift and the time per step of the verlet and multi-step (mv) integrators.
+
+A copy of the configuration is simulated with the verlet integrator and with the mv integrator at
+each of several inner steps, all with the same time step.  The thermostat only thermalizes the
+initial momenta, so the total energy, the potential plus the kinetic energy of all atoms, would
+be conserved by an exact integrator.  The drift is the slope of a least-squares line through the
+total energy of the frames, and the fluctuation is the RMS deviation from that line, both per atom.
+
+The mv integrator computes the level 1 potentials (see upside_config.py --integrator-level) once
+per inner_step time steps, so larger inner steps save time per step at the cost of more drift.
+The time per step includes the setup of the run. '''
+
+import sys, os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import tables as tb
+
+import run_upside as ru
+import upside_config as uc
+
+
+def energy_drift(config_path):
+    '''Drift (energy per atom per unit time) and RMS fluctuation (energy per atom) of the total
+    energy in the output of config_path'''
+    with tb.open_file(config_path) as t:
+        n_atom = t.root.input.pos.shape[0]
+        frame_time = t.root.output.time[:]
+        total = t.root.output.potential[:,0] + n_atom*t.root.output.kinetic[:,0]
+    slope, intercept = np.polyfit(frame_time, total, 1)
+    residual = total - (slope*frame_time + intercept)
+    return slope/n_atom, np.sqrt(np.mean(residual**2))/n_atom
+
+
+def slow_potentials(config_path):
+    '''Names of the potentials at level 1 of the multi-step integrator'''
+    with tb.open_file(config_path) as t:
+        groups = list(t.root.input.potential._f_iter_nodes('Group'))
+        levels = dict((g._v_name, g._v_attrs['integrator_level'] if 'integrator_level' in g._v_attrs else 0)
+                for g in groups)
+        return [nm for nm in uc.potential_names(groups) if levels[nm] == 1]
+
+
+def run(config_path, output_path, duration, temperature, time_step, inner_step=None, seed=1):
+    '''Simulate a copy of config_path at output_path with the verlet integrator (inner_step None)
+    or the mv integrator and return the seconds per time step, drift and fluctuation'''
+    shutil.copyfile(config_path, output_path)
+    integrator = dict(integrator='mv', inner_step=inner_step) if inner_step is not None else dict()
+    tstart = time.time()
+    job = ru.run_upside('', output_path, duration, duration/100., temperature=temperature, seed=seed,
+            time_step=time_step, extra_args=['--thermostat-interval', str(2.*duration)], **integrator)
+    if job.wait():
+        with open(job.output) as f:
+            raise RuntimeError('upside failed:\n' + f.read())
+    seconds = time.time() - tstart
+
+    n_step = int(round(duration/time_step))
+    drift, fluctuation = energy_drift(output_path)
+    return dict(seconds_per_step=seconds/n_step, drift=drift, fluctuation=fluctuation)
+
+
+def benchmark(config_path, inner_steps, duration=30., temperature=0.8, time_step=0.009, integrator_level='',
+        stdout=sys.stdout):
+    '''Dict from 'verlet' and 'mv/inner_stepN' to the result of run'''
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        if integrator_level:
+            levels_path = os.path.join(tmp_dir, 'levels.up')
+            shutil.copyfile(config_path, levels_path)
+            with tb.open_file(levels_path, 'a') as t:
+                uc.assign_integrator_levels(t.root.input.potential, integrator_level)
+            config_path = levels_path
+        print('slow potentials: %s' % ', '.join(slow_potentials(config_path)), file=stdout)
+        print(file=stdout)
+
+        results = dict()
+        results['verlet'] = run(config_path, os.path.join(tmp_dir, 'verlet.up'), duration, temperature, time_step)
+        for inner_step in inner_steps:
+            results['mv/inner_step%i' % inner_step] = run(config_path, os.path.join(tmp_dir, 'mv.up'),
+                    duration, temperature, time_step, inner_step)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    reference = results['verlet']['seconds_per_step']
+    print('%-16s %10s %8s %14s %12s' % ('integrator', 'us/step', 'speedup', 'drift/atom/t', 'rms/atom'), file=stdout)
+    for name, r in results.items():
+        print('%-16s %10.1f %7.2fx %14.2e %12.2e' % (name, 1e6*r['seconds_per_step'],
+            reference/r['seconds_per_step'], r['drift'], r['fluctuation']), file=stdout)
+    return results
+
+
+def main():
+    import argparse
+    import json
+    parser = argparse.ArgumentParser(description='Compare the energy drift and time per step of the verlet ' +
+            'and multi-step integrators on a configuration')
+    parser.add_argument('config', help='Upside configuration (.up)')
+    parser.add_argument('--inner-steps', default='1,2,3,4,6',
+            help='(default %(default)s) comma-separated inner steps of the mv integrator')
+    parser.add_argument('--duration', type=float, default=30., help='(default 30) simulation time of each run')
+    parser.add_argument('--temperature', type=float, default=0.8,
+            help='(default 0.8) temperature of the initial momenta')
+    parser.add_argument('--time-step', type=float, default=0.009, help='(default 0.009) time step')
+    parser.add_argument('--integrator-level', default='',
+            help='assignments of potentials to integrator levels, applied to a copy of the configuration ' +
+            '(same format as upside_config.py --integrator-level)')
+    parser.add_argument('--output', default=None, help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    try:
+        results = benchmark(args.config, [int(x) for x in args.inner_steps.split(',') if x], args.duration,
+                args.temperature, args.time_step, args.integrator_level)
+    except uc.ConfigError as e:
+        parser.error(str(e))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+''' Compare the cell list and all-pairs rebuilds of the interaction graph pairlists.
+
+Two scratch copies of the configuration are made, one in which every interaction graph rebuilds
+its pairlist cache with a cell list and one in which it checks all pairs (the cell_list_min_elem
+attribute of the graph, which otherwise selects the cell list above 1024 elements).  Both copies
+are evaluated on the initial structure to check that they find the same edges and energy.  The
+rebuild time is the extra time of an energy evaluation when every evaluation is forced to rebuild
+the caches, by translating the structure further than the cache buffer, over one that reuses them. '''
+
+import sys, os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import tables as tb
+
+import upside_engine as ue
+import upside_config as uc
+
+never_cell_list  = 2**30
+always_cell_list = 0
+
+
+def write_variant(config_path, output_path, cell_list_min_elem):
+    '''Copy config_path with cell_list_min_elem set on every interaction graph.  Returns the
+    names of the nodes built on interaction graphs.'''
+    shutil.copyfile(config_path, output_path)
+    with tb.open_file(output_path, 'a') as t:
+        groups = uc.interaction_graph_groups(t)
+        for g in groups.values():
+            g._v_attrs.cell_list_min_elem = cell_list_min_elem
+    return sorted(groups)
+
+
+def edges(engine, node_name):
+    n_edge = int(engine.get_value_by_name((3,), node_name, 'n_edge')[0])
+    return engine.get_value_by_name((n_edge,2), node_name, 'edge_indices').astype('i4')
+
+
+def seconds_per_evaluation(engine, pos, n_eval, shift):
+    # Alternate between two positions shift apart, so that shift larger than the cache buffer
+    # forces every evaluation to rebuild
+    frames = [pos, pos + np.array([shift,0.,0.], dtype='f4')]
+    engine.energy(frames[1])
+    best = np.inf
+    for i in range(3):
+        tstart = time.time()
+        for j in range(n_eval):
+            engine.energy(frames[j%2])
+        best = min(best, (time.time()-tstart)/n_eval)
+    return best
+
+
+def benchmark(config_path, n_eval=20, shift=50., stdout=sys.stdout):
+    '''Returns a dict with the energies, the node names whose edges differ, and the seconds per
+    rebuild of both paths'''
+    with tb.open_file(config_path) as t:
+        pos = np.require(t.root.input.pos[:,:,0], dtype='f4', requirements='C')
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        engines = dict()
+        for path_name, min_elem in [('all_pairs', never_cell_list), ('cell_list', always_cell_list)]:
+            variant_path = os.path.join(tmp_dir, path_name+'.up')
+            node_names = write_variant(config_path, variant_path, min_elem)
+            engines[path_name] = ue.Upside(variant_path, quiet=True)
+
+        result = dict(nodes=node_names, energy=dict(), differing_nodes=[], seconds_per_rebuild=dict())
+        for path_name, engine in engines.items():
+            result['energy'][path_name] = float(engine.energy(pos))
+
+        for nm in node_names:
+            e1 = edges(engines['all_pairs'], nm)
+            e2 = edges(engines['cell_list'], nm)
+            same = e1.shape == e2.shape and bool(np.all(e1 == e2))
+            if not same:
+                result['differing_nodes'].append(nm)
+            print('%-32s %7i edges %s' % (nm, len(e1), 'same' if same else 'DIFFERENT (%i with cell list)'%len(e2)),
+                    file=stdout)
+
+        for path_name, engine in engines.items():
+            t_static  = seconds_per_evaluation(engine, pos, n_eval, 0.)
+            t_rebuild = seconds_per_evaluation(engine, pos, n_eval, shift)
+            result['seconds_per_rebuild'][path_name] = t_rebuild - t_static
+            print('%-9s  %8.3f ms per evaluation, %8.3f ms per evaluation with rebuild, %8.3f ms per rebuild' % (
+                path_name, 1e3*t_static, 1e3*t_rebuild, 1e3*(t_rebuild-t_static)), file=stdout)
+        del engines
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    r = result['seconds_per_rebuild']
+    print('energy %.4f (all pairs) %.4f (cell list), rebuild speedup %.2fx' % (
+        result['energy']['all_pairs'], result['energy']['cell_list'],
+        r['all_pairs']/max(r['cell_list'],1e-9)), file=stdout)
+    return result
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Compare the cell list and all-pairs pairlist rebuilds ' +
+            'of the interaction graphs of a configuration')
+    parser.add_argument('config', help='Upside configuration (.up)')
+    parser.add_argument('--n-eval', type=int, default=20, help='(default 20) energy evaluations per timing')
+    parser.add_argument('--shift', type=float, default=50.,
+            help='(default 50) translation in angstroms applied to force a rebuild; must exceed the cache buffer')
+    args = parser.parse_args()
+
+    result = benchmark(args.config, args.n_eval, args.shift)
+    if result['differing_nodes']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+''' Measure the time and memory of the Python steps around an Upside simulation.
+
+The fixtures are synthetic and are made from one input structure (by default the ubiquitin of
+1ubq.pdb in the repository root), tiled into several copies in the same way as benchmark_steps.py:
+- a multi-chain PDB file of the copies, for the structure reader;
+- the configuration of the copies;
+- trajectories of the configuration with a given number of frames.  Each frame is the initial
+  structure plus Gaussian noise, stored as a compressed /output/pos like the engine's output.
+
+The paths measured for each size are:
+
+  config               run_upside.upside_config (the upside_config.py writers, without measure_max_n_edge)
+  read_residues        PDB_to_initial_structure.read_residues of every chain of the parsed structure
+  read_structure_residues   the whole-structure version used by write_initial_structure
+  vtf                  extract_vtf.print_augmented_vtf of the trajectory
+  load_upside_traj     mdtraj_upside.load_upside_traj of the trajectory
+  traj_from_upside     mdtraj_upside.traj_from_upside of trajectory arrays already in memory
+  energy               Upside.energy of every frame of the trajectory
+
+The time is the fastest of several repeats.  The memory is the peak of the Python allocations
+(tracemalloc, which includes numpy arrays) in a separate run, so it does not count memory
+allocated by the engine library.  The results can be written to JSON and compared against an
+earlier results file, in which case every path that is slower than the baseline by more than
+the tolerance is reported and the exit status is 1. '''
+
+import sys, os
+import json
+import shutil
+import string
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import tables as tb
+
+import benchmark_steps as bs
+
+system_sizes = bs.size_ladder[:3]
+frame_counts = [100, 1000]
+
+
+def write_tiled_pdb(structure, output_path, n_copy, spacing=bs.copy_spacing):
+    '''Write n_copy copies of the protein atoms of structure to output_path, one chain per copy,
+    on the same grid as benchmark_steps.tile_structure'''
+    import PDB_to_initial_structure as pis
+
+    protein = pis.read_structure(structure).select('protein').copy()
+    coords = protein.getCoords()
+    chain_ids = string.ascii_uppercase + string.ascii_lowercase + string.digits
+    copies = []
+    for i, offset in enumerate(bs.grid_offsets(n_copy, spacing)):
+        c = protein.copy()
+        c.setCoords(coords - coords.mean(axis=0) + offset)
+        c.setChids(chain_ids[i])
+        copies.append(c)
+    combined = copies[0]
+    for c in copies[1:]:
+        combined = combined + c
+    pis.prody.writePDB(output_path, combined)
+
+
+def write_trajectory(config, output_path, n_frame, noise=0.5, seed=0):
+    '''Copy config to output_path with an /output group of n_frame frames, each the initial
+    structure plus Gaussian noise of noise angstroms'''
+    shutil.copyfile(config, output_path)
+    with tb.open_file(output_path, 'a') as t:
+        pos0 = t.root.input.pos[:,:,0]
+        rng = np.random.RandomState(seed)
+        g = t.create_group('/', 'output')
+        filters = tb.Filters(complevel=1, complib='zlib', shuffle=True, fletcher32=True)
+        pos = t.create_earray(g, 'pos', tb.Float32Atom(), (0,1)+pos0.shape, filters=filters)
+        for i in range(n_frame):
+            pos.append((pos0 + noise*rng.randn(*pos0.shape))[None,None].astype('f4'))
+        t.create_earray(g, 'time', tb.Float32Atom(), (0,), filters=filters, obj=np.arange(n_frame, dtype='f4'))
+
+
+def measure(fn, n_repeat=3):
+    '''Seconds of the fastest of n_repeat calls of fn and the peak bytes of Python allocations of
+    one more call'''
+    best = np.inf
+    for i in range(n_repeat):
+        tstart = time.time()
+        fn()
+        best = min(best, time.time()-tstart)
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return dict(seconds=best, peak_bytes=peak)
+
+
+def benchmark(structure, work_dir, sizes, frames, config_kwargs, n_repeat=3, stdout=sys.stdout):
+    '''Dict from case name (PATH/SIZE or PATH/SIZE/framesN) to its measurements'''
+    import PDB_to_initial_structure as pis
+    import extract_vtf
+    import mdtraj_upside as mu
+    import run_upside as ru
+    import upside_engine as ue
+
+    configs = bs.prepare_configs(structure, work_dir, sizes, config_kwargs)
+    results = dict()
+
+    def record(name, fn, **info):
+        r = measure(fn, n_repeat)
+        r.update(info)
+        results[name] = r
+        print('%-40s %9.4f s %9.1f MB' % (name, r['seconds'], r['peak_bytes']/2.**20), file=stdout)
+
+    for size_name, n_copy in sizes:
+        config, n_residue = configs[size_name]
+        prefix = os.path.join(work_dir, size_name)
+
+        kwargs = dict(config_kwargs)
+        if os.path.exists(prefix+'.chain_breaks'):
+            kwargs['chain_break_from_file'] = prefix+'.chain_breaks'
+        record('config/%s' % size_name, lambda: ru.upside_config(prefix+'.fasta', prefix+'.scratch.up',
+            initial_structure=prefix+'.initial.npy', **kwargs), n_residue=n_residue)
+
+        pdb_path = prefix+'.pdb'
+        write_tiled_pdb(structure, pdb_path, n_copy)
+        parsed = pis.read_structure(pdb_path)
+        chains = list(parsed.getHierView().iterChains())
+        record('read_residues/%s' % size_name, lambda: [pis.read_residues(c) for c in chains], n_residue=n_residue)
+        record('read_structure_residues/%s' % size_name, lambda: pis.read_structure_residues(parsed),
+                n_residue=n_residue)
+
+        engine = ue.Upside(config, quiet=True)
+        for n_frame in frames:
+            traj_path = '%s.frames%i.up' % (prefix, n_frame)
+            write_trajectory(config, traj_path, n_frame)
+            with tb.open_file(traj_path) as t:
+                seq = t.root.input.sequence[:]
+                pos = t.root.output.pos[:]
+                frame_time = t.root.output.time[:]
+                chain_first_residue = np.append([0], t.root.input.chain_break.chain_first_residue[:]
+                        if 'chain_break' in t.root.input else []).astype('i4')
+            chain_counts = np.ones(len(chain_first_residue), dtype='i4')
+            info = dict(n_residue=n_residue, n_frame=n_frame)
+            suffix = '%s/frames%i' % (size_name, n_frame)
+
+            vtf_seq = np.char.decode(seq, encoding='UTF-8')
+            record('vtf/'+suffix, lambda: extract_vtf.print_augmented_vtf(prefix+'.vtf', vtf_seq,
+                pos.transpose((0,2,3,1)), chain_first_residue[1:] if len(chain_first_residue)>1 else None), **info)
+            record('load_upside_traj/'+suffix, lambda: mu.load_upside_traj(traj_path), **info)
+            record('traj_from_upside/'+suffix, lambda: mu.traj_from_upside(seq, frame_time, pos[:,0],
+                chain_first_residue, chain_counts), **info)
+            record('energy/'+suffix, lambda engine=engine: [engine.energy(x) for x in pos[:,0]], **info)
+            os.remove(traj_path)
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=0.1, stdout=sys.stdout):
+    '''Print the ratio of each case to the baseline and return the names of the cases whose time
+    grew by more than the fraction tolerance.  Cases missing from either are skipped.'''
+    regressions = []
+    for name in sorted(set(results).intersection(baseline)):
+        r, b = results[name], baseline[name]
+        ratio = r['seconds']/b['seconds']
+        slower = ratio > 1.+tolerance
+        if slower:
+            regressions.append(name)
+        print('%-40s %5.2fx time %5.2fx memory%s' % (
+            name, ratio, r['peak_bytes']/max(b['peak_bytes'],1), '  REGRESSION' if slower else ''), file=stdout)
+    return regressions
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Measure the time and memory of configuration, structure ' +
+            'reading, trajectory conversion and rescoring over several system and trajectory sizes')
+    parser.add_argument('--structure', default=bs.default_structure,
+            help='(default 1ubq.pdb of the repository) PDB or mmCIF structure tiled to make the fixtures')
+    parser.add_argument('--sizes', default=','.join(nm for nm,n in system_sizes),
+            help='(default %%(default)s) comma-separated sizes, among %s' % ','.join(nm for nm,n in bs.size_ladder))
+    parser.add_argument('--frames', default=','.join(map(str,frame_counts)),
+            help='(default %(default)s) comma-separated trajectory lengths')
+    parser.add_argument('--repeat', type=int, default=3, help='(default 3) timed calls of each path')
+    parser.add_argument('--force-field', default='ff_2.1', help='(default ff_2.1) parameter set')
+    parser.add_argument('--rama-library', default=None,
+            help='Rama library to use instead of the one in parameters/common')
+    parser.add_argument('--work-dir', default=None,
+            help='directory for the fixtures (default: a temporary directory that is removed)')
+    parser.add_argument('--output', default=None, help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=None, help='results JSON of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+            help='(default 0.1) fraction by which a path may be slower than the baseline before it is a regression')
+    args = parser.parse_args()
+
+    import batch_config
+    ladder = dict(bs.size_ladder)
+    selected = [x for x in args.sizes.split(',') if x]
+    unknown = [x for x in selected if x not in ladder]
+    if unknown:
+        parser.error('unknown sizes %s; available sizes are %s' % (
+            ','.join(unknown), ','.join(nm for nm,n in bs.size_ladder)))
+    frames = [int(x) for x in args.frames.split(',') if x]
+
+    config_kwargs = batch_config.standard_options(args.force_field)
+    config_kwargs['measure_max_n_edge'] = False
+    if args.rama_library is not None:
+        config_kwargs['rama_library'] = args.rama_library
+
+    work_dir = args.work_dir or tempfile.mkdtemp()
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        results = benchmark(args.structure, work_dir, [(nm,ladder[nm]) for nm in selected], frames, config_kwargs,
+                args.repeat)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print()
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print('%i of %i cases are slower than the baseline' % (len(regressions), len(results)))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
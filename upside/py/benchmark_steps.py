@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+''' Measure the simulation throughput of Upside over a ladder of system sizes.
+
+The ladder is built from one input structure (by default the ubiquitin of 1ubq.pdb in the
+repository root) by tiling copies of it on a grid, far enough apart that they do not interact
+at the start, with a chain break between copies.  The standard sizes are 1, 4, 13 and 39
+copies, or about 76, 300, 1000 and 3000 residues for ubiquitin.  A configuration is built for
+each size with the standard parameters of the force field.
+
+Each combination of size, integrator (verlet or mv) and thread count is simulated for a fixed
+duration through run_upside.run_upside(queue='in_process') with --profile, in a fresh process so
+that the OpenMP thread count takes effect and the peak RSS is that of the case alone.  Each case
+is repeated and the fastest repeat is kept.  The result of each case records the steps per second,
+the peak RSS (and the RSS of the process before the run, mostly the Python modules), the bytes
+added to the output file and the most expensive nodes of /output/profile.  The steps per second
+are timed over the simulation loop alone (the loop_seconds that --profile writes to
+/output/profile), so they exclude process start, configuration loading and engine construction,
+which dominate short cases, but include the small cost of the profile.  The wall time of the whole
+run is kept as wall_seconds.
+
+The results are written to a JSON file.  Given a baseline (a results file from an earlier build),
+every case that is slower than the baseline by more than the tolerance is reported and the exit
+status is 1.  Results are only comparable on the same machine with the same options, so a baseline
+is made locally: build the reference commit (cd ../obj && make), run
+
+    python benchmark_steps.py --output baseline.json
+
+then build the change to test and run python benchmark_steps.py --baseline baseline.json.
+
+Both runs must use the same --sizes, --threads, --integrators and --duration; cases that are
+missing from either file are skipped. '''
+
+import sys, os
+import json
+import multiprocessing
+import resource
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+size_ladder = [('ubiquitin', 1), ('res300', 4), ('res1000', 13), ('res3000', 39)]
+integrators = ['verlet', 'mv']
+default_structure = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '1ubq.pdb')
+copy_spacing = 60.  # angstroms between the centers of neighboring copies
+
+
+def grid_offsets(n_copy, spacing=copy_spacing):
+    '''Centered (n_copy,3) positions of the first n_copy points of the smallest cubic grid that
+    holds them'''
+    n_side = int(np.ceil(n_copy**(1./3.) - 1e-6))
+    grid = np.array([(i,j,k) for i in range(n_side) for j in range(n_side) for k in range(n_side)])[:n_copy]
+    return spacing*(grid - grid.mean(axis=0))
+
+
+def tile_structure(pos, sequence, n_copy, spacing=copy_spacing):
+    '''Positions, sequence and chain first residues of n_copy copies of the centered backbone pos
+    (n_atom,3) placed at grid_offsets'''
+    centered = pos - pos.mean(axis=0)
+    tiled_pos = np.concatenate([centered + x for x in grid_offsets(n_copy, spacing)]).astype('f4')
+    chain_first_residue = [i*len(sequence) for i in range(1,n_copy)]
+    return tiled_pos, list(sequence)*n_copy, chain_first_residue
+
+
+def prepare_configs(structure, work_dir, sizes, config_kwargs):
+    '''Write work_dir/NAME.up for each (NAME, n_copy) of sizes, using the upside_config keyword
+    arguments config_kwargs.  Returns a dict from NAME to (path, n_residue).'''
+    import PDB_to_initial_structure as pis
+    import run_upside as ru
+
+    base = os.path.join(work_dir, 'structure')
+    with open(os.devnull, 'w') as devnull:
+        pis.write_initial_structure(structure, base, stdout=devnull)
+    pos = np.load(base+'.initial.npy')
+    with open(base+'.fasta') as f:
+        sequence = ''.join(ln.strip() for ln in f if not ln.startswith('>'))
+
+    configs = dict()
+    for name, n_copy in sizes:
+        tiled_pos, tiled_seq, chain_first_residue = tile_structure(pos, sequence, n_copy)
+        prefix = os.path.join(work_dir, name)
+        np.save(prefix+'.initial.npy', tiled_pos)
+        with open(prefix+'.fasta', 'w') as f:
+            print('> %i copies of %s' % (n_copy, structure), file=f)
+            print(''.join(tiled_seq), file=f)
+        kwargs = dict(config_kwargs)
+        if chain_first_residue:
+            with open(prefix+'.chain_breaks', 'w') as f:
+                print(' '.join(map(str, chain_first_residue)), file=f)
+                print(' '.join(['1']*n_copy), file=f)
+            kwargs['chain_break_from_file'] = prefix+'.chain_breaks'
+        ru.upside_config(prefix+'.fasta', prefix+'.up', initial_structure=prefix+'.initial.npy', **kwargs)
+        configs[name] = (prefix+'.up', len(tiled_seq))
+    return configs
+
+
+def _run_case(config, duration, n_threads, integrator, seed, profile_top):
+    # Runs in a fresh process; OMP_NUM_THREADS was set before the process started
+    import run_upside as ru
+
+    size_before = os.path.getsize(config)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+    extra_args = ['--threads-per-system', str(n_threads), '--integrator', 'mv' if integrator == 'mv' else 'v']
+    tstart = time.time()
+    job = ru.run_upside('in_process', config, duration, frame_interval=duration/10., n_threads=n_threads,
+            seed=seed, profile=True, profile_top=profile_top, extra_args=extra_args, verbose=False)
+    job.wait()
+    wall_seconds = time.time() - tstart
+
+    import tables as tb
+    with tb.open_file(config) as t:
+        n_round = int(t.root.output.profile._v_attrs.n_round)
+        seconds = float(t.root.output.profile._v_attrs.loop_seconds)
+    inner_step = 3  # both integrators take 3 time steps per round with the default --inner-step
+    return dict(
+            seconds          = seconds,
+            wall_seconds     = wall_seconds,
+            n_step           = n_round*inner_step,
+            steps_per_second = n_round*inner_step/seconds,
+            peak_rss_bytes   = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024,
+            rss_before_bytes = rss_before,
+            output_bytes     = os.path.getsize(config) - size_before,
+            profile          = job.profile[config])
+
+
+def run_case(config, duration, n_threads, integrator, seed=1, profile_top=10):
+    '''Simulate a copy of config in a fresh process and return the measurements as a dict'''
+    old_omp_num_threads = os.environ.get('OMP_NUM_THREADS', None)
+    scratch = config + '.run.up'
+    shutil.copyfile(config, scratch)
+    try:
+        # OpenMP reads the thread count when the library loads, so it must be in the environment
+        # of the new process
+        os.environ['OMP_NUM_THREADS'] = str(n_threads)
+        with multiprocessing.get_context('spawn').Pool(1) as pool:
+            return pool.apply(_run_case, (scratch, duration, n_threads, integrator, seed, profile_top))
+    finally:
+        if old_omp_num_threads is None:
+            del os.environ['OMP_NUM_THREADS']
+        else:
+            os.environ['OMP_NUM_THREADS'] = old_omp_num_threads
+        os.remove(scratch)
+
+
+def case_name(size_name, integrator, n_threads):
+    return '%s/%s/threads%i' % (size_name, integrator, n_threads)
+
+
+def benchmark(configs, duration, thread_counts, integrator_names, n_repeat=3, profile_top=10, stdout=sys.stdout):
+    '''Dict from case name to the result of the fastest of n_repeat runs of each case.  configs is
+    the output of prepare_configs.'''
+    results = dict()
+    for size_name, (config, n_residue) in configs.items():
+        for integrator in integrator_names:
+            for n_threads in thread_counts:
+                r = max([run_case(config, duration, n_threads, integrator, profile_top=profile_top)
+                    for i in range(n_repeat)], key=lambda x: x['steps_per_second'])
+                r.update(n_residue=n_residue, integrator=integrator, n_threads=n_threads, duration=duration,
+                        n_repeat=n_repeat)
+                name = case_name(size_name, integrator, n_threads)
+                results[name] = r
+                top = r['profile'][0] if r['profile'] else dict(name='', fraction=0.)
+                print('%-28s %6i residues %9.1f steps/s %7.1f MB peak RSS %8.1f kB output, top node %s (%.0f%%)' % (
+                    name, n_residue, r['steps_per_second'], r['peak_rss_bytes']/2.**20, r['output_bytes']/1024.,
+                    top['name'], 100.*top['fraction']), file=stdout)
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=0.1, stdout=sys.stdout):
+    '''Print the ratio of each case to the baseline and return the names of the cases whose steps
+    per second fell by more than the fraction tolerance.  Cases missing from either are skipped.'''
+    regressions = []
+    for name in sorted(set(results).intersection(baseline)):
+        r, b = results[name], baseline[name]
+        speed = r['steps_per_second']/b['steps_per_second']
+        slower = speed < 1.-tolerance
+        if slower:
+            regressions.append(name)
+        print('%-28s %5.2fx steps/s %5.2fx peak RSS %5.2fx output%s' % (
+            name, speed, r['peak_rss_bytes']/b['peak_rss_bytes'], r['output_bytes']/max(b['output_bytes'],1),
+            '  REGRESSION' if slower else ''), file=stdout)
+    return regressions
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Measure Upside steps per second over a ladder of system sizes')
+    parser.add_argument('--structure', default=default_structure,
+            help='(default 1ubq.pdb of the repository) PDB or mmCIF structure tiled to make the ladder')
+    parser.add_argument('--sizes', default=','.join(nm for nm,n in size_ladder),
+            help='(default %(default)s) comma-separated sizes to run')
+    parser.add_argument('--threads', default='1', help='(default 1) comma-separated thread counts')
+    parser.add_argument('--integrators', default=','.join(integrators),
+            help='(default %(default)s) comma-separated integrators')
+    parser.add_argument('--duration', type=float, default=10.,
+            help='(default 10) simulation time of each case; the default time step gives 111 steps per unit')
+    parser.add_argument('--repeat', type=int, default=3,
+            help='(default 3) runs of each case, of which the fastest is kept')
+    parser.add_argument('--force-field', default='ff_2.1', help='(default ff_2.1) parameter set')
+    parser.add_argument('--rama-library', default=None,
+            help='Rama library to use instead of the one in parameters/common')
+    parser.add_argument('--profile-top', type=int, default=10,
+            help='(default 10) number of most expensive profile entries kept for each case')
+    parser.add_argument('--work-dir', default=None,
+            help='directory for the configurations (default: a temporary directory that is removed)')
+    parser.add_argument('--output', default=None, help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=None,
+            help='results JSON written by --output in an earlier run on this machine to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+            help='(default 0.1) fraction of the baseline steps per second a case may lose before it is a regression')
+    args = parser.parse_args()
+
+    import batch_config
+    sizes = dict(size_ladder)
+    selected = [x for x in args.sizes.split(',') if x]
+    unknown = [x for x in selected if x not in sizes]
+    if unknown:
+        parser.error('unknown sizes %s; available sizes are %s' % (
+            ','.join(unknown), ','.join(nm for nm,n in size_ladder)))
+    thread_counts = [int(x) for x in args.threads.split(',') if x]
+    integrator_names = [x for x in args.integrators.split(',') if x]
+    if any(x not in integrators for x in integrator_names):
+        parser.error('integrators must be among %s' % ','.join(integrators))
+
+    config_kwargs = batch_config.standard_options(args.force_field)
+    if args.rama_library is not None:
+        config_kwargs['rama_library'] = args.rama_library
+
+    work_dir = args.work_dir or tempfile.mkdtemp()
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        configs = prepare_configs(args.structure, work_dir, [(nm,sizes[nm]) for nm in selected], config_kwargs)
+        results = benchmark(configs, args.duration, thread_counts, integrator_names, args.repeat,
+                args.profile_top)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(file=sys.stdout)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print('%i of %i cases are slower than the baseline' % (len(regressions), len(results)))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
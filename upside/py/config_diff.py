@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+''' Compare Upside configurations and regenerate parts of them.
+
+"diff A.up B.up" prints the groups, arrays and attributes that differ between two configurations,
+with a short hash of the contents of each differing array.
+
+"regenerate BASE.up OUTPUT.up [upside_config.py options]" writes a copy of BASE.up with the
+given options changed.  Only the /input/potential groups that those options affect are rewritten;
+everything else is copied from BASE.up as HDF5 objects, so a scan over many variants of, say,
+--hb-scale or --environment-potential costs little more than the copy.  The options that can be
+changed this way are listed in regenerable_options.  Any other change (the sequence, the initial
+structure, the Rama maps, ...) needs a full upside_config.py run. '''
+
+import sys, os
+from dataclasses import fields, asdict
+
+import numpy as np
+import tables as tb
+import h5py
+
+import attr_overview
+import upside_config as uc
+
+#---------------------------------------------------------------------------
+#                                   diff
+#---------------------------------------------------------------------------
+
+def config_contents(path):
+    '''Dict from the path of every node (and path@name of every user attribute) of the file to a
+    description of its contents: "group", (shape, dtype, digest) for arrays and the value for attributes'''
+    contents = dict()
+    with tb.open_file(path) as t:
+        for node in t.walk_nodes('/'):
+            if isinstance(node, tb.Group):
+                contents[node._v_pathname] = 'group'
+            else:
+                contents[node._v_pathname] = (tuple(int(n) for n in node.shape), str(node.dtype), attr_overview.array_digest(node))
+            for nm in node._v_attrs._v_attrnamesuser:
+                contents['%s@%s' % (node._v_pathname.rstrip('/'), nm)] = node._v_attrs[nm]
+    return contents
+
+
+def _same(a, b):
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        a, b = np.asarray(a), np.asarray(b)
+        return a.shape == b.shape and a.dtype.kind == b.dtype.kind and bool(np.all(a == b))
+    return bool(a == b)
+
+
+def diff_configs(path_a, path_b):
+    '''List of (path, contents in A, contents in B) for every node or attribute that differs, with
+    None for the contents if it is missing from that file'''
+    a = config_contents(path_a)
+    b = config_contents(path_b)
+    return [(k, a.get(k), b.get(k)) for k in sorted(set(a).union(b))
+            if k not in a or k not in b or not _same(a[k], b[k])]
+
+
+def _describe(x, width=40):
+    if isinstance(x, tuple):
+        return '%s %s %s' % x
+    if isinstance(x, np.generic):
+        x = x.item()
+    s = repr(x)
+    return s if len(s) <= width else s[:width-3]+'...'
+
+
+def print_diff(differences, file=sys.stdout):
+    for k, x, y in differences:
+        if x is None:
+            print('+ %s  %s' % (k, _describe(y)), file=file)
+        elif y is None:
+            print('- %s  %s' % (k, _describe(x)), file=file)
+        else:
+            print('! %s  %s -> %s' % (k, _describe(x), _describe(y)), file=file)
+
+#---------------------------------------------------------------------------
+#                               regeneration
+#---------------------------------------------------------------------------
+
+# Each family of potentials is rewritten as a unit, in the order write_system writes them.  The
+# options of a family only affect the groups written by its writers (and apply_param_scale).
+regenerable_families = [
+    ('hbond',       ('hbond_energy', 'hb_scale')),
+    ('rotamer',     ('rotamer_interaction', 'rotamer_solve_damping', 'rotamer_max_damping', 'rotamer_warm_start',
+                     'rot_scale')),
+    ('environment', ('environment_potential', 'environment_potential_type', 'environment_weights_number',
+                     'vector_CA_CO', 'bb_environment_potential', 'use_heavy_atom_coverage', 'env_scale')),
+    ('membrane',    ('membrane_potential', 'channel_membrane_potential', 'membrane_exclude_residues',
+                     'use_curvature', 'curvature_radius', 'curvature_sign', 'membrane_lateral_potential',
+                     'memb_scale')),
+]
+regenerable_options = [nm for family,options in regenerable_families for nm in options]
+
+# options that do not change any potential
+passive_options = ('fasta', 'output', 'measure_max_n_edge', 'max_n_edge_headroom', 'freeze')
+
+
+def _family_enabled(family, o):
+    if family == 'hbond':       return bool(o.hbond_energy)
+    if family == 'rotamer':     return bool(o.rotamer_interaction)
+    if family == 'environment': return bool(o.environment_potential or o.bb_environment_potential)
+    if family == 'membrane':    return bool(o.membrane_potential or o.channel_membrane_potential)
+
+
+def _write_family(builder, family, fasta_seq, o):
+    sc_node_name = 'placement%s_point_vector_only' % ('' if o.dynamic_rotamer_placement else '_fixed')
+    pl_node_name = 'placement%s_scalar'            % ('' if o.dynamic_rotamer_1body     else '_fixed')
+
+    if family == 'hbond':
+        builder.write_short_hbond(fasta_seq, o.hbond_energy)
+    elif family == 'rotamer':
+        if o.hbond_energy and o.rotamer_placement:
+            builder.write_rotamer_backbone(fasta_seq, o.rotamer_interaction, sc_node_name)
+        builder.write_rotamer(fasta_seq, o.rotamer_interaction, o.rotamer_solve_damping, sc_node_name, pl_node_name,
+                max_damping=o.rotamer_max_damping, warm_start=o.rotamer_warm_start)
+    elif family == 'environment':
+        if o.environment_potential:
+            builder.write_environment(fasta_seq, o.environment_potential, sc_node_name, o.environment_potential_type,
+                    o.environment_weights_number, o.vector_CA_CO, False, o.env_exclude_residues,
+                    o.rotamer_exclude_residues)
+        if o.bb_environment_potential:
+            builder.write_bb_environment(fasta_seq, o.environment_potential, sc_node_name,
+                    o.bb_environment_potential, o.use_heavy_atom_coverage)
+    elif family == 'membrane':
+        write = builder.write_membrane_potential4 if o.channel_membrane_potential else builder.write_membrane_potential3
+        write(fasta_seq, o.channel_membrane_potential or o.membrane_potential, o.membrane_thickness,
+                o.membrane_exclude_residues, o.hbond_exclude_residues,
+                o.use_curvature, o.curvature_radius, o.curvature_sign)
+        if o.membrane_lateral_potential:
+            builder.write_membrane_lateral_potential(fasta_seq, o.membrane_lateral_potential)
+
+
+class _ReplacingFile(object):
+    '''Wraps an open tables.File so that creating a potential group first removes the copy of that
+    group from the base configuration.  The names of the replaced groups are kept in replaced.'''
+    def __init__(self, t):
+        self._t = t
+        self.replaced = []
+
+    def __getattr__(self, name):
+        return getattr(self._t, name)
+
+    def create_group(self, where, name, *args, **kwargs):
+        parent = self._t.get_node(where)
+        if parent._v_pathname == '/input/potential':
+            if name in parent and name not in self.replaced:
+                parent._f_get_child(name)._f_remove(recursive=True)
+            self.replaced.append(name)
+        return self._t.create_group(parent, name, *args, **kwargs)
+
+
+def read_options(t):
+    '''ConfigOptions recorded in /input/args of the open configuration t.  Options that the file
+    predates get their defaults.'''
+    attrs = t.root.input.args._v_attrs
+    names = set(attrs._v_attrnamesuser)
+    return uc.ConfigOptions(**dict((f.name, attrs[f.name]) for f in fields(uc.ConfigOptions) if f.name in names))
+
+
+def changed_options(old, new):
+    return [f.name for f in fields(uc.ConfigOptions) if not _same(getattr(old, f.name), getattr(new, f.name))]
+
+
+def _copy_h5(src_path, dst_path):
+    # h5py copies the stored (compressed) chunks without decoding them
+    with h5py.File(src_path, 'r') as src, h5py.File(dst_path, 'w') as dst:
+        for k,v in src.attrs.items():
+            dst.attrs[k] = v
+        for nm in src:
+            src.copy(src[nm], dst, nm)
+
+
+def regenerate_config(base_path, output_path, options, invocation='', stdout=None):
+    '''Write output_path as base_path with its potential rewritten for options (a ConfigOptions,
+    usually read_options of the base with some fields replaced).  Returns the names of the
+    rewritten /input/potential groups.  Raises ConfigError if an option outside
+    regenerable_options changed or if the change adds or removes a potential.'''
+    with tb.open_file(base_path) as t:
+        base = read_options(t)
+    changed = [nm for nm in changed_options(base, options) if nm not in passive_options]
+
+    unsupported = [nm for nm in changed if nm not in regenerable_options]
+    if unsupported:
+        raise uc.ConfigError('cannot regenerate a configuration after changing %s; run upside_config.py instead'
+                % ', '.join(unsupported))
+    families = [family for family,family_options in regenerable_families
+            if any(nm in changed for nm in family_options)]
+    for family in families:
+        if _family_enabled(family, base) != _family_enabled(family, options):
+            raise uc.ConfigError('changing the %s options would add or remove a potential; '
+                    'run upside_config.py instead' % family)
+
+    # Rewrite a scratch copy in place, then copy it to the output to drop the replaced groups
+    scratch_path = output_path + '.partial'
+    _copy_h5(base_path, scratch_path)
+    try:
+        with tb.open_file(scratch_path, 'a') as t:
+            builder = uc.ConfigBuilder(options, invocation=invocation, stdout=stdout)
+            builder.t = _ReplacingFile(t)
+            builder.potential = t.root.input.potential
+            fasta_seq = np.array([(x if x != 'CPR' else 'PRO') for x in
+                    t.root.input.sequence[:].astype(str)])
+            builder.use_intensive_memory = ((len(fasta_seq) > 1000 or options.intensive_memory)
+                    and not options.no_intensive_memory)
+
+            for family in families:
+                _write_family(builder, family, fasta_seq, options)
+            builder.apply_param_scale(
+                    options.hb_scale   if 'hbond'       in families else 1.,
+                    options.env_scale  if 'environment' in families else 1.,
+                    options.rot_scale  if 'rotamer'     in families else 1.,
+                    options.memb_scale if 'membrane'    in families else 1.)
+            if families and options.integrator_level:
+                # the writers of the rewritten families set their default levels
+                builder.apply_integrator_levels(options.integrator_level)
+
+            args_group = t.root.input.args
+            for k,v in sorted(asdict(options).items()):
+                args_group._v_attrs[k] = v
+            args_group._v_attrs['invocation'] = invocation
+            replaced = builder.t.replaced
+
+        if options.freeze:
+            import upside_engine as ue
+            ue.freeze_constant_nodes(scratch_path, scratch_path)
+        if options.measure_max_n_edge:
+            uc.measure_max_n_edge(scratch_path, options.max_n_edge_headroom)
+        _copy_h5(scratch_path, output_path)
+    finally:
+        if os.path.exists(scratch_path):
+            os.remove(scratch_path)
+    return replaced
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Compare Upside configurations or regenerate part of one',
+            usage='use "%(prog)s --help" for more information')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('diff', help='print the groups, arrays and attributes that differ between two configurations')
+    p.add_argument('config_a')
+    p.add_argument('config_b')
+    p.add_argument('--include-args', action='store_true',
+            help='also compare /input/args, the record of the options used to build each file')
+
+    p = sub.add_parser('regenerate', help='copy a configuration, rewriting only the potentials affected by ' +
+            'the given upside_config.py options (%s)' % ', '.join('--'+nm.replace('_','-') for nm in regenerable_options))
+    p.add_argument('base')
+    p.add_argument('output')
+    args, config_argv = parser.parse_known_args()
+
+    if args.command == 'diff':
+        if config_argv:
+            parser.error('unrecognized arguments: %s' % ' '.join(config_argv))
+        differences = [d for d in diff_configs(args.config_a, args.config_b)
+                if args.include_args or not d[0].startswith('/input/args')]
+        print_diff(differences)
+        sys.exit(1 if differences else 0)
+
+    with tb.open_file(args.base) as t:
+        base = read_options(t)
+    # options not given on the command line keep their values from the base configuration
+    config_parser = uc.make_parser()
+    namespace = argparse.Namespace(**asdict(base))
+    config_parser.parse_args(['--fasta', base.fasta, '--output', args.output] + config_argv, namespace)
+    options = uc.ConfigOptions(**vars(namespace))
+
+    try:
+        replaced = regenerate_config(args.base, args.output, options, invocation=' '.join(sys.argv))
+    except uc.ConfigError as e:
+        parser.error(str(e))
+    print('rewrote %s' % (', '.join(replaced) if replaced else 'no potentials'))
+
+if __name__ == '__main__':
+    main()
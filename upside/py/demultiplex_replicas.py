@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+''' Demultiplex replica exchange output in a single pass.
+
+Replica exchange writes one file per temperature, each holding the frames of whichever replica
+was at that temperature.  This writes one continuous-replica trajectory per replica (or, with
+--mode temperature, a compact copy of each continuous-temperature trajectory together with its
+replica index), reading every input frame once. '''
+
+import sys
+import mdtraj_upside as mu
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Demultiplex Upside replica exchange trajectories')
+    parser.add_argument('input_h5', nargs='+', help='Replica exchange output files, in the order of the --temperature list')
+    parser.add_argument('--output-base', required=True,
+            help='output files are written to OUTPUT_BASE.rep{N}.up (or .temp{N}.up with --mode temperature)')
+    parser.add_argument('--mode', default='replica', choices=['replica','temperature'],
+            help='(default replica) write continuous-replica or continuous-temperature trajectories')
+    parser.add_argument('--chunk-size', type=int, default=200, help='(default 200) frames read at a time')
+    parser.add_argument('--stride', type=int, default=1, help='(default 1) keep every STRIDE-th frame')
+    args = parser.parse_args(sys.argv[1:])
+
+    suffix = 'rep' if args.mode == 'replica' else 'temp'
+    output_paths = ['%s.%s%i.up'%(args.output_base, suffix, i) for i in range(len(args.input_h5))]
+    mu.demultiplex_upside_files(args.input_h5, output_paths, mode=args.mode,
+            chunk_size=args.chunk_size, stride=args.stride)
+    for fn in output_paths:
+        print(fn)
+
+if __name__ == '__main__':
+    main()
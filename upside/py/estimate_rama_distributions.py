@@ -3,59 +3,200 @@
 import os,sys
 import tables as tb
 import numpy as np
-from sklearn.neighbors.kde import KernelDensity
 import pickle as cp
+from quantized_output import output_array
+from mdtraj_upside import output_groups
 
 deg = np.pi/180.
-
-def add_image_points(rama, padding):
-    assert rama.shape == (rama.shape[0], 2)
-    assert np.all(np.abs(rama) < np.pi+1e-3)  # must be in the range (-pi,pi)
-
-    new_rama = np.concatenate([rama + np.array((i*2*np.pi,j*2*np.pi), dtype='f4')
-            for i in [-1,0,1] for j in [-1,0,1]], axis=0)
-
-    new_rama = new_rama[np.all(np.abs(new_rama) < np.pi+padding,axis=-1)]
-
-    return new_rama
-
-
-def rama_density(rama, bw_no_std):
-    print (rama.shape)
-    assert rama.shape == (rama.shape[0], 2)
-    bins = (-180.+np.arange(72)*5.)*deg
-
-    eval_points = np.column_stack([a.ravel() for a in np.meshgrid(bins,bins)])
-
-    bw = bw_no_std / np.sqrt(np.var(rama,axis=0).sum(axis=-1))  # correct for scikit automatic bandwidth selection
-
-    kde = KernelDensity(kernel='gaussian', bandwidth=bw, rtol=1e-2).fit(rama)
-    return np.exp(kde.score_samples(eval_points).reshape((bins.shape[0],bins.shape[0])))
+n_bin = 72  # 5 degree grid for the output densities
+
+def rama_from_pos(pos):
+    '''Compute (phi,psi) in radians from N,CA,C positions of shape (n_frame,3*n_res,3).
+    The N-terminal phi and C-terminal psi are undefined and are returned as NaN.'''
+    n_frame = pos.shape[0]
+    n_res = pos.shape[1]//3
+    bb = pos.reshape((n_frame,n_res,3,3))  # (N,CA,C) per residue
+
+    def dihedral(x1,x2,x3,x4):
+        # same (IUPAC) sign convention as PDB_to_initial_structure.dihedral
+        b1 = x2-x1; b2 = x3-x2; b3 = x4-x3
+        b2b3 = np.cross(b2,b3)
+        b2mag = np.linalg.norm(b2,axis=-1)
+        return np.arctan2(b2mag*(b1*b2b3).sum(axis=-1), (np.cross(b1,b2)*b2b3).sum(axis=-1))
+
+    rama = np.full((n_frame,n_res,2), np.nan, dtype='f4')
+    rama[:,1:, 0] = dihedral(bb[:,:-1,2], bb[:,1:,0], bb[:,1:,1], bb[:,1:,2])
+    rama[:,:-1,1] = dihedral(bb[:,:-1,0], bb[:,:-1,1], bb[:,:-1,2], bb[:,1:,0])
+    return rama
+
+
+def iter_rama_chunks(fname, system=0, chunk_size=10000):
+    '''Yield (n_frame,n_res,2) rama angles in chunks, reading /output/rama when it was logged
+    and computing the angles from /output/pos otherwise.  Restarts do not repeat their first frame.'''
+    with tb.open_file(fname) as t:
+        for g_no, g in enumerate(output_groups(t)):
+            first = 1 if g_no else 0
+            if 'rama' in g:
+                dset = g.rama
+                take = (lambda s,e: dset[s:e]) if len(dset.shape)==3 else (lambda s,e: dset[s:e,system])
+            else:
+                dset = output_array(g, 'pos')
+                take = lambda s,e: rama_from_pos(dset[s:e,system])
+            for s in range(first, dset.shape[0], chunk_size):
+                yield take(s, min(s+chunk_size, dset.shape[0]))
+
+
+class RamaHistogram(object):
+    '''Periodic (phi,psi) histogram for every residue that may be filled in chunks and merged
+    across trajectories.  The density estimate is the histogram convolved with a Gaussian on
+    the torus, which is done with FFTs for all residues at once.
+
+    The histogram is kept in float32 on the 72x72 output grid, about 60 MB for 3000 residues.
+    Each sample is shared linearly between its neighbouring grid points, and the smoothing step
+    divides out the transfer function of that linear binning.  The moments that set the bandwidth
+    are summed from the samples themselves, since they are sensitive to the few image points near
+    the edge of the padded square.'''
+
+    def __init__(self, n_res, padding=80.*deg):
+        self.n_res = n_res
+        self.n_grid = n_bin
+        self.padding = padding
+        self.counts = np.zeros((n_res,self.n_grid,self.n_grid), dtype='f4')
+        self.n_sample = np.zeros(n_res)
+        self.moments = np.zeros((n_res,5))  # count, phi, psi, phi^2, psi^2 of the padded images
+
+    def add(self, rama):
+        n_frame,n_res,two = rama.shape; assert two == 2
+        assert n_res == self.n_res
+        rama = np.asarray(rama, dtype='f8')
+
+        # grid points sit at -pi + k*spacing, matching the output bins; each sample is shared
+        # linearly between its neighbouring grid points so binning error is second order in spacing
+        spacing = 2*np.pi/self.n_grid
+        x = (rama+np.pi)/spacing
+        defined = np.isfinite(x)
+        x = np.where(defined, x, 0.)
+        lo = np.floor(x)
+        frac = x-lo
+        lo = lo.astype('i8') % self.n_grid
+        hi = (lo+1) % self.n_grid
+
+        residue = np.broadcast_to(np.arange(n_res), defined.shape[:2])
+        both = defined[...,0] & defined[...,1]
+        flat_counts = self.counts.reshape(-1)  # view, since counts is contiguous
+        for i0,w0 in ((lo[...,0],1.-frac[...,0]), (hi[...,0],frac[...,0])):
+            for i1,w1 in ((lo[...,1],1.-frac[...,1]), (hi[...,1],frac[...,1])):
+                flat_idx = (residue*self.n_grid + i0)*self.n_grid + i1
+                np.add.at(flat_counts, flat_idx[both], (w0*w1)[both])
+
+        # an undefined terminal angle spreads its sample uniformly along that axis
+        for axis in (0,1):
+            lone = defined[...,axis] & ~defined[...,1-axis]
+            if lone.any():
+                marginal = np.zeros((n_res,self.n_grid), dtype='f4')
+                for ia,wa in ((lo[...,axis],1.-frac[...,axis]), (hi[...,axis],frac[...,axis])):
+                    np.add.at(marginal, (residue[lone], ia[lone]), wa[lone]/self.n_grid)
+                self.counts += marginal[:,:,None] if axis==0 else marginal[:,None,:]
+
+        self.moments  += self._padded_moments(rama, defined)
+        self.n_sample += n_frame
+
+    def _padded_moments(self, rama, defined):
+        # (count, x, x^2) of each angle for the images at shifts -2pi, 0, 2pi that lie within padding
+        # of the (-pi,pi) square.  An undefined angle is uniform over the grid points, as in add.
+        grid = -np.pi + np.arange(self.n_grid)*(2*np.pi/self.n_grid)
+        used = (defined[...,0] | defined[...,1])[...,None]
+        phi, psi = [np.zeros(defined.shape[:2]+(3,)) for axis in (0,1)]
+        for axis,total in ((0,phi), (1,psi)):
+            for shift in (-2*np.pi, 0., 2*np.pi):
+                x = np.where(defined[...,axis], rama[...,axis], 0.) + shift
+                inside = defined[...,axis] & (np.abs(x) < np.pi+self.padding)
+                g = grid + shift
+                g = g[np.abs(g) < np.pi+self.padding]
+                uniform = np.array([len(g), g.sum(), (g**2).sum()])/self.n_grid
+                term = np.stack([inside, inside*x, inside*x**2], axis=-1)
+                total += np.where(defined[...,axis,None], term, uniform*used)
+        # the count of image (i,j) is the product of the axis counts, so the sums over the 9 images
+        # are products of the sums over the shifts of each axis
+        return np.column_stack([
+            (phi[...,0]*psi[...,0]).sum(axis=0),
+            (phi[...,1]*psi[...,0]).sum(axis=0), (phi[...,0]*psi[...,1]).sum(axis=0),
+            (phi[...,2]*psi[...,0]).sum(axis=0), (phi[...,0]*psi[...,2]).sum(axis=0)])
+
+    def merge(self, other):
+        assert (other.n_res, other.n_grid, other.padding) == (self.n_res, self.n_grid, self.padding)
+        self.counts   += other.counts
+        self.moments  += other.moments
+        self.n_sample += other.n_sample
+        return self
+
+    def padded_variance(self):
+        '''Total (phi,psi) variance of each residue after adding the periodic images that lie within
+        padding of the (-pi,pi) square, as the image-padded KernelDensity estimator used to compute it'''
+        m = self.moments
+        n = np.maximum(m[:,0], 1.)
+        return (m[:,3]/n - (m[:,1]/n)**2) + (m[:,4]/n - (m[:,2]/n)**2)
+
+    def density(self, bw_no_std):
+        '''Return (n_res,72,72) densities evaluated at the same points and in the same layout as the
+        previous KernelDensity estimator, i.e. densities[nr,i,j] is the density at phi=bins[j],
+        psi=bins[i] with bins = -180+5*k degrees.  The bandwidth is bw_no_std divided by the square
+        root of the total variance of the image-padded angles, as before, but each density is now
+        normalized on the torus rather than over the padded points.  Bandwidths below the 5 degree
+        grid spacing, which only nearly uniform residues reach, are not resolved by the grid.'''
+        n = np.maximum(self.n_sample, 1.)
+        bw = bw_no_std / np.sqrt(np.maximum(self.padded_variance(), 1e-12))
+
+        # Fourier coefficients of the periodic Gaussian are exp(-bw^2 k^2/2) for integer frequencies k.
+        # Sampled on the grid, the frequencies k+m*n_grid fold onto k, and linear binning multiplies
+        # the coefficients of the samples by sinc^2(k/n_grid), which is divided out.
+        k  = np.fft.fftfreq (self.n_grid, d=1./self.n_grid)
+        kr = np.fft.rfftfreq(self.n_grid, d=1./self.n_grid)
+        folds = np.arange(-2,3)*self.n_grid
+        binning_k  = np.sinc(k /self.n_grid)**2
+        binning_kr = np.sinc(kr/self.n_grid)**2
+
+        densities = np.zeros((self.n_res,n_bin,n_bin))
+        block = 64  # residues per FFT to bound the size of the temporaries
+        for s in range(0, self.n_res, block):
+            e = min(s+block, self.n_res)
+            b2 = bw[s:e,None,None]**2
+            kernel_k  = np.exp(-0.5*b2*(k [None,:,None]+folds)**2).sum(axis=-1) / binning_k
+            kernel_kr = np.exp(-0.5*b2*(kr[None,:,None]+folds)**2).sum(axis=-1) / binning_kr
+            kernel = kernel_k[:,:,None]*kernel_kr[:,None,:]
+            smoothed = np.fft.irfft2(np.fft.rfft2(self.counts[s:e].astype('f8'))*kernel, s=(self.n_grid,self.n_grid))
+            smoothed *= self.n_grid**2 / ((2*np.pi)**2 * n[s:e,None,None])
+            # counts are indexed [phi,psi]; the output layout is [psi,phi]
+            densities[s:e] = smoothed.transpose((0,2,1))
+
+        return np.maximum(densities, 0.)  # remove FFT round-off below zero
 
 
 def main():
     import argparse
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('input_h5', help='Simulation output')
+    parser.add_argument('input_h5', nargs='+', help='Simulation output (several files are merged into one estimate)')
     parser.add_argument('output_pkl', help='path to put output density pickles')
     parser.add_argument('--system', type=int, required=True, help='system to analyze')
     parser.add_argument('--bandwidth', default=0.2, type=float, help='Bandwidth for kernel density estimate')
     parser.add_argument('--periodic-padding', type=float, default=80., 
-            help='periodic padding of angles (in degrees, default 80.)')
+            help='periodic padding of angles used to set the bandwidth (in degrees, default 80.)')
+    parser.add_argument('--chunk-size', type=int, default=10000,
+            help='number of frames read at a time (default 10000)')
 
     args = parser.parse_args(sys.argv[1:])
 
-    with tb.open_file(args.input_h5) as t:
-        rama = t.root.output.rama[:]
-
-    n_frame,n_res,two = rama.shape;  assert two == 2
-    densities = np.zeros((n_res,72,72))
+    hist = None
+    for fn in args.input_h5:
+        for rama in iter_rama_chunks(fn, args.system, args.chunk_size):
+            if hist is None:
+                hist = RamaHistogram(rama.shape[1], args.periodic_padding*deg)
+            hist.add(rama)
+    if hist is None:
+        parser.error('no frames in %s' % ' '.join(args.input_h5))
 
-    for nr in range(n_res):
-        densities[nr] = rama_density(
-                add_image_points(rama[:,nr], args.periodic_padding*deg), 
-                args.bandwidth)
+    densities = hist.density(args.bandwidth)
 
     with open(args.output_pkl,'wb') as f:
         cp.dump(densities,f,-1)
@@ -3,6 +3,7 @@ import sys
 from string import ascii_lowercase
 import tables
 import numpy as np
+from quantized_output import output_array
 
 H_bond=0.88
 O_bond=1.24
@@ -152,7 +153,7 @@ def main():
         stride = args.stride
         for opath in output_paths:
             g = t.get_node(t.get_node(opath))
-            pos.append(g.pos[start_frame::stride].transpose((0,2,3,1)))
+            pos.append(output_array(g, 'pos')[start_frame::stride].transpose((0,2,3,1)))
             # take into account that the first frame of each pos is the same as the last frame before restart
             # attempt to land on the stride
             total_frames_produced += g.pos.shape[0]-1  # correct for first frame
@@ -10,6 +10,7 @@ import sys,os
 import numpy as np
 import tables as tb
 import h5py as h5
+from quantized_output import output_array
 
 
 def generate_config_for_restart(up_fname, up_fname_for_next_round, frame=-1):
@@ -28,7 +29,7 @@ def generate_config_for_restart(up_fname, up_fname_for_next_round, frame=-1):
             NF = in_H5.root.output.pos.shape[0]
             assert NF > frame
 
-            out_H5.root.input.pos[:,:,0] = in_H5.root.output.pos[frame, 0]
+            out_H5.root.input.pos[:,:,0] = output_array(in_H5.root.output, 'pos')[frame, 0]
             if 'tip_pos' in in_H5.root.output:
                 use_AFM_pulling = True
                 tip_pos         = in_H5.root.output.tip_pos[frame]
@@ -66,6 +67,7 @@ import sys,os
 import numpy as np
 import tables as tb
 import h5py as h5
+from quantized_output import output_array
 
 
 def generate_config_for_restart(up_fname, up_fname_for_next_round, frame=-1):
@@ -84,7 +86,7 @@ def generate_config_for_restart(up_fname, up_fname_for_next_round, frame=-1):
             NF = in_H5.root.output.pos.shape[0]
             assert NF > frame
 
-            out_H5.root.input.pos[:,:,0] = in_H5.root.output.pos[frame, 0]
+            out_H5.root.input.pos[:,:,0] = output_array(in_H5.root.output, 'pos')[frame, 0]
             if 'tip_pos' in in_H5.root.output:
                 use_AFM_pulling = True
                 tip_pos         = in_H5.root.output.tip_pos[frame]
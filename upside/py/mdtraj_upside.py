@@ -6,6 +6,7 @@ import mdtraj.core.element as el
 import mdtraj as md
 
 from mdtraj.formats.registry import FormatRegistry
+from quantized_output import output_array
 angstrom=0.1  # conversion to nanometer from angstrom
 
 aa_conv_dict = {"A": "ALA", "R": "ARG", "N": "ASN", "D": "ASP", "C": "CYS", "E": "GLU",
@@ -22,7 +23,8 @@ def vmag(x):
 def vhat(x):
     return x / vmag(x)[...,None]
 
-def _output_groups(t):
+def output_groups(t):
+    '''The /output_previous_* groups of restarts in order, followed by /output'''
     i=0
     while 'output_previous_%i'%i in t.root:
         yield t.get_node('/output_previous_%i'%i)
@@ -31,6 +33,26 @@ def _output_groups(t):
         yield t.get_node('/output')
         i += 1
 
+def iter_upside_pos(fname, chunk_size=1000, start=0, stride=1, system=0):
+    '''Yield the N,CA,C positions (angstroms) of one system in chunks of at most chunk_size frames.
+    Frames are numbered as in load_upside_traj, i.e. restarts do not repeat their first frame,
+    and only frames start, start+stride, ... are read from disk.'''
+    import tables as tb
+
+    with tb.open_file(fname) as t:
+        offset = 0  # index of the first new frame of this group in the continuous trajectory
+        for g_no, g in enumerate(output_groups(t)):
+            first = 1 if g_no else 0  # first frame of each restart repeats the last frame before it
+            pos = output_array(g, 'pos')
+            n_frame = pos.shape[0]
+            n_new = n_frame - first
+
+            lo = max(start, offset)
+            lo = start + stride*(-(-(lo-start)//stride))  # round up to the next frame on the stride
+            for s in range(lo-offset+first, n_frame, chunk_size*stride):
+                yield pos[s:min(s+chunk_size*stride, n_frame):stride, system]
+            offset += n_new
+
 def traj_from_upside(seq, time, pos, chain_first_residue, chain_counts, add_extra_atoms=True):
     H_bond_length = 0.88
     O_bond_length = 1.24
@@ -184,11 +206,11 @@ def load_upside_traj(fname, top='', stride=1, external_pos=[], from_init=False,
             elif initial_pos_only:
                 xyz.append(t.root.input.pos[:,:,0])
             else:
-                for g_no, g in enumerate(_output_groups(t)):
+                for g_no, g in enumerate(output_groups(t)):
                     # take into account that the first frame of each pos is the same as the last frame before restart
                     # attempt to land on the stride
                     sl = slice(start_frame,None,stride)
-                    xyz.append(g.pos[sl,0])
+                    xyz.append(output_array(g, 'pos')[sl,0])
                     time.append(g.time[sl]+last_time)
                     last_time = g.time[-1]+last_time
                     total_frames_produced += g.pos.shape[0]-(1 if g_no else 0)  # correct for first frame
@@ -249,60 +271,144 @@ def load_upside_data(fname, output_names):
 
     # return dict from output_names to numpy array of values
 
+def _output_segments(t):
+    '''(group, first local frame, number of frames) for each output group, where the first frame
+    of each restart is skipped because it repeats the last frame before the restart'''
+    return [(g, (1 if g_no else 0), g.pos.shape[0]-(1 if g_no else 0))
+            for g_no, g in enumerate(output_groups(t))]
+
+def _read_frames(segments, name, frames):
+    '''Read dataset name at the sorted continuous frame indices frames across output groups'''
+    output = []
+    offset = 0
+    for g, first, n in segments:
+        sel = frames[(frames>=offset) & (frames<offset+n)] - offset + first
+        if len(sel):
+            dset = output_array(g, name)
+            step = np.diff(sel)
+            if len(sel) == 1 or np.all(step == step[0]):
+                output.append(dset[sel[0]:sel[-1]+1:(step[0] if len(step) else 1)])
+            else:
+                # read each run of consecutive frames, since PyTables only fancy-indexes 1d arrays
+                breaks = np.nonzero(step != 1)[0]+1
+                for run in np.split(sel, breaks):
+                    output.append(dset[run[0]:run[-1]+1])
+        offset += n
+    return np.concatenate(output, axis=0)
+
+def _read_topology_info(t):
+    seq = t.root.input.sequence[:]
+    chain_first_residue = np.array([0], dtype='int32')
+    chain_counts = np.array([1], dtype='int32')
+    if 'chain_break' in t.root.input:
+        chain_first_residue = np.append(chain_first_residue, t.root.input.chain_break.chain_first_residue[:])
+        if 'chain_counts' in t.root.input.chain_break:
+            chain_counts = t.root.input.chain_break.chain_counts[:]
+        else:
+            chain_counts = np.array([1 for i in chain_first_residue])
+    return seq, chain_first_residue, chain_counts
+
+def replica_source_table(fnames, stride=1):
+    '''Read /output/replica_index once from every replica file and return (frames, source), where
+    frames are the continuous frame indices used and source[r,i] is the index into fnames of the
+    file that held replica r at frame frames[i].  Only the small replica_index arrays are read.'''
+    import tables as tb
+    replica_index = []
+    for fn in fnames:
+        with tb.open_file(fn) as t:
+            segments = _output_segments(t)
+            n_frame = sum(n for g,first,n in segments)
+            replica_index.append(_read_frames(segments, 'replica_index', np.arange(0,n_frame,stride))[:,0])
+    n_frame = min(len(r) for r in replica_index)  # an interrupted run may have flushed unevenly
+    replica_index = np.stack([r[:n_frame] for r in replica_index])
+
+    # replica_index[:,i] is a permutation of the replicas, so sorting it inverts the permutation
+    if not np.all(np.sort(replica_index,axis=0) == np.arange(len(fnames))[:,None]):
+        raise ValueError('replica_index is not a permutation of the replicas at every frame')
+    return np.arange(n_frame)*stride, np.argsort(replica_index, axis=0)
+
 def load_upside_rep(fnames, rep_select, stride=1, add_atoms=True):
+    '''Load the continuous trajectory of replica rep_select from the replica exchange files fnames
+    (one per temperature).  Each file is read only at the frames where it held rep_select.'''
     import tables as tb
-    for i, fn in enumerate(fnames):
-        if i == 0:
-            with tb.open_file(fn) as t:
-                last_time = 0.
-                start_frame = 0
-                total_frames_produced = 0
-                xyz = []
-                time = []
-                for g_no, g in enumerate(_output_groups(t)):
-                    # take into account that the first frame of each pos is the same as the last frame before restart
-                    # attempt to land on the stride
-                    sl = slice(start_frame,None,stride)
-                    xyz.append(g.pos[sl,0])
-                    time.append(g.time[sl]+last_time)
-                    last_time = g.time[-1]+last_time
-                    total_frames_produced += g.pos.shape[0]-(1 if g_no else 0)  # correct for first frame
-                    start_frame = 1 + stride*(total_frames_produced%stride>0) - total_frames_produced%stride
-                xyz = np.concatenate(xyz,axis=0)
-                time = np.concatenate(time,axis=0)
-
-                seq = t.root.input.sequence[:]
-
-                # Check for chain breaks in config file
-                chain_first_residue = np.array([0], dtype='int32')
-                chain_counts = np.array([1], dtype='int32')
-                if 'chain_break' in t.root.input:
-                    chain_first_residue = np.append(chain_first_residue, t.root.input.chain_break.chain_first_residue[:])
-                    if 'chain_counts' in t.root.input.chain_break:
-                        chain_counts = t.root.input.chain_break.chain_counts[:]
-                    else:
-                        chain_counts = np.array([1 for i in chain_first_residue])
-        else:
-            with tb.open_file(fn) as t:
-                start_frame = 0
-                total_frames_produced = 0
-                xyz2 = []
-                replica_idx = []
-                for g_no, g in enumerate(_output_groups(t)):
-                    # take into account that the first frame of each pos is the same as the last frame before restart
-                    # attempt to land on the stride
-                    sl = slice(start_frame,None,stride)
-                    xyz2.append(g.pos[sl,0])
-                    replica_idx.append(g.replica_index[sl,0])
-                    total_frames_produced += g.pos.shape[0]-(1 if g_no else 0)  # correct for first frame
-                    start_frame = 1 + stride*(total_frames_produced%stride>0) - total_frames_produced%stride
-            xyz2 = np.concatenate(xyz2, axis=0)
-            replica_idx = np.concatenate(replica_idx, axis=0)
-            replica_idx = (replica_idx == rep_select)
-            
-            xyz[replica_idx] = xyz2[replica_idx]
-        
-    return traj_from_upside(seq, time, xyz, chain_first_residue, chain_counts, add_extra_atoms=add_atoms)        
+    frames, source = replica_source_table(fnames, stride)
+    source = source[rep_select]
+
+    xyz = None
+    for nf, fn in enumerate(fnames):
+        with tb.open_file(fn) as t:
+            segments = _output_segments(t)
+            if nf == 0:
+                time = _read_frames(segments, 'time', frames)
+                seq, chain_first_residue, chain_counts = _read_topology_info(t)
+            here = source==nf
+            if here.any():
+                pos = _read_frames(segments, 'pos', frames[here])[:,0]
+                if xyz is None:
+                    xyz = np.zeros((len(frames),)+pos.shape[1:], dtype=pos.dtype)
+                xyz[here] = pos
+
+    return traj_from_upside(seq, time, xyz, chain_first_residue, chain_counts, add_extra_atoms=add_atoms)
+
+def demultiplex_upside_files(fnames, output_paths, mode='replica', chunk_size=200, stride=1):
+    '''Demultiplex replica exchange output in a single pass over the replica files.
+
+    fnames holds one file per temperature.  With mode='replica', output_paths[r] receives the
+    continuous trajectory of replica r, together with the temperature and source file of each frame.
+    With mode='temperature', output_paths[k] receives the continuous-temperature trajectory of
+    fnames[k] together with the replica held at each frame.  Each output has the /input group of the
+    first file and an /output group readable by load_upside_traj.  Frames are processed chunk_size
+    at a time, so every position is read once and memory is bounded by one chunk per file.'''
+    import tables as tb
+    assert mode in ('replica', 'temperature')
+    assert len(output_paths) == len(fnames)
+    frames, source = replica_source_table(fnames, stride)
+    n_rep = len(fnames)
+
+    inputs = [tb.open_file(fn) for fn in fnames]
+    outputs = []
+    try:
+        segments = [_output_segments(t) for t in inputs]
+        n_atom = inputs[0].root.input.pos.shape[0]
+        for path in output_paths:
+            out = tb.open_file(path, 'w')
+            outputs.append(out)
+            inputs[0].root.input._f_copy(out.root, recursive=True)
+            g = out.create_group(out.root, 'output')
+            filters = tb.Filters(complib='zlib', complevel=5, fletcher32=True)
+            out.create_earray(g, 'pos',  tb.Float32Atom(), (0,1,n_atom,3), filters=filters)
+            out.create_earray(g, 'time', tb.Float64Atom(), (0,), filters=filters)
+            out.create_earray(g, 'potential', tb.Float64Atom(), (0,1), filters=filters)
+            out.create_earray(g, 'temperature', tb.Float64Atom(), (0,1), filters=filters)
+            out.create_earray(g, 'replica_index' if mode=='temperature' else 'system_index',
+                    tb.Int32Atom(), (0,1), filters=filters)
+
+        for s in range(0, len(frames), chunk_size):
+            fr = frames[s:s+chunk_size]
+            src = source[:,s:s+chunk_size]
+            time = _read_frames(segments[0], 'time', fr)
+            pos  = np.stack([_read_frames(seg, 'pos',         fr)[:,0] for seg in segments])
+            pot  = np.stack([_read_frames(seg, 'potential',   fr)[:,0] for seg in segments])
+            temp = np.stack([_read_frames(seg, 'temperature', fr)[:,0] for seg in segments])
+            idx  = np.arange(len(fr))
+
+            for r in range(n_rep):
+                g = outputs[r].root.output
+                if mode == 'replica':
+                    g.pos.append(pos[src[r],idx][:,None])
+                    g.potential.append(pot[src[r],idx][:,None])
+                    g.temperature.append(temp[src[r],idx][:,None])
+                    g.system_index.append(src[r][:,None].astype('i4'))
+                else:
+                    g.pos.append(pos[r][:,None])
+                    g.potential.append(pot[r][:,None])
+                    g.temperature.append(temp[r][:,None])
+                    # the replica at this temperature is the one whose source is this file
+                    g.replica_index.append(np.argmax(src==r, axis=0)[:,None].astype('i4'))
+                g.time.append(time)
+    finally:
+        for t in outputs+inputs:
+            t.close()
 
 def ca_contact_pca(traj, n_pc, cutoff_angstroms=8., variance_scaled=True):
     from sklearn.decomposition import TruncatedSVD
@@ -314,6 +420,102 @@ def ca_contact_pca(traj, n_pc, cutoff_angstroms=8., variance_scaled=True):
     return pc
 
 
+def ca_contact_pair_index(i, j, n_res):
+    '''Column of residue pair (i,j), i+3<=j, in the contact ordering of md.compute_contacts(scheme='ca')'''
+    return i*(n_res-3) - i*(i-1)//2 + (j-i-3)
+
+def sparse_ca_contacts(ca_pos, cutoff_angstroms=8.):
+    '''Contact matrix of CA positions (n_frame,n_res,3) in angstroms as a boolean CSR matrix of shape
+    (n_frame,n_pairs), with the same pair ordering as ca_contact_pca.  Contacts are found with a
+    neighbour list per frame, so the cost scales with the number of contacts rather than pairs.'''
+    import scipy.sparse
+    from scipy.spatial import cKDTree
+    n_frame, n_res = ca_pos.shape[:2]
+    n_pairs = (n_res-2)*(n_res-3)//2
+
+    indptr = [0]
+    indices = []
+    for x in ca_pos:
+        pairs = cKDTree(x).query_pairs(cutoff_angstroms, output_type='ndarray')
+        pairs = pairs[pairs[:,1]-pairs[:,0] >= 3]
+        col = np.sort(ca_contact_pair_index(pairs[:,0], pairs[:,1], n_res))
+        indices.append(col)
+        indptr.append(indptr[-1]+len(col))
+    indices = np.concatenate(indices) if indices else np.zeros(0,dtype='i8')
+    return scipy.sparse.csr_matrix((np.ones(len(indices),dtype=bool), indices, np.array(indptr)),
+            shape=(n_frame,n_pairs))
+
+def iter_sparse_ca_contacts(fnames, cutoff_angstroms=8., chunk_size=10000, stride=1):
+    '''Yield CSR contact matrices for consecutive chunks of frames from the Upside files fnames'''
+    for fn in fnames:
+        for pos in iter_upside_pos(fn, chunk_size=chunk_size, stride=stride):
+            yield sparse_ca_contacts(pos[:,1::3], cutoff_angstroms)
+
+def streaming_ca_contact_pca(chunk_source, n_pc, variance_scaled=True, n_oversample=10, n_power_iter=1, seed=0):
+    '''Principal components of CA contact matrices that never hold more than one chunk of frames.
+
+    chunk_source is a callable returning a fresh iterator of CSR contact matrices (for example
+    lambda: iter_sparse_ca_contacts(fnames)), since a randomized PCA needs a few passes:
+    one to sketch the range of the covariance, n_power_iter refinement passes, and one to project.
+    Centering is applied implicitly, so the sparse matrices are never densified.  The result
+    matches ca_contact_pca up to the sign of each component.'''
+    rng = np.random.RandomState(seed)
+    n_col = None
+    n_frame = 0
+    col_sum = None
+
+    def scatter_times(Q):
+        # (X-mu)^T (X-mu) Q, accumulated from uncentered sparse products
+        nonlocal n_frame, col_sum
+        acc = np.zeros_like(Q)
+        n_frame = 0
+        col_sum = np.zeros(Q.shape[0])
+        for X in chunk_source():
+            acc += X.T.dot(X.dot(Q))
+            col_sum += np.asarray(X.sum(axis=0)).ravel()
+            n_frame += X.shape[0]
+        mu = col_sum/n_frame
+        return acc - n_frame*np.outer(mu, mu.dot(Q))
+
+    for X in chunk_source():
+        n_col = X.shape[1]
+        break
+    k = min(n_pc+n_oversample, n_col)
+
+    Q = np.linalg.qr(scatter_times(rng.normal(size=(n_col,k))))[0]
+    for i in range(n_power_iter):
+        Q = np.linalg.qr(scatter_times(Q))[0]
+
+    # Rayleigh-Ritz on the small subspace gives the leading eigenvectors of the covariance
+    B = Q.T.dot(scatter_times(Q))
+    evals, evecs = np.linalg.eigh(0.5*(B+B.T))
+    order = np.argsort(evals)[::-1][:n_pc]
+    components = Q.dot(evecs[:,order])
+    explained_variance = evals[order]/n_frame
+
+    mu = col_sum/n_frame
+    total_variance = (mu*(1.-mu)).sum()  # contacts are binary, so E[x^2] = E[x]
+    explained_variance_ratio = explained_variance/total_variance
+
+    offset = mu.dot(components)
+    pc = np.concatenate([X.dot(components)-offset for X in chunk_source()], axis=0)
+    return pc / (explained_variance_ratio if variance_scaled else 1.)
+
+def minibatch_kmeans_cluster(pc, rmsd, n_clusters, batch_size=10000, seed=0):
+    '''Same as kmeans_cluster but with MiniBatchKMeans, which scales to millions of frames'''
+    import sklearn.cluster
+    assert len(pc.shape) == 2
+    assert len(pc) == len(rmsd)
+
+    km = sklearn.cluster.MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size,
+            random_state=seed, n_init=3).fit(pc)
+    counts = np.bincount(km.labels_, minlength=n_clusters)
+    assert np.all(counts>0)
+    label_rmsd = np.bincount(km.labels_, weights=rmsd, minlength=n_clusters) / counts
+    label_order = np.argsort(label_rmsd)
+    # permute the labels so that they are in order of average RMSD
+    return np.argsort(label_order)[km.labels_]
+
 def kmeans_cluster(pc, rmsd, n_clusters):
     import sklearn.cluster
     assert len(pc.shape) == 2
@@ -397,13 +599,58 @@ def pick_all_representative_points(coord, labels, sigma_fraction=0.1):
         ret.append(all_idx[pick_representative_point(coord[good])])
     return np.array(ret)
 
+def pick_representative_point_approx(coord, sigma_fraction=0.2, n_sample=2000, block=1000, seed=0):
+    '''Approximate version of pick_representative_point for large clusters.  The Gaussian density
+    is estimated from a random subsample of at most n_sample reference points and maximized over
+    another such subsample of candidates, so the cost is bounded by n_sample^2 per cluster.'''
+    assert len(coord.shape) == 2
+    rng = np.random.RandomState(seed)
+    sigma = np.sqrt(np.var(coord,axis=0).mean(axis=0))
+    bw = sigma_fraction*sigma
+
+    def subsample(n):
+        return np.arange(n) if n <= n_sample else np.sort(rng.choice(n, n_sample, replace=False))
+    ref  = coord[subsample(len(coord))]
+    cand = subsample(len(coord))
+
+    density = np.zeros(len(cand))
+    for s in range(0, len(cand), block):
+        x = coord[cand[s:s+block]]
+        d2 = ((x[:,None,:]-ref[None,:,:])**2).sum(axis=-1)
+        density[s:s+block] = np.exp(-0.5*d2/bw**2).sum(axis=1)
+    return cand[np.argmax(density)]
+
+def pick_all_representative_points_approx(coord, labels, sigma_fraction=0.1, n_sample=2000):
+    assert len(labels.shape) == 1
+    assert coord.shape == (labels.shape[0],coord.shape[1])
+    n_label = 1+np.max(labels)
+    order = np.argsort(labels, kind='stable')
+    bounds = np.searchsorted(labels[order], np.arange(n_label+1))
+    ret = []
+    for i in range(n_label):
+        all_idx = order[bounds[i]:bounds[i+1]]
+        ret.append(all_idx[pick_representative_point_approx(coord[all_idx], sigma_fraction, n_sample)])
+    return np.array(ret)
+
 def select(traj, sel_text):
     return traj.atom_slice(traj.topology.select(sel_text))
 
 def replex_demultiplex(list_of_replex_traj, replica_index):
+    '''Convert in-memory continuous-temperature trajectories (one per temperature) into
+    continuous-replica trajectories.  replica_index has shape (n_temperature,n_frame) and gives the
+    replica held by each temperature at each frame, as in /output/replica_index.'''
     n_frame = list_of_replex_traj[0].n_frames
     n_atom  = list_of_replex_traj[0].n_atoms
-
+    replica_index = np.asarray(replica_index)
+    assert replica_index.shape == (len(list_of_replex_traj), n_frame)
+
+    xyz = np.stack([tr.xyz for tr in list_of_replex_traj])
+    assert xyz.shape[1:] == (n_frame, n_atom, 3)
+    source = np.argsort(replica_index, axis=0)
+    idx = np.arange(n_frame)
+    return [md.Trajectory(xyz=xyz[source[r],idx], topology=list_of_replex_traj[0].topology,
+                          time=list_of_replex_traj[0].time)
+            for r in range(len(list_of_replex_traj))]
 
 
 
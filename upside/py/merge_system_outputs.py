@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+''' Combine the per-system output files of a multi-system run into one file.
+
+With --output-per-system (or a single --output path for several systems), upside writes the
+output of system N to STEM.sys{N}.up, which holds only the /output group.  This writes a file
+with the /input group of the configuration and an /output group in which every per-frame array
+with a system axis (pos, kinetic, potential, temperature, replica_index, ...) is one
+(n_frame, n_system, ...) array, as if all systems had written to one file.  /output/time is that
+of system 0.  The whole /output group of each system, including the arrays without a system axis,
+is reachable as /output/systems/sys{N}.
+
+By default the arrays are HDF5 virtual datasets that read from the system files, so the merge
+copies nothing and the system files must stay next to the merged file.  With --copy the frames
+are copied into the merged file instead.  The number of frames is the smallest of the systems,
+so a merge of a run that is still going is a consistent prefix of it. '''
+
+import os
+
+import numpy as np
+import h5py
+
+
+def system_output_paths(output, n_system):
+    '''Paths of the per-system output files that upside writes for --output output'''
+    stem = output
+    for ext in ('.up', '.h5'):
+        if stem.endswith(ext) and len(stem) > len(ext):
+            stem = stem[:-len(ext)]
+            break
+    return ['%s.sys%i.up' % (stem, ns) for ns in range(n_system)]
+
+
+def find_system_outputs(stem):
+    '''The existing STEM.sys{N}.up files, for N from 0 up to the first one that is missing'''
+    paths = []
+    while os.path.exists(system_output_paths(stem, len(paths)+1)[-1]):
+        paths.append(system_output_paths(stem, len(paths)+1)[-1])
+    return paths
+
+
+def _attr_str(x):
+    return x.decode('utf-8') if isinstance(x, bytes) else str(x)
+
+
+def recorded_config_path(recorded, system_path):
+    '''Path of the configuration recorded in the /output config attribute of the per-system output
+    file system_path.  The recorded path may be relative to the directory where upside ran, so a
+    missing one is looked up next to the output file instead.'''
+    config = _attr_str(recorded)
+    if not os.path.exists(config):
+        config = os.path.join(os.path.dirname(os.path.abspath(system_path)), os.path.basename(config))
+    return config
+
+
+def _stacked_names(outputs, n_frame):
+    '''Names of the datasets of /output that every system has with the same shape, dtype and a
+    singleton system axis'''
+    names = []
+    for nm, dset in outputs[0].items():
+        if not isinstance(dset, h5py.Dataset) or dset.ndim < 2 or dset.shape[1] != 1 or dset.shape[0] < n_frame:
+            continue
+        if all(nm in g and isinstance(g[nm], h5py.Dataset) and g[nm].shape[1:] == dset.shape[1:]
+                and g[nm].dtype == dset.dtype for g in outputs[1:]):
+            names.append(nm)
+    return names
+
+
+def merge_system_outputs(system_paths, merged_path, config=None, copy=False, chunk_size=1000):
+    '''Write merged_path from the per-system output files system_paths (in system order) and the
+    configuration config (by default the one recorded in the output of system 0).  Returns the
+    number of frames.'''
+    merged_dir = os.path.dirname(os.path.abspath(merged_path))
+    files = [h5py.File(p, 'r') for p in system_paths]
+    try:
+        outputs = [f['output'] for f in files]
+        systems = [int(g.attrs['system']) if 'system' in g.attrs else ns for ns, g in enumerate(outputs)]
+        if systems != list(range(len(files))):
+            raise ValueError('the output files are of systems %s, but should be of systems 0 to %i in order'
+                    % (systems, len(files)-1))
+
+        if config is None:
+            if 'config' not in outputs[0].attrs:
+                raise ValueError('%s does not record its configuration; pass it explicitly' % system_paths[0])
+            config = recorded_config_path(outputs[0].attrs['config'], system_paths[0])
+        n_frame = min(g['time'].shape[0] for g in outputs)
+        names = _stacked_names(outputs, n_frame)
+        # sources are found relative to the merged file
+        rel_paths = [os.path.relpath(os.path.abspath(p), merged_dir) for p in system_paths]
+
+        with h5py.File(config, 'r') as cfg, h5py.File(merged_path, 'w') as out:
+            cfg.copy(cfg['input'], out, 'input')
+            g = out.create_group('output')
+            for k, v in outputs[0].attrs.items():
+                if k not in ('system', 'config'):
+                    g.attrs[k] = v
+            g.attrs['n_system'] = len(files)
+            g.attrs['system_outputs'] = np.array([p.encode('utf-8') for p in rel_paths])
+
+            for nm in names + ['time']:
+                src = outputs[0][nm]
+                stacked = nm != 'time'
+                shape = (n_frame, len(files)) + src.shape[2:] if stacked else (n_frame,) + src.shape[1:]
+                if copy:
+                    dset = g.create_dataset(nm, shape=shape, dtype=src.dtype, compression='gzip',
+                            compression_opts=1, shuffle=True, fletcher32=True,
+                            chunks=(min(100, max(n_frame,1)),) + shape[1:])
+                    for s in range(0, n_frame, chunk_size):
+                        e = min(s+chunk_size, n_frame)
+                        if stacked:
+                            dset[s:e] = np.concatenate([o[nm][s:e] for o in outputs], axis=1)
+                        else:
+                            dset[s:e] = src[s:e]
+                else:
+                    layout = h5py.VirtualLayout(shape=shape, dtype=src.dtype)
+                    if stacked:
+                        for ns, (o, path) in enumerate(zip(outputs, rel_paths)):
+                            layout[:, ns] = h5py.VirtualSource(path, '/output/'+nm, shape=o[nm].shape)[:n_frame, 0]
+                    else:
+                        layout[:] = h5py.VirtualSource(rel_paths[0], '/output/'+nm, shape=src.shape)[:n_frame]
+                    dset = g.create_virtual_dataset(nm, layout)
+                for k, v in src.attrs.items():
+                    dset.attrs[k] = v
+
+            systems_group = g.create_group('systems')
+            for ns, path in enumerate(rel_paths):
+                systems_group['sys%i' % ns] = h5py.ExternalLink(path, '/output')
+    finally:
+        for f in files:
+            f.close()
+    return n_frame
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Combine the per-system output files (STEM.sys{N}.up) of an ' +
+            'Upside run into one file with (n_frame, n_system, ...) output arrays')
+    parser.add_argument('merged', help='merged file to write')
+    parser.add_argument('system_outputs', nargs='*',
+            help='per-system output files in system order (default: the STEM.sys{N}.up files for --stem)')
+    parser.add_argument('--stem', default=None,
+            help='the --output path of the run; the system files are STEM.sys0.up, STEM.sys1.up, ...')
+    parser.add_argument('--config', default=None,
+            help='configuration whose /input is copied (default: the one recorded in the output of system 0)')
+    parser.add_argument('--copy', action='store_true',
+            help='copy the frames instead of writing virtual datasets that read from the system files')
+    args = parser.parse_intermixed_args()  # options may come between the file names
+
+    paths = args.system_outputs
+    if args.stem is not None:
+        if paths:
+            parser.error('give either the system output files or --stem, not both')
+        paths = find_system_outputs(args.stem)
+        if not paths:
+            parser.error('no output file %s' % system_output_paths(args.stem, 1)[0])
+    if not paths:
+        parser.error('no system output files')
+
+    try:
+        n_frame = merge_system_outputs(paths, args.merged, args.config, args.copy)
+    except ValueError as e:
+        parser.error(str(e))
+    print('merged %i frames of %i systems into %s' % (n_frame, len(paths), args.merged))
+
+if __name__ == '__main__':
+    main()
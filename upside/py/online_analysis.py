@@ -0,0 +1,291 @@
+''' Streaming analysis accumulators for Upside trajectories.
+
+Each accumulator sees the trajectory once, as a sequence of frame chunks, and keeps only
+running sums (or per-frame scalars), so the analysis cost is one pass over the output with
+memory independent of the trajectory length.  A StreamingAnalysis feeds every registered
+accumulator from the same chunks and writes their .npy arrays and a JSON summary. '''
+
+import json
+import numpy as np
+import tables as tb
+
+import estimate_rama_distributions as erd
+import merge_system_outputs as msys
+from quantized_output import output_array
+from mdtraj_upside import output_groups
+
+analysis_types = dict()
+
+def register_accumulator(name):
+    def register(cls):
+        cls.name = name
+        analysis_types[name] = cls
+        return cls
+    return register
+
+
+def kabsch_rmsd(pos, ref):
+    '''RMSD of each frame of pos (n_frame,n_atom,3) to ref (n_atom,3) after optimal superposition'''
+    pos = pos - pos.mean(axis=1, keepdims=True)
+    ref = ref - ref.mean(axis=0)
+    cov = np.einsum('fai,aj->fij', pos, ref)
+    u,s,vt = np.linalg.svd(cov)
+    sign = np.sign(np.linalg.det(u) * np.linalg.det(vt))
+    s[:,-1] *= sign
+    msd = ((pos**2).sum(axis=(1,2)) + (ref**2).sum() - 2.*s.sum(axis=1)) / ref.shape[0]
+    return np.sqrt(np.maximum(msd, 0.))
+
+
+class Accumulator(object):
+    '''Base class for streaming analyses.  start is called once with the run metadata,
+    add once per chunk of frames, and finish once at the end; finish writes any arrays
+    using output_base and returns a dict of JSON-serializable summary values.'''
+    name = None
+
+    def start(self, info):
+        pass
+
+    def add(self, chunk):
+        raise NotImplementedError
+
+    def finish(self, output_base):
+        return dict()
+
+
+class _SeriesAccumulator(Accumulator):
+    '''Accumulator holding one scalar per frame'''
+    def start(self, info):
+        self.series = []
+
+    def finish_series(self, output_base, suffix):
+        series = np.concatenate(self.series) if self.series else np.zeros(0)
+        np.save('{}_{}.npy'.format(output_base, suffix), series)
+        return series
+
+
+@register_accumulator('energy')
+class EnergyAccumulator(_SeriesAccumulator):
+    def start(self, info):
+        _SeriesAccumulator.start(self, info)
+        self.temperature = []
+
+    def add(self, chunk):
+        self.series.append(chunk['potential'])
+        if 'temperature' in chunk:
+            self.temperature.append(chunk['temperature'])
+
+    def finish(self, output_base):
+        pot = self.finish_series(output_base, 'Energy')
+        summary = dict()
+        if len(pot):
+            summary['final_potential'] = float(pot[-1])
+            summary['mean_potential']  = float(pot.mean())
+        if self.temperature:
+            T = np.concatenate(self.temperature)
+            np.save('{}_T.npy'.format(output_base), T[0])
+            summary['temperature'] = float(T[0])
+        return summary
+
+
+@register_accumulator('rmsd')
+class RmsdAccumulator(_SeriesAccumulator):
+    '''CA RMSD in angstroms to the input structure of the run'''
+    def start(self, info):
+        _SeriesAccumulator.start(self, info)
+        self.ref = info['reference_pos'][1::3]
+
+    def add(self, chunk):
+        self.series.append(kabsch_rmsd(chunk['pos'][:,1::3], self.ref))
+
+    def finish(self, output_base):
+        rmsd = self.finish_series(output_base, 'Rmsd')
+        if not len(rmsd): return dict()
+        return dict(final_rmsd=float(rmsd[-1]), mean_rmsd=float(rmsd.mean()))
+
+
+@register_accumulator('rg')
+class RgAccumulator(_SeriesAccumulator):
+    '''Radius of gyration in angstroms over the backbone atoms'''
+    def add(self, chunk):
+        pos = chunk['pos']
+        com = pos.mean(axis=1, keepdims=True)
+        self.series.append(np.sqrt(((pos-com)**2).sum(axis=-1).mean(axis=-1)))
+
+    def finish(self, output_base):
+        rg = self.finish_series(output_base, 'Rg')
+        if not len(rg): return dict()
+        return dict(final_rg=float(rg[-1]), mean_rg=float(rg.mean()))
+
+
+@register_accumulator('hbond')
+class HbondAccumulator(_SeriesAccumulator):
+    '''Total hbond score per frame and mean hbond occupancy per residue.  Requires /output/hbond,
+    which is logged at the default (detailed) log level.'''
+    def start(self, info):
+        _SeriesAccumulator.start(self, info)
+        self.n_res = info['n_res']
+        self.donor_residue = info.get('donor_residue')
+        self.acceptor_residue = info.get('acceptor_residue')
+        self.n_donor = None if self.donor_residue is None else len(self.donor_residue)
+        self.occupancy = np.zeros(self.n_res)
+        self.donor_count = []
+        self.n_frame = 0
+
+    def add(self, chunk):
+        if 'hbond' not in chunk: return
+        hb = chunk['hbond']
+        self.series.append(hb.sum(axis=1))
+        self.n_frame += len(hb)
+        if self.donor_residue is not None:
+            self.donor_count.append(hb[:,:self.n_donor].sum(axis=1))
+            total = hb.sum(axis=0)
+            np.add.at(self.occupancy, self.donor_residue,    total[:self.n_donor])
+            np.add.at(self.occupancy, self.acceptor_residue, total[self.n_donor:])
+
+    def finish(self, output_base):
+        if not self.series: return dict()
+        self.finish_series(output_base, 'Hbond')
+        summary = dict()
+        if self.donor_count:
+            occupancy = self.occupancy / max(self.n_frame,1)
+            np.save('{}_HbondOccupancy.npy'.format(output_base), occupancy)
+            donor_count = np.concatenate(self.donor_count)
+            summary['final_hbonds'] = float(donor_count[-1])
+            summary['mean_hbonds']  = float(donor_count.mean())
+        return summary
+
+
+@register_accumulator('contacts')
+class ContactAccumulator(Accumulator):
+    '''Frequency of CA-CA contacts closer than cutoff angstroms'''
+    max_block_elements = 2**23  # bounds the (frames,n_res,n_res) temporaries of one block
+
+    def __init__(self, cutoff=8.):
+        self.cutoff = cutoff
+
+    def start(self, info):
+        self.counts = np.zeros((info['n_res'],info['n_res']))
+        self.n_frame = 0
+
+    def add(self, chunk):
+        ca = chunk['pos'][:,1::3]
+        n_res = ca.shape[1]
+        block = max(1, self.max_block_elements//max(n_res*n_res,1))
+        for s in range(0, len(ca), block):
+            x = ca[s:s+block]
+            sq = (x**2).sum(axis=-1)
+            d2 = sq[:,:,None] + sq[:,None,:] - 2.*np.matmul(x, x.transpose((0,2,1)))
+            self.counts += (d2 < self.cutoff**2).sum(axis=0)
+        self.n_frame += len(ca)
+
+    def finish(self, output_base):
+        freq = self.counts / max(self.n_frame,1)
+        np.save('{}_ContactFrequency.npy'.format(output_base), freq)
+        return dict()
+
+
+@register_accumulator('rama')
+class RamaAccumulator(Accumulator):
+    '''Periodic (phi,psi) histograms per residue, saved on the 5 degree grid of
+    estimate_rama_distributions (indexed [residue,phi,psi])'''
+    def start(self, info):
+        self.hist = erd.RamaHistogram(info['n_res'])
+
+    def add(self, chunk):
+        self.hist.add(erd.rama_from_pos(chunk['pos']))
+
+    def finish(self, output_base):
+        np.save('{}_RamaHistogram.npy'.format(output_base), self.hist.counts)
+        return dict()
+
+
+class StreamingAnalysis(object):
+    '''Feed a set of accumulators from the frames of an Upside output file.  Frames are read
+    from /output (and any /output_previous_* groups from restarts) in chunks, and each new frame
+    is seen exactly once, so feed may be called again on a file that has grown since.
+
+    A per-system output file (STEM.sys{N}.up) has no /input group and holds only its own system,
+    so the topology is read from the configuration recorded in its /output and system is ignored.'''
+
+    def __init__(self, accumulators, system=0, chunk_size=1000):
+        self.accumulators = list(accumulators)
+        self.system = system
+        self.chunk_size = chunk_size
+        self.info = None
+        self.n_seen = 0
+
+    @staticmethod
+    def read_info(t):
+        info = dict()
+        info['reference_pos'] = t.root.input.pos[:,:,0].astype('f8')
+        info['n_res'] = int(info['reference_pos'].shape[0]//3)
+        if 'infer_H_O' in t.root.input.potential:
+            infer = t.root.input.potential.infer_H_O
+            info['donor_residue']    = infer.donors.residue[:]
+            info['acceptor_residue'] = infer.acceptors.residue[:]
+        return info
+
+    def feed(self, h5_path):
+        with tb.open_file(h5_path) as t:
+            per_system = 'input' not in t.root
+            if self.info is None:
+                if per_system:
+                    config = msys.recorded_config_path(t.root.output._v_attrs.config, h5_path)
+                    with tb.open_file(config) as c:
+                        self.info = self.read_info(c)
+                else:
+                    self.info = self.read_info(t)
+                for acc in self.accumulators:
+                    acc.start(self.info)
+            system = 0 if per_system else self.system
+
+            offset = 0
+            for g_no, g in enumerate(output_groups(t)):
+                first = 1 if g_no else 0  # first frame of each restart repeats the last frame before it
+                pos = output_array(g, 'pos')
+                n_frame = pos.shape[0]
+                start = max(first, self.n_seen-offset+first)
+                for s in range(start, n_frame, self.chunk_size):
+                    e = min(s+self.chunk_size, n_frame)
+                    chunk = dict(pos=pos[s:e,system].astype('f8'),
+                                 potential=g.potential[s:e,system])
+                    if 'temperature' in g: chunk['temperature'] = g.temperature[s:e,system]
+                    if 'hbond' in g:       chunk['hbond']       = g.hbond[s:e]
+                    for acc in self.accumulators:
+                        acc.add(chunk)
+                offset += n_frame-first
+            self.n_seen = max(self.n_seen, offset)
+
+    def finish(self, output_base):
+        summary = dict(frame_count=int(self.n_seen))
+        if self.info is not None:
+            summary['residue_count'] = int(self.info['n_res'])
+            for acc in self.accumulators:
+                summary.update(acc.finish(output_base))
+        with open('{}.analysis.json'.format(output_base), 'w') as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+
+def analyze(h5_path, output_base, names=('energy','rmsd','rg','hbond','contacts','rama'), system=0, chunk_size=1000):
+    analysis = StreamingAnalysis([analysis_types[nm]() for nm in names], system=system, chunk_size=chunk_size)
+    analysis.feed(h5_path)
+    return analysis.finish(output_base)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Streaming analysis of an Upside trajectory')
+    parser.add_argument('input_h5', help='Input simulation file')
+    parser.add_argument('output_base', help='Output name')
+    parser.add_argument('--analysis', default=[], action='append', choices=sorted(analysis_types),
+            help='analysis to run (may be repeated; default all)')
+    parser.add_argument('--system', type=int, default=0, help='(default 0) system to analyze')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='(default 1000) frames per chunk')
+    args = parser.parse_args()
+
+    names = args.analysis or ('energy','rmsd','rg','hbond','contacts','rama')
+    print(json.dumps(analyze(args.input_h5, args.output_base, names, args.system, args.chunk_size), indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+''' Read /output arrays that upside stores quantized, such as /output/pos with --pos-quantum.
+
+A quantized array NAME is an int16 dataset q with the attribute encoding "int16_offset_scale",
+stored along with NAME_offset (n_frame,n_system,3) and NAME_scale (n_frame,n_system), so that
+
+    value = NAME_offset[:,:,None,:] + NAME_scale[:,:,None,None]*q
+
+Values that were not finite are stored as -32768 and read as NaN.  output_array returns an object
+that is indexed like the float32 dataset it replaces, so readers that use output_array(g, 'pos')
+instead of g.pos read either kind of file. '''
+
+import numpy as np
+
+encoding = 'int16_offset_scale'
+missing = -32768
+
+
+def is_quantized(node):
+    return 'encoding' in node._v_attrs._v_attrnamesuser and _as_str(node._v_attrs.encoding) == encoding
+
+
+def _as_str(x):
+    return x.decode('utf-8') if isinstance(x, bytes) else str(x)
+
+
+def decode(q, offset, scale):
+    '''Float32 values of the int16 array q (...,n_elem,3) with offset (...,3) and scale (...)'''
+    value = np.asarray(offset, dtype='f4')[...,None,:] + np.asarray(scale, dtype='f4')[...,None,None]*q
+    value[q == missing] = np.nan
+    return value.astype('f4', copy=False)
+
+
+class QuantizedArray(object):
+    '''Read-only view of a quantized array that decodes the frames it is indexed with.  The first
+    two indices select frames and systems; any further indices apply to the decoded values.'''
+    def __init__(self, group, name):
+        self.values = group._f_get_child(name)
+        self.offset = group._f_get_child(name+'_offset')
+        self.scale  = group._f_get_child(name+'_scale')
+        self.quantum = float(self.values._v_attrs.quantum)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def dtype(self):
+        return np.dtype('f4')
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        head, rest = key[:2], key[2:]
+        value = decode(self.values[head], self.offset[head], self.scale[head])
+        if not rest:
+            return value
+        # integer indices of the frame and system axes drop those axes from value
+        n_kept = sum(1 for k in head if not isinstance(k, (int, np.integer)))
+        return value[(slice(None),)*n_kept + rest]
+
+    def read(self):
+        return self[:]
+
+
+def output_array(group, name):
+    '''The child name of an output group, decoded if it is quantized'''
+    node = group._f_get_child(name)
+    return QuantizedArray(group, name) if is_quantized(node) else node
+
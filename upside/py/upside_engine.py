@@ -51,6 +51,15 @@ calc.get_output.argtypes = [ct.c_int, ct.c_void_p, ct.c_void_p, ct.c_char_p]
 calc.get_value_by_name.restype  = ct.c_int
 calc.get_value_by_name.argtypes = [ct.c_int, ct.c_void_p, ct.c_void_p, ct.c_char_p, ct.c_char_p]
 
+calc.set_profile.restype  = ct.c_int
+calc.set_profile.argtypes = [ct.c_void_p, ct.c_bool]
+
+calc.get_profile_size.restype  = ct.c_int
+calc.get_profile_size.argtypes = [ct.c_void_p, ct.c_void_p, ct.c_void_p, ct.c_bool]
+
+calc.get_profile.restype  = ct.c_int
+calc.get_profile.argtypes = [ct.c_int, ct.c_int, ct.c_void_p, ct.c_void_p, ct.c_void_p, ct.c_void_p, ct.c_bool]
+
 calc.get_clamped_value_and_deriv.restype  = ct.c_int
 calc.get_clamped_value_and_deriv.argtypes = [ct.c_int, ct.c_void_p, ct.c_void_p, ct.c_int, ct.c_void_p]
 
@@ -236,6 +245,33 @@ class Upside(object):
         if retcode: raise RuntimeError('Unable to get output')
         return output
 
+    def evaluate_outputs(self, pos_frames, node_names):
+        '''Evaluate the energy of each frame of pos_frames (n_frame,n_atom,3) and collect the
+        outputs of node_names.  Returns the energies (n_frame,) and a dict from node name to
+        an array of shape (n_frame,n_elem,elem_width).'''
+        pos_frames = np.require(pos_frames, dtype='f4', requirements='C')
+        assert pos_frames.shape[1:] == (self.n_atom,3)
+        n_frame = pos_frames.shape[0]
+
+        energies = np.zeros(n_frame, dtype='f4')
+        outputs = dict()
+        for nm in node_names:
+            c_nm = bytes(nm, encoding="ascii")
+            n_elem = np.zeros(1,dtype=np.intc)
+            elem_width = np.zeros(1,dtype=np.intc)
+            retcode = calc.get_output_dims(n_elem.ctypes.data, elem_width.ctypes.data, self.engine, c_nm)
+            if retcode: raise RuntimeError('Unable to get output dims')
+            outputs[nm] = (c_nm, np.zeros((n_frame, int(n_elem[0]), int(elem_width[0])), dtype='f4'))
+
+        for i in range(n_frame):
+            retcode = calc.evaluate_energy(energies[i:].ctypes.data, self.engine, pos_frames[i].ctypes.data)
+            if retcode: raise RuntimeError('Unable to evaluate energy')
+            for c_nm, output in outputs.values():
+                retcode = calc.get_output(int(output[i].size), output[i].ctypes.data, self.engine, c_nm)
+                if retcode: raise RuntimeError('Unable to get output')
+
+        return energies, dict((nm,output) for nm,(c_nm,output) in outputs.items())
+
     def get_value_by_name(self, value_shape, node_name, log_name):
         node_name = bytes(node_name, encoding="ascii")
         log_name = bytes(log_name, encoding="ascii")
@@ -245,9 +281,60 @@ class Upside(object):
         if retcode: raise RuntimeError('Unable to get value by name')
         return value
 
+    def enable_profile(self, enabled=True):
+        '''Start (or stop) recording the time spent in each node.  Starting clears the previous records.'''
+        retcode = calc.set_profile(self.engine, bool(enabled))
+        if retcode: raise RuntimeError('Unable to set profile')
+
+    def profile(self, timers=False):
+        '''Time spent in each node since enable_profile, as a dict from NAME (compute_value) and
+        NAME_deriv (propagate_deriv) to dict(n_invoke, seconds), in order of decreasing time.  With
+        timers=True, the finer timers within the nodes are returned instead.  Those are shared by all
+        engines of the process.'''
+        n_entry   = np.zeros(1,dtype=np.intc)
+        name_size = np.zeros(1,dtype=np.intc)
+        retcode = calc.get_profile_size(n_entry.ctypes.data, name_size.ctypes.data, self.engine, bool(timers))
+        if retcode: raise RuntimeError('Unable to get profile size')
+        n_entry, name_size = int(n_entry[0]), int(name_size[0])
+
+        names    = np.zeros(n_entry, dtype='S%i'%name_size)
+        n_invoke = np.zeros(n_entry, dtype=np.dtype(ct.c_long))
+        seconds  = np.zeros(n_entry, dtype='f8')
+        retcode = calc.get_profile(n_entry, name_size, names.ctypes.data, n_invoke.ctypes.data,
+                seconds.ctypes.data, self.engine, bool(timers))
+        if retcode: raise RuntimeError('Unable to get profile')
+        return _profile_dict(names, n_invoke, seconds)
+
     def __del__(self):
         calc.free_deriv_engine(self.engine)
 
+
+def _profile_dict(names, n_invoke, seconds):
+    return dict((nm.decode('ascii'), dict(n_invoke=int(n), seconds=float(s)))
+            for nm,n,s in zip(names, n_invoke, seconds))
+
+
+def read_profile(t, timers=False):
+    '''Profile written to /output/profile by upside --profile, from the open tables.File or path t,
+    in the format of Upside.profile.  Returns None if the output has no profile.'''
+    if isinstance(t, str):
+        with tb.open_file(t) as f:
+            return read_profile(f, timers)
+    if '/output/profile' not in t:
+        return None
+    g = t.get_node('/output/profile/timers' if timers else '/output/profile')
+    if 'name' not in g:
+        return dict()
+    return _profile_dict(g.name[:], g.n_invoke[:], g.seconds[:])
+
+
+def top_profile_entries(profile, n_top=10):
+    '''The n_top most expensive entries of a profile as a list of dict(name, n_invoke, seconds,
+    fraction), where fraction is of the total time of all entries'''
+    total = sum(v['seconds'] for v in profile.values())
+    entries = sorted(profile.items(), key=lambda kv: -kv[1]['seconds'])[:n_top]
+    return [dict(name=nm, fraction=v['seconds']/total if total>0. else 0., **v) for nm,v in entries]
+
 def get_rotamer_graph(engine):
     n_node, n_edge = engine.get_value_by_name((2,),         'rotamer', 'graph_nodes_edges_sizes').astype('i')
     node_prob      = engine.get_value_by_name((n_node,3),   'rotamer', 'graph_node_prob')
@@ -256,8 +343,10 @@ def get_rotamer_graph(engine):
     return node_prob, edge_prob, edge_indices
 
 def freeze_nodes(new_h5_path, old_h5_path, nodes_to_freeze, additional_nodes_to_delete, quiet=False):
-    '''Replace computation nodes with constant nodes that give the same answer on the initial structure'''
-    shutil.copyfile(old_h5_path, new_h5_path)
+    '''Replace computation nodes with constant nodes that give the same answer on the initial structure.
+    new_h5_path may be the same as old_h5_path to modify the file in place.'''
+    if os.path.abspath(new_h5_path) != os.path.abspath(old_h5_path):
+        shutil.copyfile(old_h5_path, new_h5_path)
 
     engine = Upside(old_h5_path)
     pos = engine.initial_pos
@@ -265,6 +354,7 @@ def freeze_nodes(new_h5_path, old_h5_path, nodes_to_freeze, additional_nodes_to_
     en = engine.energy(pos)  # required to fill output
     if not quiet: print ('energy', en)
     freeze = dict((nm,engine.get_output(nm)) for nm in nodes_to_freeze)
+    del engine
 
     with tb.open_file(new_h5_path, 'a') as tn:
         for nm in list(nodes_to_freeze) + list(additional_nodes_to_delete):
@@ -272,13 +362,112 @@ def freeze_nodes(new_h5_path, old_h5_path, nodes_to_freeze, additional_nodes_to_
 
         for nm,value in freeze.items():
             g = tn.create_group(tn.root.input.potential, 'constant_'+nm)
-            g._v_attrs.arguments = []
+            g._v_attrs.arguments = np.array([b'pos'])  # unused, but every node needs an argument list
             tn.create_array(g, 'value', obj=value)
 
         for node in tn.root.input.potential:
             node._v_attrs.arguments = np.array(
-                    [('constant_'+nm if nm in freeze else nm) 
-                        for nm in node._v_attrs.arguments])
+                    [(b'constant_'+nm if nm.decode('ascii') in freeze else nm)
+                        for nm in np.char.encode(node._v_attrs.arguments.astype('U'), 'ascii')])
 
     new_en = Upside(new_h5_path).energy(pos)
     if not quiet: print ('new_energy', new_en)
+    return en, new_en
+
+
+# Nodes whose output is fixed by their parameters or by the initial structure.  They take pos as an
+# argument only to size or initialize their output, so that argument does not make them dynamic.
+constant_node_prefixes = ('Const1D', 'Const2D', 'Const3D', 'constant')
+
+def _node_arguments(h5_path):
+    with tb.open_file(h5_path) as t:
+        return dict((g._v_name, [x.decode('ascii') if isinstance(x,bytes) else str(x)
+                                 for x in g._v_attrs.arguments])
+                for g in t.root.input.potential._f_iter_nodes('Group'))
+
+def find_constant_nodes(h5_path):
+    '''Find the nodes whose outputs cannot change during a simulation.  Constness is seeded from
+    the inputs that are really fixed, the constant nodes (whatever their arguments) and nodes without
+    arguments, and a node is constant when every argument is (recursively) constant.  Returns
+    (nodes_to_freeze, nodes_to_delete) for freeze_nodes: the roots of the constant subtrees that
+    feed nodes with dynamic inputs, and the other nodes of those subtrees.  Seeds themselves are
+    never frozen since they are already cheap, and nodes nothing reads, such as potentials, are
+    never frozen so that the energy is unchanged.'''
+    arguments = _node_arguments(h5_path)
+    used = set(nm for args in arguments.values() for nm in args)
+
+    seeds = set(nm for nm,args in arguments.items() if nm.startswith(constant_node_prefixes) or not args)
+    constant = set(seeds)
+    n_constant = -1
+    while n_constant != len(constant):
+        n_constant = len(constant)
+        constant.update(nm for nm,args in arguments.items()
+                if nm in used and args and all(x in constant for x in args))
+
+    # a constant node feeds a mixed node when a node with some dynamic input reads it
+    read_by_dynamic = set(x for nm,args in arguments.items() if nm not in constant for x in args if x in constant)
+    nodes_to_freeze = sorted(read_by_dynamic.difference(seeds))
+
+    # everything the frozen roots read, and seeds read by nothing else, is no longer needed
+    still_read = set(x for nm,args in arguments.items() if nm not in constant for x in args)
+    subtree = set()
+    stack = list(nodes_to_freeze)
+    while stack:
+        for x in arguments.get(stack.pop(), []):
+            if x in constant and x not in subtree:
+                subtree.add(x)
+                stack.append(x)
+    nodes_to_delete = sorted(subtree.difference(still_read).difference(nodes_to_freeze))
+    return nodes_to_freeze, nodes_to_delete
+
+
+def node_seconds_per_step(h5_path, n_step=30):
+    '''Time for the force evaluations of one integration step (three derivative evaluations) spent
+    in each node of the configuration at its initial structure, as a dict from node name to
+    seconds, summed over compute_value and propagate_deriv from Upside.profile'''
+    engine = Upside(h5_path, quiet=True)
+    pos = np.require(engine.initial_pos, dtype='f4', requirements='C')
+    engine.deriv(pos)  # build pairlists and caches before timing
+    engine.enable_profile()
+    for j in range(3*n_step):
+        engine.deriv(pos)
+    profile = engine.profile()
+    engine.enable_profile(False)
+
+    seconds = dict()
+    for nm,v in profile.items():
+        node = nm[:-len('_deriv')] if nm.endswith('_deriv') else nm
+        seconds[node] = seconds.get(node, 0.) + v['seconds']/n_step
+    return seconds
+
+
+def freeze_constant_nodes(new_h5_path, old_h5_path, n_step=30):
+    '''Freeze the nodes found by find_constant_nodes.  Returns a dict with the frozen and deleted
+    node names, the energies of the initial structure before and after, and the seconds per
+    integration step that each frozen or deleted node took in the profile of the old configuration.
+    When nothing can be frozen, the configuration is copied and nothing is timed.'''
+    nodes_to_freeze, nodes_to_delete = find_constant_nodes(old_h5_path)
+    report = dict(frozen=nodes_to_freeze, deleted=nodes_to_delete, seconds_saved=dict())
+    if not nodes_to_freeze and not nodes_to_delete:
+        if os.path.abspath(new_h5_path) != os.path.abspath(old_h5_path):
+            shutil.copyfile(old_h5_path, new_h5_path)
+        return report
+
+    seconds = node_seconds_per_step(old_h5_path, n_step)
+    report['seconds_saved'] = dict((nm, seconds.get(nm, 0.)) for nm in nodes_to_freeze+nodes_to_delete)
+    report['energy_before'], report['energy_after'] = freeze_nodes(new_h5_path, old_h5_path,
+            nodes_to_freeze, nodes_to_delete, quiet=True)
+    return report
+
+
+def format_freeze_report(report):
+    '''Human-readable summary of a freeze_constant_nodes report'''
+    if not report['frozen'] and not report['deleted']:
+        return 'freeze: no nodes with constant inputs'
+    saved = report['seconds_saved']
+    lines = []
+    for nm in report['frozen']:  lines.append('freeze: froze   %-40s %8.1f us per step' % (nm, 1e6*saved[nm]))
+    for nm in report['deleted']: lines.append('freeze: removed %-40s %8.1f us per step' % (nm, 1e6*saved[nm]))
+    lines.append('freeze: initial energy %.4f -> %.4f' % (report['energy_before'], report['energy_after']))
+    lines.append('freeze: %.1f us per step saved' % (1e6*sum(saved.values())))
+    return '\n'.join(lines)
\ No newline at end of file
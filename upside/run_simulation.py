@@ -3,26 +3,36 @@
 AWS Batch simulation runner for Upside.
 Downloads PDB from S3, runs simulation, uploads results back to S3.
 
-S3 Input: s3://{input_bucket}/{job_id}.pdb
+S3 Input: s3://{input_bucket}/{job_id}.pdb (or .cif, .pdb.gz, .cif.gz)
 S3 Output: s3://{output_bucket}/{job_id}-results/
   - {job_id}.run.up   (trajectory HDF5)
   - {job_id}.run.log  (simulation log)
   - {job_id}.vtf      (VMD visualization format)
+  - {job_id}.analysis.json and {job_id}_*.npy (trajectory analysis summaries)
+  - {job_id}.profile.json (the most expensive nodes of the engine, from /output/profile)
 """
 
 import argparse
+import json
 import os
 import shutil
 import subprocess as sp
 import sys
-from pathlib import Path
 
 import boto3
 import tables
+from botocore.exceptions import ClientError
 
 upside_path = os.environ.get("UPSIDE_HOME", "/upside")
 sys.path.insert(0, os.path.join(upside_path, "py"))
+import online_analysis as oa
 import run_upside as ru
+from quantized_output import output_array
+from PDB_to_initial_structure import structure_basename
+
+ANALYSES = ["energy", "rmsd", "rg", "hbond", "contacts", "rama"]
+PROFILE_TOP = 10
+INPUT_EXTENSIONS = [".pdb", ".cif", ".pdb.gz", ".cif.gz"]
 
 
 def download_from_s3(bucket: str, key: str, local_path: str):
@@ -32,6 +42,19 @@ def download_from_s3(bucket: str, key: str, local_path: str):
     print(f"Downloaded s3://{bucket}/{key} to {local_path}")
 
 
+def find_input_key(bucket: str, job_id: str) -> str:
+    """Find the uploaded structure of a job, which keeps the extension it was uploaded with."""
+    s3 = boto3.client("s3")
+    for ext in INPUT_EXTENSIONS:
+        key = f"{job_id}{ext}"
+        try:
+            s3.head_object(Bucket=bucket, Key=key)
+            return key
+        except ClientError:
+            continue
+    raise FileNotFoundError(f"No input structure for job {job_id} in s3://{bucket}/")
+
+
 def upload_to_s3(local_path: str, bucket: str, key: str):
     """Upload a file to S3."""
     s3 = boto3.client("s3")
@@ -61,7 +84,7 @@ def generate_vtf(h5_file: str, output_vtf: str):
                             f.write(f"bond {i}:{i + 1}\n")
 
                         if hasattr(t.root, "output") and hasattr(t.root.output, "pos"):
-                            pos = t.root.output.pos[:]
+                            pos = output_array(t.root.output, "pos")[:, 0]
                             for frame in pos:
                                 f.write("\ntimestep\n")
                                 for coord in frame:
@@ -76,6 +99,53 @@ def generate_vtf(h5_file: str, output_vtf: str):
         return False
 
 
+def run_analysis(h5_file: str, output_base: str, analyses=ANALYSES):
+    """Feed the trajectory through the registered analysis accumulators in a single pass.
+
+    Returns:
+        List of written analysis files (JSON summary first), empty on failure
+    """
+    try:
+        analysis = oa.StreamingAnalysis(
+            [oa.analysis_types[name]() for name in analyses]
+        )
+        analysis.feed(h5_file)
+        summary = analysis.finish(output_base)
+        print(f"Analysis summary: {summary}")
+    except Exception as e:
+        print(f"Warning: Trajectory analysis failed: {e}")
+        return []
+
+    output_dir = os.path.dirname(output_base) or "."
+    prefix = os.path.basename(output_base) + "_"
+    arrays = sorted(
+        os.path.join(output_dir, fn)
+        for fn in os.listdir(output_dir)
+        if fn.startswith(prefix) and fn.endswith(".npy")
+    )
+    return [f"{output_base}.analysis.json"] + arrays
+
+
+def write_profile_summary(h5_file: str, output_json: str, n_top: int = PROFILE_TOP):
+    """Write the n_top most expensive entries of the run's /output/profile to a JSON list.
+
+    Returns:
+        The path of the JSON file, or None if the run has no profile
+    """
+    try:
+        import upside_engine as ue
+
+        profile = ue.read_profile(h5_file)
+        if profile is None:
+            return None
+        with open(output_json, "w") as f:
+            json.dump(ue.top_profile_entries(profile, n_top), f, indent=1)
+        return output_json
+    except Exception as e:
+        print(f"Warning: Failed to read the engine profile: {e}")
+        return None
+
+
 def run_simulation(
     pdb_file: str,
     output_dir: str,
@@ -85,11 +155,15 @@ def run_simulation(
     frame_interval: int = 100,
     seed: int = 42,
     force_field: str = "ff_2.1",
+    profile: bool = True,
+    integrator: str = "verlet",
+    inner_step: int = 3,
+    integrator_levels: str = "",
 ):
     """Run an upside simulation.
 
     Args:
-        pdb_file: Path to input PDB file
+        pdb_file: Path to input PDB or mmCIF file, optionally gzip-compressed
         output_dir: Working directory for simulation
         job_id: Job UUID for naming output files
         duration: Simulation duration
@@ -97,17 +171,23 @@ def run_simulation(
         frame_interval: Frame output frequency
         seed: Random seed
         force_field: Force field version (e.g., ff_2.1)
+        profile: Record the time spent in each engine node and summarize it
+        integrator: "verlet", or "mv" for the multi-step integrator
+        inner_step: Fast time steps per slow time step of the mv integrator
+        integrator_levels: Assignments of potentials to the levels of the mv integrator, as
+            for upside_config.py --integrator-level (e.g. "*membrane*=1")
 
     Returns:
-        Tuple of (trajectory_file, log_file, vtf_file) or None on failure
+        Tuple of (trajectory_file, log_file, vtf_file, analysis_files, profile_file) or None on
+        failure, where profile_file is None without a profile
     """
-    pdb_id = Path(pdb_file).stem
+    pdb_id = structure_basename(pdb_file)
     input_dir = os.path.join(output_dir, "inputs")
     run_dir = os.path.join(output_dir, "outputs")
     os.makedirs(input_dir, exist_ok=True)
     os.makedirs(run_dir, exist_ok=True)
 
-    print("Step 1: Converting PDB to initial structure...")
+    print("Step 1: Converting structure to initial structure...")
     cmd = [
         "python",
         f"{upside_path}/py/PDB_to_initial_structure.py",
@@ -138,6 +218,8 @@ def run_simulation(
         bb_environment_potential=param_dir_ff + "bb_env.dat",
         chain_break_from_file=f"{input_dir}/{pdb_id}.chain_breaks",
         initial_structure=f"{input_dir}/{pdb_id}.initial.npy",
+        measure_max_n_edge=True,
+        integrator_level=integrator_levels,
     )
 
     config_stdout = ru.upside_config(fasta, config_base, **kwargs)
@@ -157,6 +239,8 @@ def run_simulation(
         f"--frame-interval {frame_interval} "
         f"--temperature {temperature} "
         f"--seed {seed} "
+        f"{'--profile ' if profile else ''}"
+        f"{f'--integrator mv --inner-step {inner_step} ' if integrator == 'mv' else ''}"
         f"{h5_file}"
     )
     print(f"Running: {cmd}")
@@ -176,16 +260,28 @@ def run_simulation(
     vtf_file = f"{run_dir}/{job_id}.vtf"
     generate_vtf(h5_file, vtf_file)
 
-    return h5_file, log_file, vtf_file
+    print("Step 5: Analyzing trajectory...")
+    analysis_files = run_analysis(h5_file, f"{run_dir}/{job_id}")
+
+    profile_file = None
+    if profile:
+        profile_file = write_profile_summary(h5_file, f"{run_dir}/{job_id}.profile.json")
+
+    return h5_file, log_file, vtf_file, analysis_files, profile_file
 
 
 def main():
     parser = argparse.ArgumentParser(
-        description="Run Upside simulation from S3 PDB file"
+        description="Run Upside simulation from S3 structure file"
     )
     parser.add_argument("--job-id", required=True, help="Job UUID")
     parser.add_argument(
-        "--input-bucket", required=True, help="S3 bucket for input PDB files"
+        "--input-bucket", required=True, help="S3 bucket for input structure files"
+    )
+    parser.add_argument(
+        "--input-key",
+        default=None,
+        help="S3 key of the input structure (default: {job_id} with a .pdb, .cif, .pdb.gz or .cif.gz extension)",
     )
     parser.add_argument(
         "--output-bucket", required=True, help="S3 bucket for output results"
@@ -208,16 +304,39 @@ def main():
     parser.add_argument(
         "--rot-scale", type=float, default=1.0, help="Rotamer energy scale"
     )
+    parser.add_argument(
+        "--integrator",
+        choices=["verlet", "mv"],
+        default="verlet",
+        help="Integrator; mv computes the slow potentials once per --inner-step time steps",
+    )
+    parser.add_argument(
+        "--inner-step",
+        type=int,
+        default=3,
+        help="Fast time steps per slow time step of the mv integrator",
+    )
+    parser.add_argument(
+        "--integrator-levels",
+        default="",
+        help='Potentials to put on the fast (0) or slow (1) level of the mv integrator, e.g. "*membrane*=1"',
+    )
+    parser.add_argument(
+        "--no-profile",
+        action="store_true",
+        help="Do not record the time spent in each engine node",
+    )
 
     args = parser.parse_args()
 
     work_dir = "/work"
     os.makedirs(work_dir, exist_ok=True)
 
-    pdb_key = f"{args.job_id}.pdb"
-    local_pdb = f"{work_dir}/{args.job_id}.pdb"
+    pdb_key = args.input_key or find_input_key(args.input_bucket, args.job_id)
+    local_pdb = f"{work_dir}/{os.path.basename(pdb_key)}"
 
-    print("Downloading PDB from S3...")
+    # compressed structures are downloaded as-is and decompressed while parsing
+    print("Downloading structure from S3...")
     download_from_s3(args.input_bucket, pdb_key, local_pdb)
 
     result = run_simulation(
@@ -229,10 +348,14 @@ def main():
         frame_interval=args.frame_interval,
         seed=args.seed,
         force_field=args.force_field,
+        profile=not args.no_profile,
+        integrator=args.integrator,
+        inner_step=args.inner_step,
+        integrator_levels=args.integrator_levels,
     )
 
     if result:
-        h5_file, log_file, vtf_file = result
+        h5_file, log_file, vtf_file, analysis_files, profile_file = result
 
         output_prefix = f"{args.job_id}-results/"
         print("Uploading results to S3...")
@@ -248,6 +371,20 @@ def main():
                 vtf_file, args.output_bucket, f"{output_prefix}{args.job_id}.vtf"
             )
 
+        if profile_file:
+            upload_to_s3(
+                profile_file,
+                args.output_bucket,
+                f"{output_prefix}{args.job_id}.profile.json",
+            )
+
+        for analysis_file in analysis_files:
+            upload_to_s3(
+                analysis_file,
+                args.output_bucket,
+                f"{output_prefix}{os.path.basename(analysis_file)}",
+            )
+
         print("Done!")
         return 0
     else:
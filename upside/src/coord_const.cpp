@@ -178,6 +178,22 @@ struct ConstantCoord3D : public CoordNode
 };
 static RegisterNodeType<ConstantCoord3D,1> const3d_node("Const3D");
 
+
+struct ConstantCoord : public CoordNode
+{
+    // Output of any shape read from the value dataset, such as a node frozen at the initial
+    // structure by upside_engine.freeze_nodes.  The argument is unused.
+    ConstantCoord(hid_t grp, CoordNode& pos_):
+        CoordNode(get_dset_size(2, grp, "value")[0], get_dset_size(2, grp, "value")[1])
+    {
+        traverse_dset<2,float>(grp, "value", [&](size_t ne, size_t d, float x) { output(d,ne) = x;});
+    }
+
+    virtual void compute_value(ComputeMode mode) {}
+    virtual void propagate_deriv() {}
+};
+static RegisterNodeType<ConstantCoord,1> constant_node("constant");
+
 struct MovingConstantCoord1D : public CoordNode
 {
     struct Params { 
@@ -175,15 +175,89 @@ void DerivEngine::build_exec_levels() {
         if(!not_finished) break;
     }
 
+    build_exec_groups();
+
+    deriv_timer_names.clear();
+    for(auto& n: nodes) deriv_timer_names.push_back(n.name + "_deriv");
+}
+
+void DerivEngine::build_exec_groups() {
+    // Greedily place each node in the first group of its level that holds none of its parents'
+    // other children
+    auto make_groups = [&](const vector<int>& order, int Node::*exec_level) {
+        vector<vector<int>> groups;
+        vector<vector<size_t>> group_parents;
+        int first_group_of_level = 0;
+        for(size_t k=0; k<order.size(); ++k) {
+            auto& n = nodes[order[k]];
+            if(k && nodes[order[k-1]].*exec_level != n.*exec_level)
+                first_group_of_level = groups.size();
+
+            int ng = first_group_of_level;
+            for(; ng<int(groups.size()); ++ng) {
+                auto& gp = group_parents[ng];
+                if(none_of(begin(n.parents), end(n.parents), [&](size_t ip) {
+                            return find(begin(gp), end(gp), ip) != end(gp);}))
+                    break;
+            }
+            if(ng == int(groups.size())) {
+                groups.emplace_back();
+                group_parents.emplace_back();
+            }
+            groups[ng].push_back(order[k]);
+            group_parents[ng].insert(end(group_parents[ng]), begin(n.parents), end(n.parents));
+        }
+        return groups;
+    };
+
+    germ_exec_groups  = make_groups(germ_exec_levels,  &Node::germ_exec_level);
+    deriv_exec_groups = make_groups(deriv_exec_levels, &Node::deriv_exec_level);
+}
+
+template <typename GermFunc, typename DerivFunc>
+static void execute_groups(const DerivEngine& engine, GermFunc&& germ, DerivFunc&& deriv) {
+    if(engine.n_thread <= 1) {
+        for(int i : engine.germ_exec_levels)  germ(i);
+        for(int i : engine.deriv_exec_levels) deriv(i);
+        return;
+    }
+
+    // The nodes of a group run as tasks.  A group of one node runs directly, so that the tasks
+    // created within the node by for_each_block have the whole team.
+    auto run = [](const vector<vector<int>>& groups, const function<void(int)>& f) {
+        for(auto& g: groups) {
+            if(g.size() == 1u) {
+                f(g[0]);
+                continue;
+            }
+            auto fp = &f;
+            for(int i: g) {
+                #pragma omp task firstprivate(i, fp)
+                (*fp)(i);
+            }
+            #pragma omp taskwait
+        }
+    };
+
+    #pragma omp parallel num_threads(engine.n_thread)
+    #pragma omp single
+    {
+        run(engine.germ_exec_groups,  germ);
+        run(engine.deriv_exec_groups, deriv);
+    }
 }
 
 void DerivEngine::build_integrator_levels( bool print_info, float dt, int inner_step) {
 
     for(int nid=0; nid<(int)nodes.size(); nid++) {
         auto& n = nodes[nid];
-        if(n.computation->potential_term)
-            if (n.integrator_level >= 2 or n.integrator_level < 0)
+        if(n.computation->potential_term) {
+            if (n.integrator_level < 0 or n.integrator_level > 2)
+                throw string("potential ") + n.name + " has integrator_level " + to_string(n.integrator_level) +
+                    ", but the multi-step integrator only has levels 0 (fast) and 1 (slow)";
+            if (n.integrator_level == 2)  // no level in the configuration
                 n.integrator_level = 0;
+        }
     }
   
     for(int i : deriv_exec_levels) {
@@ -237,58 +311,70 @@ void DerivEngine::build_integrator_levels( bool print_info, float dt, int inner_
 }
 
 void DerivEngine::compute(ComputeMode mode) {
-    if(mode == PotentialAndDerivMode) potential = 0.f;
-
-    for(int i : germ_exec_levels) {
-        auto& n = nodes[i];
-        n.computation->compute_value(mode);
-        if(mode == PotentialAndDerivMode && n.computation->potential_term) {
-            auto pot_node = static_cast<PotentialNode*>(n.computation.get());
-            potential += pot_node->potential;
-        }
-        if(!n.computation->potential_term) {
-            // ensure zero sensitivity for later derivative writing
-            CoordNode* coord_node = static_cast<CoordNode*>(n.computation.get());
-            fill(coord_node->sens, 0.f);
+    execute_groups(*this,
+            [&](int i) {
+                auto& n = nodes[i];
+                Timer timer(n.name, profile);
+                n.computation->compute_value(mode);
+                if(!n.computation->potential_term) {
+                    // ensure zero sensitivity for later derivative writing
+                    CoordNode* coord_node = static_cast<CoordNode*>(n.computation.get());
+                    fill(coord_node->sens, 0.f);
+                }
+            },
+            [&](int i) {
+                Timer timer(deriv_timer_names[i], profile);
+                nodes[i].computation->propagate_deriv();
+            });
+
+    // sum in execution order so that the potential does not depend on the number of threads
+    if(mode == PotentialAndDerivMode) {
+        potential = 0.f;
+        for(int i : germ_exec_levels) {
+            auto& n = nodes[i];
+            if(n.computation->potential_term)
+                potential += static_cast<PotentialNode*>(n.computation.get())->potential;
         }
     }
-
-    for(int i : deriv_exec_levels) {
-        auto& n = nodes[i];
-        n.computation->propagate_deriv();
-    }
 }
 
 void DerivEngine::compute(ComputeMode mode, int integrator_level) {
-    if(mode == PotentialAndDerivMode) potential = 0.f;
+    auto at_level = [&](const Node& n) {
+        return n.integrator_level == integrator_level or n.integrator_level == -1;
+    };
+
+    execute_groups(*this,
+            [&](int i) {
+                auto& n = nodes[i];
+                if (not n.computation->potential_term) {
+                    CoordNode* coord_node = static_cast<CoordNode*>(n.computation.get());
+                    fill(coord_node->sens, 0.f);
+                }
 
-    for(int i : germ_exec_levels) {
-        auto& n = nodes[i];
-        if (not n.computation->potential_term) {
-            CoordNode* coord_node = static_cast<CoordNode*>(n.computation.get());
-            fill(coord_node->sens, 0.f);
-        }
+                if (!at_level(n))
+                    return;
 
-        if (n.integrator_level != integrator_level and n.integrator_level != -1)
-            continue;
+                //std::cout << n.name << " " << n.integrator_level << " " << integrator_level << std::endl;
 
-        //std::cout << n.name << " " << n.integrator_level << " " << integrator_level << std::endl;
+                Timer timer(n.name, profile);
+                n.computation->compute_value(mode);
+            },
+            [&](int i) {
+                auto& n = nodes[i];
+                if (at_level(n)) {
+                    Timer timer(deriv_timer_names[i], profile);
+                    n.computation->propagate_deriv();
+                }
+            });
 
-        n.computation->compute_value(mode);
-        if (n.computation->potential_term) {
-            if(mode == PotentialAndDerivMode && n.computation->potential_term) {
-                auto pot_node = static_cast<PotentialNode*>(n.computation.get());
-                potential += pot_node->potential;
-            }
+    if(mode == PotentialAndDerivMode) {
+        potential = 0.f;
+        for(int i : germ_exec_levels) {
+            auto& n = nodes[i];
+            if(n.computation->potential_term && at_level(n))
+                potential += static_cast<PotentialNode*>(n.computation.get())->potential;
         }
     }
-
-    for(int i : deriv_exec_levels) {
-        auto& n = nodes[i];
-        if (n.integrator_level != integrator_level and n.integrator_level != -1)
-            continue;
-        n.computation->propagate_deriv();
-    }
 }
 
 
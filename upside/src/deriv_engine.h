@@ -7,7 +7,12 @@
 #include <functional>
 #include <initializer_list>
 #include <map>
+#include <algorithm>
 #include "vector_math.h"
+#include "timing.h"
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 
 //!\brief Copy VecArray to a flat float* array
 inline void copy_vec_array_to_buffer(VecArray arr, int n_elem, int n_dim, float* buffer) {
@@ -18,6 +23,25 @@ inline void copy_vec_array_to_buffer(VecArray arr, int n_elem, int n_dim, float*
 
 typedef int index_t;  //!< Type of coordinate indices
 
+//! \brief Call body(start, stop) for blocks of block_size elements covering [0,n)
+//!
+//! Inside an OpenMP parallel region, such as DerivEngine::compute with more than one thread, the
+//! blocks run as OpenMP tasks.  Otherwise body is called once for the whole range.  The body must
+//! only write data belonging to its own block.
+template <typename F>
+inline void for_each_block(int n, int block_size, F&& body) {
+#ifdef _OPENMP
+    if(n > block_size && omp_in_parallel()) {
+        int n_block = (n+block_size-1)/block_size;
+        #pragma omp taskloop grainsize(1)
+        for(int nb=0; nb<n_block; ++nb)
+            body(nb*block_size, std::min(n, (nb+1)*block_size));
+        return;
+    }
+#endif
+    body(0, n);
+}
+
 //! \brief Update position and momentum
 void
 integration_stage(
@@ -191,6 +215,26 @@ struct DerivEngine
     std::vector<int> germ_exec_levels;
     std::vector<int> deriv_exec_levels;
 
+    //! \brief Groups of nodes that may execute concurrently, in execution order
+    //!
+    //! The nodes of a group are at the same level of the graph and share no parents, since both
+    //! compute_value of a potential node and propagate_deriv accumulate into the sens of the parents.
+    std::vector<std::vector<int>> germ_exec_groups;
+    std::vector<std::vector<int>> deriv_exec_groups;
+
+    //! \brief Number of OpenMP threads used by compute (1 for serial execution)
+    //!
+    //! With more than one thread, the nodes of each exec group run as OpenMP tasks and the large
+    //! loops within nodes are split into tasks with for_each_block.
+    int n_thread;
+
+    //! \brief Time spent in each node, recorded only when profile.enabled
+    //!
+    //! compute_value of a node is recorded under the node name and propagate_deriv under
+    //! deriv_timer_names, which is the node name followed by "_deriv".
+    TimeKeeper profile;
+    std::vector<std::string> deriv_timer_names;
+
     //! \brief Pointer to pos node (used for position input and derivative output)
     Pos* pos;
     //! \brief potential energy output of the computation graph
@@ -200,9 +244,10 @@ struct DerivEngine
     float potential;
 
     //! \brief Default constructor (not used)
-    DerivEngine() {}
+    DerivEngine(): n_thread(1) {}
     //! \brief Construct from number of atoms
     DerivEngine(int n_atom): 
+        n_thread(1),
         potential(0.f)
     {
         nodes.emplace_back("pos", new Pos(n_atom));
@@ -243,6 +288,7 @@ struct DerivEngine
     void compute(ComputeMode mode, int integrator_level);
 
     void build_exec_levels();
+    void build_exec_groups();
     void build_integrator_levels(bool print_info, float dt, int inner_step);
 
     //! \brief Integration scheme (i.e. position and velocity update weights) to use
@@ -2,6 +2,7 @@
 #include "deriv_engine.h"
 #include <algorithm>
 #include "spline.h"
+#include "timing.h"
 
 using namespace h5;
 using namespace std;
@@ -194,6 +195,46 @@ try {
     return 1;
 }
 
+int set_profile(DerivEngine* engine, bool enabled) {
+    for(TimeKeeper* time_keeper: {&engine->profile, &global_time_keeper}) {
+        if(enabled) time_keeper->records.clear();
+        time_keeper->enabled = enabled;
+    }
+    return 0;
+}
+
+
+int get_profile_size(int* n_entry, int* name_size, DerivEngine* engine, bool global_timers) {
+    const TimeKeeper& time_keeper = global_timers ? global_time_keeper : engine->profile;
+    *n_entry = time_keeper.records.size();
+    *name_size = 1;  // including the null terminator
+    for(auto& r: time_keeper.records) *name_size = max(*name_size, int(r.first.size())+1);
+    return 0;
+}
+
+
+int get_profile(int n_entry, int name_size, char* names, long* n_invoke, double* seconds,
+        DerivEngine* engine, bool global_timers)
+try {
+    auto records = (global_timers ? global_time_keeper : engine->profile).sorted_records();
+    if(n_entry != int(records.size()))
+        throw string("expected ") + to_string(n_entry) + " profile entries but have " + to_string(records.size());
+
+    fill_n(names, n_entry*name_size, '\0');
+    for(int i=0; i<n_entry; ++i) {
+        if(int(records[i].first.size()) >= name_size) throw string("profile name too long");
+        copy(begin(records[i].first), end(records[i].first), names + i*name_size);
+        n_invoke[i] = records[i].second.n_invoke;
+        seconds [i] = records[i].second.total_elapsed;
+    }
+    return 0;
+} catch(const string& s) {
+    fprintf(stderr, "ERROR: %s\n", s.c_str());
+    return 1;
+} catch(...) {
+    return 1;
+}
+
 int clamped_spline_solve(int N_coeff, float* bspline_coeff, const float* values) {
     vector<double> temp(3*N_coeff);
     vector<double> bspline_coeff_d(N_coeff);
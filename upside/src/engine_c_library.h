@@ -26,6 +26,13 @@ extern "C" {
     int get_value_by_name(int n_output, float* output, DerivEngine* engine,
             const char* node_name, const char* log_name);
 
+    // Per-node timing (global_timers=false) or the finer timers shared by all engines (true).
+    // Enabling clears the previous records of both.
+    int set_profile     (DerivEngine* engine, bool enabled);
+    int get_profile_size(int* n_entry, int* name_size, DerivEngine* engine, bool global_timers);
+    int get_profile     (int n_entry, int name_size, char* names, long* n_invoke, double* seconds,
+            DerivEngine* engine, bool global_timers);
+
     int clamped_spline_solve       (int N, float* bspline_coeff, const float* values);
     int clamped_spline_value       (int N, float* result, const float* bspline_coeff, int nx, float* x);
     int get_clamped_value_and_deriv(int N, float* result, const float* bspline_coeff, int nx, float* x);
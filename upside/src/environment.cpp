@@ -344,6 +344,10 @@ struct EnvironmentCoverage : public CoordNode {
     virtual std::vector<float> get_param_deriv() override {return igraph.get_param_deriv();}
 #endif
     virtual void set_param(const std::vector<float>& new_param) override {igraph.set_param(new_param);}
+
+    virtual std::vector<float> get_value_by_name(const char* log_name) override {
+        return igraph.get_value_by_name(log_name);
+    }
 };
 static RegisterNodeType<EnvironmentCoverage,2> environment_coverage_node("environment_coverage");
 
@@ -381,6 +385,10 @@ struct HbondEnvironmentCoverage : public CoordNode {
     virtual std::vector<float> get_param_deriv() override {return igraph.get_param_deriv();}
 #endif
     virtual void set_param(const std::vector<float>& new_param) override {igraph.set_param(new_param);}
+
+    virtual std::vector<float> get_value_by_name(const char* log_name) override {
+        return igraph.get_value_by_name(log_name);
+    }
 };
 static RegisterNodeType<HbondEnvironmentCoverage,2> hbond_environment_coverage_node("hb_environment_coverage");
 
@@ -418,6 +426,10 @@ struct HbondBackBoneCoverage : public CoordNode {
     virtual std::vector<float> get_param_deriv() override {return igraph.get_param_deriv();}
 #endif
     virtual void set_param(const std::vector<float>& new_param) override {igraph.set_param(new_param);}
+
+    virtual std::vector<float> get_value_by_name(const char* log_name) override {
+        return igraph.get_value_by_name(log_name);
+    }
 };
 static RegisterNodeType<HbondBackBoneCoverage,2> hbond_backbone_coverage_node("hbbb_coverage");
 
@@ -450,6 +462,10 @@ struct SphereEnvironmentCoverage : public CoordNode {
     virtual std::vector<float> get_param_deriv() override {return igraph.get_param_deriv();}
 #endif
     virtual void set_param(const std::vector<float>& new_param) override {igraph.set_param(new_param);}
+
+    virtual std::vector<float> get_value_by_name(const char* log_name) override {
+        return igraph.get_value_by_name(log_name);
+    }
 };
 static RegisterNodeType<SphereEnvironmentCoverage,1> sphere_environment_coverage_node("SphereCoverage");
 
@@ -482,6 +498,10 @@ struct WeightedSphereEnvironmentCoverage : public CoordNode {
     virtual std::vector<float> get_param_deriv() override {return igraph.get_param_deriv();}
 #endif
     virtual void set_param(const std::vector<float>& new_param) override {igraph.set_param(new_param);}
+
+    virtual std::vector<float> get_value_by_name(const char* log_name) override {
+        return igraph.get_value_by_name(log_name);
+    }
 };
 static RegisterNodeType<WeightedSphereEnvironmentCoverage,1> weighted_sphere_environment_coverage_node("WeightedSphereCoverage");
 
@@ -6,6 +6,7 @@
 #include <array>
 #include <functional>
 #include <memory>
+#include <cstdint>
 
 #include <hdf5.h>
 
@@ -18,6 +19,7 @@ inline hid_t select_predtype () { return T::NO_SPECIALIZATION_AVAILABLE; }
 template<> inline hid_t select_predtype<float> (){ return H5T_NATIVE_FLOAT;  }
 template<> inline hid_t select_predtype<double>(){ return H5T_NATIVE_DOUBLE; }
 template<> inline hid_t select_predtype<int>   (){ return H5T_NATIVE_INT;    }
+template<> inline hid_t select_predtype<int16_t>(){ return H5T_NATIVE_SHORT;  }
 template<> inline hid_t select_predtype<long>  (){ return H5T_NATIVE_LONG;    }
 template<> inline hid_t select_predtype<unsigned>(){ return H5T_NATIVE_UINT;    }
 //! \endcond
@@ -431,6 +431,10 @@ struct ProteinHBond : public CoordNode
             update_vec(pd2, igraph.loc2[na], load_vec<6>(sens, na+n_donor));
         }
     }
+
+    virtual vector<float> get_value_by_name(const char* log_name) override {
+        return igraph.get_value_by_name(log_name);
+    }
 };
 static RegisterNodeType<ProteinHBond,1> hbond_node("protein_hbond");
 
@@ -474,11 +478,7 @@ struct HBondCoverage : public CoordNode {
     virtual void set_param(const std::vector<float>& new_param) override {igraph.set_param(new_param);}
 
     virtual vector<float> get_value_by_name(const char* log_name) override {
-        if(!strcmp(log_name, "count_edges_by_type")) {
-            return igraph.count_edges_by_type();
-        } else {
-            throw string("Value ") + log_name + string(" not implemented");
-        }
+        return igraph.get_value_by_name(log_name);
     }
 };
 static RegisterNodeType<HBondCoverage,2> coverage_node("hbond_coverage");
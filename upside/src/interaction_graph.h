@@ -10,6 +10,8 @@
 #include "Float4.h"
 #include <iostream>
 #include <stdexcept>
+#include <cstring>
+#include <cmath>
 
 template <typename T>
 inline T* operator+(const std::unique_ptr<T[]>& ptr, int i) {
@@ -37,6 +39,11 @@ struct PairlistComputation {
         std::unique_ptr<int32_t[]>  edge_indices1, edge_indices2;
         std::unique_ptr<int32_t[]>  edge_id1,      edge_id2;
         int n_edge;
+        int max_n_edge;  // capacity of the edge arrays, which grows if the cache needs more edges
+        int cell_list_min_elem;  // cache rebuilds use a cell list when n_elem2 is at least this
+
+        // Below this many elements, checking all pairs is faster than binning into cells
+        constexpr static const int default_cell_list_min_elem = 1024;
 
     protected:
         bool cache_valid;
@@ -48,6 +55,137 @@ struct PairlistComputation {
         std::unique_ptr<int32_t[]>  cache_edge_id1,      cache_edge_id2;
         int cache_n_edge;
 
+        // Uniform grid over the cached positions of the second set of elements.  The elements of
+        // cell c are cell_elem[cell_start[c]:cell_start[c+1]], in increasing order.
+        int n_cell[3];
+        float cell_origin[3];
+        float inv_cell_width;
+        std::vector<int32_t> cell_start, cell_elem, cell_count;
+        std::vector<int32_t> neighbor_cells;
+        // Bit i2 is set for each candidate partner of the current block of four elements.  Reading
+        // the set bits in order gives the candidates in increasing order without sorting them.
+        std::vector<uint64_t> candidate_bits;
+        int candidate_word_begin, candidate_word_end;
+
+        bool bin_cells() {
+            // Cells are at least cache_cutoff wide, so every pair within the cutoff is in the same
+            // or adjacent cells.  Returns false if the positions cannot be binned, in which case the
+            // caller checks all pairs.
+            const float* pos = symmetric ? cache_pos1.get() : cache_pos2.get();
+            float lo[3] = { 1e30f, 1e30f, 1e30f};
+            float hi[3] = {-1e30f,-1e30f,-1e30f};
+            for(int i=0; i<n_elem2; ++i) {
+                for(int d=0; d<3; ++d) {
+                    if(!std::isfinite(pos[4*i+d])) return false;
+                    lo[d] = std::min(lo[d], pos[4*i+d]);
+                    hi[d] = std::max(hi[d], pos[4*i+d]);
+                }
+            }
+
+            // Very spread out elements would need many empty cells, so widen the cells to keep the
+            // number of cells comparable to the number of elements
+            double width = cache_cutoff;
+            double max_cells = std::max(4.*n_elem2, 64.);
+            double n_total;
+            do {
+                n_total = 1.;
+                for(int d=0; d<3; ++d) n_total *= std::floor((hi[d]-lo[d])/width) + 1.;
+                if(n_total > max_cells) width *= std::max(1.1, std::cbrt(n_total/max_cells));
+            } while(n_total > max_cells);
+
+            inv_cell_width = float(1./width);
+            for(int d=0; d<3; ++d) {
+                cell_origin[d] = lo[d];
+                n_cell[d] = int(std::floor((hi[d]-lo[d])/width)) + 1;
+            }
+
+            // counting sort of the elements by cell, which keeps each cell in increasing order
+            cell_count.assign(n_cell[0]*n_cell[1]*n_cell[2], 0);
+            cell_start.assign(cell_count.size()+1, 0);
+            cell_elem.resize(n_elem2);
+            candidate_bits.assign(n_elem2/64+1, 0u);
+            auto cell_of = [&](int i) {
+                int c[3];
+                for(int d=0; d<3; ++d)
+                    c[d] = std::min(n_cell[d]-1, int((pos[4*i+d]-cell_origin[d])*inv_cell_width));
+                return (c[0]*n_cell[1] + c[1])*n_cell[2] + c[2];
+            };
+            for(int i=0; i<n_elem2; ++i) cell_count[cell_of(i)]++;
+            for(size_t c=0; c<cell_count.size(); ++c) cell_start[c+1] = cell_start[c] + cell_count[c];
+            std::copy(cell_start.begin(), cell_start.end()-1, cell_count.begin());
+            for(int i=0; i<n_elem2; ++i) cell_elem[cell_count[cell_of(i)]++] = i;
+            return true;
+        }
+
+        void mark_candidates(int i1, int min_i2) {
+            // Mark all elements of the second set in cells adjacent to the cells of elements i1..i1+3
+            // of the first set.  This is a superset of the elements within the cache cutoff of any
+            // of the four.
+            int c[4][3];
+            int box_lo[3] = {n_cell[0],n_cell[1],n_cell[2]}, box_hi[3] = {-1,-1,-1};
+            int n_lane = std::min(4, n_elem1-i1);
+            for(int j=0; j<n_lane; ++j) {
+                for(int d=0; d<3; ++d) {
+                    // clamp before converting to int so that far away elements cannot overflow
+                    float x = (cache_pos1[4*(i1+j)+d]-cell_origin[d])*inv_cell_width;
+                    c[j][d] = int(std::floor(std::max(-2.f, std::min(float(n_cell[d]+1), x))));
+                    box_lo[d] = std::min(box_lo[d], c[j][d]-1);
+                    box_hi[d] = std::max(box_hi[d], c[j][d]+1);
+                }
+            }
+
+            // Consecutive elements are usually close together, so scan the block of cells around all
+            // four at once unless that would visit many cells far from all of them
+            neighbor_cells.clear();
+            auto add_cells = [&](const int* lo, const int* hi) {
+                for(int a=std::max(lo[0],0); a<=std::min(hi[0],n_cell[0]-1); ++a)
+                    for(int b=std::max(lo[1],0); b<=std::min(hi[1],n_cell[1]-1); ++b)
+                        for(int e=std::max(lo[2],0); e<=std::min(hi[2],n_cell[2]-1); ++e)
+                            neighbor_cells.push_back((a*n_cell[1] + b)*n_cell[2] + e);
+            };
+            if((box_hi[0]-box_lo[0]+1)*(box_hi[1]-box_lo[1]+1)*(box_hi[2]-box_lo[2]+1) <= 27*n_lane) {
+                add_cells(box_lo, box_hi);
+            } else {
+                // overlapping cells are harmless, since marking an element twice sets the same bit
+                for(int j=0; j<n_lane; ++j) {
+                    int lo_j[3] = {c[j][0]-1, c[j][1]-1, c[j][2]-1};
+                    int hi_j[3] = {c[j][0]+1, c[j][1]+1, c[j][2]+1};
+                    add_cells(lo_j, hi_j);
+                }
+            }
+
+            candidate_word_begin = int(candidate_bits.size());
+            candidate_word_end   = 0;
+            for(int c: neighbor_cells) {
+                for(int k=cell_start[c]; k<cell_start[c+1]; ++k) {
+                    int i2 = cell_elem[k];
+                    if(i2 < min_i2) continue;
+                    candidate_bits[i2/64] |= uint64_t(1) << (i2%64);
+                    candidate_word_begin = std::min(candidate_word_begin, i2/64);
+                    candidate_word_end   = std::max(candidate_word_end,   i2/64+1);
+                }
+            }
+        }
+
+        void grow(int new_max_n_edge, int n_cache_edge_keep) {
+            // Only the cache edges found so far need to survive, since the refined edges are
+            // recomputed from the cache
+            auto reallocate = [&](std::unique_ptr<int32_t[]>& a, int alignment, int n_keep) {
+                std::unique_ptr<int32_t[]> b(new_aligned<int32_t>(new_max_n_edge, alignment));
+                std::copy_n(a.get(), n_keep, b.get());
+                a = std::move(b);
+            };
+            reallocate(cache_edge_indices1, 4, n_cache_edge_keep);
+            reallocate(cache_edge_indices2, 4, n_cache_edge_keep);
+            reallocate(cache_edge_id1,      4, n_cache_edge_keep);
+            reallocate(cache_edge_id2,      4, n_cache_edge_keep);
+            reallocate(edge_indices1, 16, 0);
+            reallocate(edge_indices2, 16, 0);
+            reallocate(edge_id1,      16, 0);
+            reallocate(edge_id2,      16, 0);
+            max_n_edge = new_max_n_edge;
+        }
+
         template<acceptable_id_pair_t acceptable_id_pair>
         void ensure_cache_valid(
                 float cutoff,
@@ -119,6 +257,10 @@ struct PairlistComputation {
             Int4 offset(offset_v);
             auto cutoff2 = Float4(sqr(cache_cutoff));
 
+            // The cell list gives the same edges in the same order as checking all pairs, since it
+            // only skips pairs that cannot be within the cutoff
+            bool use_cells = n_elem2 >= cell_list_min_elem && bin_cells();
+
             int ne = 0;
             for(int32_t i1=0; i1<n_elem1; i1+=4) {
                 Float4 v0(cache_pos1+(i1+0)*4), // aligned_pos1 size was rounded up
@@ -131,11 +273,11 @@ struct PairlistComputation {
                 auto  my_id1 = Int4(cache_id1+i1);
                 auto  i1_vec = Int4(i1) + offset;
 
-                for(int32_t i2=symmetric?i1+1:0; i2<n_elem2; ++i2) {
+                auto check_pair = [&](int32_t i2) {
                     const float* p = (symmetric?cache_pos1:cache_pos2)+i2*4;
                     auto  x2 = make_vec3(Float4(p[0]), Float4(p[1]),  Float4(p[2]));
                     auto near = mag2(x1-x2)<cutoff2;
-                    if(near.none()) continue;
+                    if(near.none()) return;
 
                     auto my_id2 = Int4((symmetric?cache_id1:cache_id2)[i2]);
                     auto i2_vec = Int4(i2);
@@ -150,11 +292,26 @@ struct PairlistComputation {
 
                     // write out pairs
                     int n_hit = popcnt_nibble(is_hit_bits);
+                    if(ne+4 > max_n_edge) {
+                        // each store writes 4 entries, so grow before the buffer could overflow
+                        grow(round_up(std::max(2*max_n_edge,16),16), ne);
+                    }
                     i1_vec.left_pack(is_hit_bits).store(cache_edge_indices1+ne, Alignment::unaligned);
                     my_id1.left_pack(is_hit_bits).store(cache_edge_id1     +ne, Alignment::unaligned);
                     i2_vec                       .store(cache_edge_indices2+ne, Alignment::unaligned);
                     my_id2                       .store(cache_edge_id2     +ne, Alignment::unaligned);
                     ne += n_hit;
+                };
+
+                if(use_cells) {
+                    mark_candidates(i1, symmetric?i1+1:0);
+                    for(int w=candidate_word_begin; w<candidate_word_end; ++w) {
+                        for(uint64_t bits=candidate_bits[w]; bits; bits &= bits-1)
+                            check_pair(64*w + __builtin_ctzll(bits));
+                        candidate_bits[w] = 0u;  // clear for the next block
+                    }
+                } else {
+                    for(int32_t i2=symmetric?i1+1:0; i2<n_elem2; ++i2) check_pair(i2);
                 }
             }
             cache_n_edge = ne;
@@ -170,15 +327,19 @@ struct PairlistComputation {
 
     public:
         void change_cache_buffer(float new_buffer) {cache_buffer=new_buffer;}
-        PairlistComputation(int n_elem1_, int n_elem2_, int max_n_edge):
+        int n_cache_edge() const {return cache_n_edge;}
+        PairlistComputation(int n_elem1_, int n_elem2_, int max_n_edge_,
+                            int cell_list_min_elem_ = default_cell_list_min_elem):
             n_elem1(n_elem1_), n_elem2(n_elem2_),
 
-            edge_indices1(new_aligned<int32_t>(max_n_edge, 16)),
-            edge_indices2(new_aligned<int32_t>(max_n_edge, 16)),
-            edge_id1     (new_aligned<int32_t>(max_n_edge, 16)),
-            edge_id2     (new_aligned<int32_t>(max_n_edge, 16)),
+            edge_indices1(new_aligned<int32_t>(max_n_edge_, 16)),
+            edge_indices2(new_aligned<int32_t>(max_n_edge_, 16)),
+            edge_id1     (new_aligned<int32_t>(max_n_edge_, 16)),
+            edge_id2     (new_aligned<int32_t>(max_n_edge_, 16)),
 
             n_edge(0),
+            max_n_edge(max_n_edge_),
+            cell_list_min_elem(cell_list_min_elem_),
 
             cache_valid(false),
             cache_buffer(1.f), // reasonable value that the user can modify
@@ -258,6 +419,9 @@ struct PairlistComputation {
         }
 };
 
+template <bool symmetric>
+constexpr const int PairlistComputation<symmetric>::default_cell_list_min_elem;
+
 
 template<typename IType>
 struct InteractionGraph{
@@ -280,6 +444,7 @@ struct InteractionGraph{
     float cutoff;
 
     int n_edge;
+    constexpr static const int edge_block_size = 512;  // edges per task, a multiple of 4
 
     std::unique_ptr<int32_t[]>  types1, types2; // pair type is type[0]*n_types2 + type[1]
     std::unique_ptr<int32_t[]>  id1,    id2;    // used to avoid self-interaction
@@ -315,7 +480,7 @@ struct InteractionGraph{
         n_type2(h5::get_dset_size(3,grp,"interaction_param")[1]),
 
         max_n_edge(round_up( h5::read_attribute<int>(grp, ".", "max_n_edge", 
-                             n_elem1*n_elem2/(symmetric?2:1)),  16)),
+                             default_max_n_edge(n_elem1,n_elem2)),  16)),
 
         types1(new_aligned<int32_t>(n_elem1,16)), types2(new_aligned<int32_t>(n_elem2,16)),
         id1   (new_aligned<int32_t>(n_elem1,16)), id2   (new_aligned<int32_t>(n_elem2,16)),
@@ -323,7 +488,8 @@ struct InteractionGraph{
         pos1(new_aligned<float>(round_up(n_elem1,16)*n_dim1a,             align_bytes)),
         pos2(new_aligned<float>(round_up(symmetric?16:n_elem2,16)*n_dim2a, align_bytes)),
 
-        pairlist(n_elem1,n_elem2,max_n_edge),
+        pairlist(n_elem1,n_elem2,max_n_edge, h5::read_attribute<int>(grp, ".", "cell_list_min_elem",
+                    PairlistComputation<IType::symmetric>::default_cell_list_min_elem)),
         edge_indices1(pairlist.edge_indices1.get()),
         edge_indices2(pairlist.edge_indices2.get()),
         edge_id1      (pairlist.edge_id1.get()),
@@ -382,6 +548,26 @@ struct InteractionGraph{
         std::cerr << e.what() << std::endl;
     } 
 
+    static int default_max_n_edge(long long n1, long long n2) {
+        // All pairs for small systems, but the edge buffers grow as needed, so a large system
+        // need not reserve space for every pair up front
+        return int(std::min(n1*n2/(symmetric?2:1), 64ll*(n1+n2)));
+    }
+
+    void grow_edge_buffers() {
+        // The pairlist has grown its arrays to hold more edges, so the per edge data must follow
+        max_n_edge       = pairlist.max_n_edge;
+        max_n_edge_deriv = (long long) max_n_edge * (n_dim1+n_dim2);
+        edge_indices1 = pairlist.edge_indices1.get();
+        edge_indices2 = pairlist.edge_indices2.get();
+        edge_id1      = pairlist.edge_id1.get();
+        edge_id2      = pairlist.edge_id2.get();
+        edge_value       = new_aligned<float>(max_n_edge,       align_bytes);
+        edge_deriv       = new_aligned<float>(max_n_edge_deriv, align_bytes_long);
+        edge_sensitivity = new_aligned<float>(max_n_edge,       align_bytes);
+        fill_n(edge_sensitivity, max_n_edge, 0.f);
+    }
+
     void update_cutoffs() {
         cutoff = 0.f;
         for(int nt1: range(n_type1)) {
@@ -442,6 +628,26 @@ struct InteractionGraph{
         return retval;
     }
 
+    std::vector<float> get_value_by_name(const char* log_name) {
+        if(!strcmp(log_name, "count_edges_by_type")) {
+            return count_edges_by_type();
+        } else if(!strcmp(log_name, "n_edge")) {
+            // edges within the cutoff, edges within the cutoff plus the pairlist cache buffer
+            // (which determines the memory needed), and the current capacity of the edge buffers
+            return {float(n_edge), float(pairlist.n_cache_edge()), float(max_n_edge)};
+        } else if(!strcmp(log_name, "edge_indices")) {
+            // index1 and index2 of each edge, so 2*n_edge values
+            std::vector<float> retval(2*n_edge);
+            for(int ne=0; ne<n_edge; ++ne) {
+                retval[2*ne+0] = edge_indices1[ne];
+                retval[2*ne+1] = edge_indices2[ne];
+            }
+            return retval;
+        } else {
+            throw std::string("Value ") + log_name + std::string(" not implemented");
+        }
+    }
+
     template<bool param_deriv=false>
     void compute_edges() {
         // Copy in the data to packed arrays to ensure contiguity
@@ -462,6 +668,7 @@ struct InteractionGraph{
                                 pos1.get(), n_dim1a, id1.get(),
                                 (symmetric?pos1:pos2).get(), n_dim2a, (symmetric?id1:id2).get());
             n_edge = pairlist.n_edge;
+            if(pairlist.max_n_edge != max_n_edge) grow_edge_buffers();
         }
         // printf("n_edge for n_dim1 %i n_dim2 %i n_elem1 %i n_elem2 %i is %i\n", n_dim1, n_dim2, n_elem1, n_elem2, n_edge);
 
@@ -469,42 +676,46 @@ struct InteractionGraph{
         if(param_deriv)
             edge_param_deriv.clear();
 
-        for(int ne=0; ne<n_edge; ne+=4) {
-            auto i1 = Int4(edge_indices1+ne);
-            auto i2 = Int4(edge_indices2+ne);
-
-            auto t1 = Int4(types1.get(),i1);
-            auto t2 = Int4(types2.get(),i2);
-
-            auto interaction_offset = (t1*Int4(n_type2) + t2)*Int4(n_param);
-            const float* interaction_ptr[4] = {
-                interaction_param+interaction_offset.x(),
-                interaction_param+interaction_offset.y(),
-                interaction_param+interaction_offset.z(),
-                interaction_param+interaction_offset.w()};
-
-            auto coord1 = aligned_gather_vec<n_dim1>(pos1.get(),                 i1*Int4(n_dim1a));
-            auto coord2 = aligned_gather_vec<n_dim2>((symmetric?pos1:pos2).get(),i2*Int4(n_dim2a));
-
-            Vec<n_dim1,Float4> d1;
-            Vec<n_dim2,Float4> d2;
-
-            IType::compute_edge(d1,d2, interaction_ptr, coord1,coord2).store(edge_value+ne);
-            long long id_ed1 = (long long) ne * (long long) (n_dim1+n_dim2);
-            long long id_ed2 = id_ed1 + (long long) 4*n_dim1;
-            store_vec(edge_deriv + id_ed1, d1);
-            store_vec(edge_deriv + id_ed2, d2);
-
-            if(param_deriv) {
-                for(int i: range(4)) {
-                    Vec<n_dim1> c1; for(int d: range(n_dim1)) c1[d] = extract_float(coord1[d],i);
-                    Vec<n_dim2> c2; for(int d: range(n_dim2)) c2[d] = extract_float(coord2[d],i);
-
-                    edge_param_deriv.push_back(make_zero<n_param>());
-                    IType::param_deriv(edge_param_deriv.back(), interaction_ptr[i], c1,c2);
+        // Edges are independent, so the work is split into blocks of edges.  The parameter derivatives
+        // are appended in edge order, so they are computed in a single block.
+        for_each_block(n_edge, param_deriv ? n_edge : edge_block_size, [&](int start, int stop) {
+            for(int ne=start; ne<stop; ne+=4) {
+                auto i1 = Int4(edge_indices1+ne);
+                auto i2 = Int4(edge_indices2+ne);
+
+                auto t1 = Int4(types1.get(),i1);
+                auto t2 = Int4(types2.get(),i2);
+
+                auto interaction_offset = (t1*Int4(n_type2) + t2)*Int4(n_param);
+                const float* interaction_ptr[4] = {
+                    interaction_param+interaction_offset.x(),
+                    interaction_param+interaction_offset.y(),
+                    interaction_param+interaction_offset.z(),
+                    interaction_param+interaction_offset.w()};
+
+                auto coord1 = aligned_gather_vec<n_dim1>(pos1.get(),                 i1*Int4(n_dim1a));
+                auto coord2 = aligned_gather_vec<n_dim2>((symmetric?pos1:pos2).get(),i2*Int4(n_dim2a));
+
+                Vec<n_dim1,Float4> d1;
+                Vec<n_dim2,Float4> d2;
+
+                IType::compute_edge(d1,d2, interaction_ptr, coord1,coord2).store(edge_value+ne);
+                long long id_ed1 = (long long) ne * (long long) (n_dim1+n_dim2);
+                long long id_ed2 = id_ed1 + (long long) 4*n_dim1;
+                store_vec(edge_deriv + id_ed1, d1);
+                store_vec(edge_deriv + id_ed2, d2);
+
+                if(param_deriv) {
+                    for(int i: range(4)) {
+                        Vec<n_dim1> c1; for(int d: range(n_dim1)) c1[d] = extract_float(coord1[d],i);
+                        Vec<n_dim2> c2; for(int d: range(n_dim2)) c2[d] = extract_float(coord2[d],i);
+
+                        edge_param_deriv.push_back(make_zero<n_param>());
+                        IType::param_deriv(edge_param_deriv.back(), interaction_ptr[i], c1,c2);
+                    }
                 }
             }
-        }
+        });
     }
 
 
@@ -563,4 +774,7 @@ struct InteractionGraph{
         }
     }
 };
+
+template<typename IType>
+constexpr const int InteractionGraph<IType>::edge_block_size;
 #endif
@@ -143,6 +143,28 @@ vector<string> split_string(const string& src, const string& sep) {
     return ret;
 }
 
+// Output path of system ns when each system writes its own file: path without a .up or .h5
+// extension, followed by .sys{ns}.up
+static string per_system_output_path(const string& path, int ns) {
+    string stem = path;
+    for(string ext: {".up", ".h5"}) {
+        if(stem.size() > ext.size() && stem.compare(stem.size()-ext.size(), ext.size(), ext) == 0) {
+            stem.resize(stem.size()-ext.size());
+            break;
+        }
+    }
+    return stem + ".sys" + to_string(ns) + ".up";
+}
+
+// Absolute form of an existing path, or the path itself if it cannot be resolved
+static string absolute_path(const string& path) {
+    char* resolved = realpath(path.c_str(), nullptr);
+    if(!resolved) return path;
+    string ret(resolved);
+    free(resolved);
+    return ret;
+}
+
 
 struct ReplicaExchange {
     struct SwapPair {int sys1; int sys2; uint64_t n_attempt; uint64_t n_success; int set_id;};
@@ -423,6 +445,36 @@ vector<float> potential_deriv_agreement(DerivEngine& engine) {
     return relative_error;
 }
 
+// Write the records of a TimeKeeper as the datasets name, n_invoke and seconds (total) of grp,
+// in order of decreasing time
+static void write_profile_records(hid_t grp, const TimeKeeper& time_keeper) {
+    auto records = time_keeper.sorted_records();
+    if(records.empty()) return;
+
+    size_t name_size = 1;  // including the null terminator
+    for(auto& r: records) name_size = max(name_size, r.first.size()+1);
+
+    vector<char>   names(records.size()*name_size, '\0');
+    vector<long>   n_invoke;
+    vector<double> seconds;
+    for(size_t i=0; i<records.size(); ++i) {
+        copy(begin(records[i].first), end(records[i].first), names.begin() + i*name_size);
+        n_invoke.push_back(records[i].second.n_invoke);
+        seconds .push_back(records[i].second.total_elapsed);
+    }
+
+    auto name_type = h5_obj(H5Tclose, H5Tcopy(H5T_C_S1));
+    h5_noerr(H5Tset_size(name_type.get(), name_size));
+    h5_noerr(H5Tset_strpad(name_type.get(), H5T_STR_NULLTERM));
+
+    vector<hsize_t> dims = {H5S_UNLIMITED};
+    vector<hsize_t> chunk_dims = {hsize_t(records.size())};
+    append_to_dset(create_earray(grp, "name", name_type.get(), dims, chunk_dims).get(),
+            name_type.get(), records.size(), names.data(), 0);
+    append_to_dset(create_earray(grp, "n_invoke", H5T_NATIVE_LONG,   dims, chunk_dims).get(), n_invoke, 0);
+    append_to_dset(create_earray(grp, "seconds",  H5T_NATIVE_DOUBLE, dims, chunk_dims).get(), seconds,  0);
+}
+
 int upside_main(int argc, const char* const * argv, int verbose=1)
 try {
     using namespace TCLAP;  // Templatized C++ Command Line Parser (tclap.sourceforge.net)
@@ -489,12 +541,31 @@ try {
             "Use this option to control which Integrator are used.  Available levels are v(verlet) or mv(multi-step verlet). "
             "Default is verlet.",
             false, "", "v, mv ", cmd);
-    ValueArg<int> inner_step_arg("", "inner-step", "inner step for the integrator", false, 3, "int", cmd);
+    ValueArg<int> inner_step_arg("", "inner-step", "number of fast time steps per slow time step of the mv integrator.  "
+            "The potentials at integrator_level 1 are computed once per slow step (default 3)", false, 3, "int", cmd);
+    ValueArg<int> threads_per_system_arg("", "threads-per-system",
+            "number of OpenMP threads used to compute the forces of each system.  Independent nodes of the "
+            "computation graph and blocks of interaction graph edges run in parallel.  The default (0) divides "
+            "OMP_NUM_THREADS among the systems, so that a single system uses all of them.",
+            false, 0, "int", cmd);
+
+    SwitchArg profile_arg("", "profile",
+            "record the time spent in the compute_value and propagate_deriv of each node, along with the "
+            "finer timers within the nodes, and write it to /output/profile.  The timers add a small "
+            "overhead to each node evaluation.",
+            cmd, false);
 
     ValueArg<string> input_arg("i", "input", "h5df input file for position", false, "not_Defined_By_user", "string", cmd);
     ValueArg<string> input_base_arg("", "input-base", "h5df input files base for positions", false, "not_Defined_By_user", "string_list", cmd);
     ValueArg<string> output_arg("o", "output", "h5df output log file", false, "not_Defined_By_user", "string", cmd);
     ValueArg<string> output_base_arg("", "output-base", "the base name of h5df output log files.", false, "not_Defined_By_user", "string", cmd);
+    SwitchArg output_per_system_arg("", "output-per-system",
+            "write the output of each system N to its own file STEM.sys{N}.up, where STEM is the --output path, "
+            "or the path of the first configuration without --output, without its .up or .h5 extension.  "
+            "This is implied when a single --output path is given for several systems.  Each file has its own "
+            "HDF5 handle and writer thread.  merge_system_outputs.py combines the files into one view with "
+            "(n_frame, n_system, ...) arrays.",
+            cmd, false);
     SwitchArg disable_recenter_arg("", "disable-recentering", 
             "Disable all recentering of protein in the universe", 
             cmd, false);
@@ -513,6 +584,22 @@ try {
             "of the potential for the initial structure.  This may give strange answers for native structures "
             "(no steric clashes may given an agreement of NaN) or random structures (where bonds and angles are "
             "exactly at their equilibrium values).  Interpret these results at your own risk.", cmd, false);
+    ValueArg<float> pos_quantum_arg("", "pos-quantum",
+            "if positive, store /output/pos as 16-bit integers in units of this length (angstroms) relative "
+            "to the center of each frame, about half the size of the default 32-bit floats.  The centers and "
+            "units of the frames are stored in /output/pos_offset and /output/pos_scale, and the unit of a "
+            "frame is only larger than the quantum if the frame is wider than 65534 quanta.  A quantum of "
+            "0.01 keeps positions to within 0.005 angstroms.  The Python readers decode the positions "
+            "transparently.  Default 0 (32-bit floats).",
+            false, 0.f, "float", cmd);
+    ValueArg<double> output_buffer_mb_arg("", "output-buffer-mb",
+            "memory (MB) of the output samples of each system that may wait to be written.  A background "
+            "thread writes the output while the simulation continues, and the simulation only waits for the "
+            "disk when this much output is waiting.  Default 64.",
+            false, 64., "float", cmd);
+    SwitchArg sync_output_arg("", "sync-output",
+            "write the output from the simulation threads instead of a background thread",
+            cmd, false);
     SwitchArg record_momentum_arg("", "record-momentum",
             "record the momentum (so that the trajectory can be exactly restarted)"
             " the momentum will be recorded in output.mom ",
@@ -548,10 +635,18 @@ try {
         }
 
 
+        if(output_buffer_mb_arg.getValue() < 0.)
+            throw string("--output-buffer-mb must not be negative, but received " +
+                    to_string(output_buffer_mb_arg.getValue()));
+        if(pos_quantum_arg.getValue() < 0.f)
+            throw string("--pos-quantum must not be negative, but received " + to_string(pos_quantum_arg.getValue()));
+
         float dt = time_step_arg.getValue();
         int inner_step = 3;
         if  (integrator_arg.getValue() == "mv" )
             inner_step = inner_step_arg.getValue();
+        if(inner_step < 1)
+            throw string("--inner-step must be at least 1, but received " + to_string(inner_step));
 
         double duration = duration_arg.getValue();
         double time_lim = time_lim_arg.getValue();
@@ -626,6 +721,16 @@ try {
             for(int ns: range(systems.size())) 
                 outputs[ns] = output_strings.size()>1u ? output_strings[ns] : output_strings[0];
 
+            // several systems cannot share one output file
+            if(output_strings.size() == 1u && (systems.size() > 1u || output_per_system_arg.getValue()))
+                for(int ns: range(systems.size()))
+                    outputs[ns] = per_system_output_path(output_strings[0], ns);
+
+            user_defined_output = true;
+        }
+        else if(output_per_system_arg.getValue()) {
+            for(int ns: range(systems.size()))
+                outputs[ns] = per_system_output_path(config_paths[0], ns);
             user_defined_output = true;
         }
 
@@ -723,15 +828,28 @@ try {
             else if(log_level_arg.getValue() == "extensive") log_level = LOG_EXTENSIVE;
             else throw string("Illegal value for --log-level");
 
+            bool background_writer = !sync_output_arg.getValue();
+            size_t max_buffer_bytes = size_t(output_buffer_mb_arg.getValue()*(1<<20));
             if (user_defined_output) 
-                sys->logger = make_shared<H5Logger>(sys->output, "output", log_level);
+                sys->logger = make_shared<H5Logger>(sys->output, "output", log_level,
+                        background_writer, max_buffer_bytes);
             else
-                sys->logger = make_shared<H5Logger>(sys->config, "output", log_level);
+                sys->logger = make_shared<H5Logger>(sys->config, "output", log_level,
+                        background_writer, max_buffer_bytes);
 
             default_logger = sys->logger;  // FIXME kind of a hack for the ugly global variable
 
-            if (user_defined_output) 
+            if (user_defined_output) {
                 write_string_attribute(sys->output.get(), "output", "invocation", invocation);
+                // record where the output came from, so that the output files can be merged later
+                write_string_attribute(sys->output.get(), "output", "config", absolute_path(config_paths[ns]));
+                auto scalar_space = h5_obj(H5Sclose, H5Screate(H5S_SCALAR));
+                for(auto attr: {make_pair("system", ns), make_pair("n_system", n_system)}) {
+                    auto a = h5_obj(H5Aclose, H5Acreate_by_name(sys->output.get(), "output", attr.first,
+                                H5T_NATIVE_INT, scalar_space.get(), H5P_DEFAULT, H5P_DEFAULT, H5P_DEFAULT));
+                    h5_noerr(H5Awrite(a.get(), H5T_NATIVE_INT, &attr.second));
+                }
+            }
             else
                 write_string_attribute(sys->config.get(), "output", "invocation", invocation);
 
@@ -804,12 +922,16 @@ try {
 
 
             // we must capture the sys pointer by value here so that it is available later
-            sys->logger->add_logger<float>("pos", {1, sys->n_atom, 3}, [sys](float* pos_buffer) {
+            auto sample_pos = [sys](float* pos_buffer) {
                     VecArray pos_array = sys->engine.pos->output;
                     for(int na=0; na<sys->n_atom; ++na) 
                     for(int d=0; d<3; ++d) 
                     pos_buffer[na*3 + d] = pos_array(d,na);
-                    });
+                    };
+            if(pos_quantum_arg.getValue() > 0.f)
+                sys->logger->add_quantized_logger("pos", sys->n_atom, pos_quantum_arg.getValue(), std::move(sample_pos));
+            else
+                sys->logger->add_logger<float>("pos", {1, sys->n_atom, 3}, std::move(sample_pos));
             if (record_momentum_arg.getValue()) { // record the momentum if requested, with the same frequency as the position recording
                 sys->logger->add_logger<float>("mom", {1, sys->n_atom, 3}, [sys](float* mom_buffer) {
                         VecArray mom_array = sys->mom;
@@ -895,6 +1017,22 @@ try {
         }
         if(verbose) printf("\n");
 
+        int max_threads = 1;
+#ifdef _OPENMP
+        max_threads = omp_get_max_threads();
+#endif
+        int threads_per_system = threads_per_system_arg.getValue();
+        if(threads_per_system <= 0)
+            threads_per_system = max(1, max_threads/n_system);
+#ifdef _OPENMP
+        // the per-system thread teams are nested within the loop over systems
+        if(threads_per_system > 1 && n_system > 1)
+            omp_set_max_active_levels(2);
+#endif
+        for(System& sys: systems)
+            sys.engine.n_thread = threads_per_system;
+        if(verbose && threads_per_system > 1) printf("using %i threads per system\n\n", threads_per_system);
+
         if(verbose) printf("Initial potential energy:");
         for(System& sys: systems) {
             sys.engine.compute(PotentialAndDerivMode);
@@ -902,6 +1040,16 @@ try {
         }
         if(verbose) printf("\n");
 
+        // profile only the simulation itself
+        if(profile_arg.getValue()) {
+            global_time_keeper.records.clear();
+            global_time_keeper.enabled = true;
+            for(System& sys: systems) {
+                sys.engine.profile.records.clear();
+                sys.engine.profile.enabled = true;
+            }
+        }
+
 
         // Install signal handlers to dump state only when the simulation has really started.  This is intended to prevent
         // loss of buffered data and to present final statistics.  It is especially useful when being killed due to running 
@@ -914,7 +1062,7 @@ try {
         auto tstart = chrono::high_resolution_clock::now();
         while(systems[0].round_num < n_round && received_signal==NO_SIGNAL) {
             int last_start = systems[0].round_num;
-            #pragma omp parallel for schedule(static,1)
+            #pragma omp parallel for schedule(static,1) num_threads(max(1, min(n_system, max_threads/threads_per_system)))
             for(int ns=0; ns<int(systems.size()); ++ns) {
                 System& sys = systems[ns];
                 for(bool do_break=false; (!do_break) && (sys.round_num<n_round); ++sys.round_num) {
@@ -997,6 +1145,8 @@ try {
                 replex->attempt_swaps(base_random_seed, systems[0].round_num, systems, exchange_criterion);
 
         }
+        // time of the simulation loop alone, without the setup before it and the final flush
+        auto loop_elapsed = chrono::duration<double>(std::chrono::high_resolution_clock::now() - tstart).count();
 
 
 
@@ -1004,6 +1154,27 @@ try {
         if(passed_time_lim) {fprintf(stderr, "Passed time limit\n");}
         for(auto& sys: systems) sys.logger = shared_ptr<H5Logger>(); // release shared_ptr, which also flushes data during destructor
 
+        if(profile_arg.getValue()) {
+            // The node records belong to each system, but the finer timers are shared by all
+            // systems of the run
+            for(auto& sys: systems) {
+                auto output_group = open_group(user_defined_output ? sys.output.get() : sys.config.get(), "/output");
+                auto profile_group = ensure_group(output_group.get(), "profile");
+                write_profile_records(profile_group.get(), sys.engine.profile);
+                write_profile_records(ensure_group(profile_group.get(), "timers").get(), global_time_keeper);
+                write_string_attribute(profile_group.get(), ".", "description",
+                        "seconds spent in each node (NAME for compute_value, NAME_deriv for propagate_deriv); "
+                        "timers holds the finer timers, summed over all systems of the run");
+                auto n_round = h5_obj(H5Aclose, H5Acreate(profile_group.get(), "n_round", H5T_NATIVE_LONG,
+                            h5_obj(H5Sclose, H5Screate(H5S_SCALAR)).get(), H5P_DEFAULT, H5P_DEFAULT));
+                long n_round_value = sys.round_num;
+                h5_noerr(H5Awrite(n_round.get(), H5T_NATIVE_LONG, &n_round_value));
+                auto loop_seconds = h5_obj(H5Aclose, H5Acreate(profile_group.get(), "loop_seconds", H5T_NATIVE_DOUBLE,
+                            h5_obj(H5Sclose, H5Screate(H5S_SCALAR)).get(), H5P_DEFAULT, H5P_DEFAULT));
+                h5_noerr(H5Awrite(loop_seconds.get(), H5T_NATIVE_DOUBLE, &loop_elapsed));
+            }
+        }
+
         auto elapsed = chrono::duration<double>(std::chrono::high_resolution_clock::now() - tstart).count();
         if(verbose)
             printf("\n\nfinished in %.1f seconds (%.2f us/systems/step, %.1e simulation_time_unit/hour)\n",
@@ -1070,13 +1241,15 @@ try {
             }
         } catch(...) {}  // stats reporting is optional
 
-#ifdef COLLECT_PROFILE
-        if(verbose) {
+        if(verbose && global_time_keeper.enabled) {
             printf("\n");
             global_time_keeper.print_report(inner_step*systems[0].round_num+1); //  FIXME inner_step
             printf("\n");
+            if(systems[0].engine.profile.enabled) {
+                systems[0].engine.profile.print_report(inner_step*systems[0].round_num+1);
+                printf("\n");
+            }
         }
-#endif
     } catch(const string &e) {
         fprintf(stderr, "\n\nERROR: %s\n", e.c_str());
         return 1;
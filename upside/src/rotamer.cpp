@@ -203,6 +203,18 @@ struct EdgeLocator {
             resize(2*data_size);
             return find_or_insert(result, i1,i2);
         }
+
+        int32_t find(int32_t i1, int32_t i2) const {
+            // return value is -1 if the pair is not present
+            const int* partner_array = locs + int(i1*data_size);
+            for(int j=0; j<data_size; j+=8) {
+                for(int k=0; k<4; ++k) {
+                    if(partner_array[j+k] == i2) return partner_array[j+4+k];
+                    if(partner_array[j+k] == -1) return -1;
+                }
+            }
+            return -1;
+        }
 };
 
 
@@ -344,19 +356,27 @@ struct EdgeHolder {
         // unordered_map<unsigned,unsigned> nodes_to_edge;
         EdgeLocator nodes_to_edge;
         vector<EdgeLoc> edge_loc;
+        int max_n_edge;  // capacity, which grows when more edges are inserted
+        constexpr static const int edge_block_size = 256;  // edges per task, which must be even
 
-        EdgeHolder(NodeHolder &nodes1_, NodeHolder &nodes2_, int max_n_edge):
+        // beliefs of the previous solve for warm starts
+        vector<int>   saved_indices1;
+        vector<int>   saved_indices2;
+        vector<float> saved_belief;
+
+        EdgeHolder(NodeHolder &nodes1_, NodeHolder &nodes2_, int max_n_edge_):
             n_rot1(nodes1_.n_rot), n_rot2(nodes2_.n_rot),
             nodes1(nodes1_), nodes2(nodes2_),
-            prob      (n_rot1*ru(n_rot2),     max_n_edge+3),
-            cur_belief(ru(n_rot1)+ru(n_rot2), max_n_edge+3),
-            old_belief(ru(n_rot1)+ru(n_rot2), max_n_edge+3),
-            marginal(n_rot1*n_rot2,           max_n_edge+3), // the +1 ensures we can write past the end
+            prob      (n_rot1*ru(n_rot2),     max_n_edge_+3),
+            cur_belief(ru(n_rot1)+ru(n_rot2), max_n_edge_+3),
+            old_belief(ru(n_rot1)+ru(n_rot2), max_n_edge_+3),
+            marginal(n_rot1*n_rot2,           max_n_edge_+3), // the +1 ensures we can write past the end
 
-            edge_indices1(new_aligned<int>(max_n_edge,simd_width)),
-            edge_indices2(new_aligned<int>(max_n_edge,simd_width)),
+            edge_indices1(new_aligned<int>(max_n_edge_,simd_width)),
+            edge_indices2(new_aligned<int>(max_n_edge_,simd_width)),
 
-            nodes_to_edge(nodes1.n_elem)
+            nodes_to_edge(nodes1.n_elem),
+            max_n_edge(max_n_edge_)
         {
 
             edge_loc.reserve(n_rot1*n_rot2*max_n_edge);
@@ -380,12 +400,63 @@ struct EdgeHolder {
         }
         void swap_beliefs() { swap(cur_belief, old_belief); }
 
+        void save_beliefs() {
+            // keep the final beliefs by node pair, since the edge numbering changes between solves
+            int n_edge = nodes_to_edge.n_edge;
+            saved_indices1.assign(edge_indices1.get(), edge_indices1.get()+n_edge);
+            saved_indices2.assign(edge_indices2.get(), edge_indices2.get()+n_edge);
+            saved_belief.assign(cur_belief.x.get(), cur_belief.x.get()+n_edge*cur_belief.row_width);
+        }
+
+        int restore_beliefs() {
+            // overwrite the old beliefs of the edges that were present at the last save_beliefs
+            // and return the number of edges restored
+            int w = old_belief.row_width;
+            int n_restored = 0;
+            for(int i: range(saved_indices1.size())) {
+                int ne = nodes_to_edge.find(saved_indices1[i], saved_indices2[i]);
+                if(ne<0) continue;
+                std::copy_n(saved_belief.data()+i*w, w, old_belief.x.get()+ne*w);
+                ++n_restored;
+            }
+            return n_restored;
+        }
+
+        void grow(int new_max_n_edge) {
+            // Copy the existing edges into larger arrays.  New edges start with unit probability,
+            // matching the state left by reset().
+            auto grow_storage = [&](VecArrayStorage& a) {
+                VecArrayStorage b(a.row_width, new_max_n_edge+3);
+                std::copy_n(a.x.get(), a.n_elem*a.row_width, b.x.get());
+                swap(a.x, b.x);
+                a.n_elem = b.n_elem;
+            };
+            int old_max_n_edge = max_n_edge;
+            grow_storage(prob);
+            grow_storage(cur_belief);
+            grow_storage(old_belief);
+            grow_storage(marginal);
+            for(int idx=old_max_n_edge; idx<new_max_n_edge; ++idx)
+                for(int i: range(n_rot1))
+                    for(int j: range(n_rot2))
+                        prob(i*ru(n_rot2)+j,idx) = 1.f;
+
+            for(auto a: {&edge_indices1, &edge_indices2}) {
+                auto b = new_aligned<int>(new_max_n_edge,simd_width);
+                fill_n(b, round_up(new_max_n_edge,simd_width), 0);
+                std::copy_n(a->get(), old_max_n_edge, b.get());
+                swap(*a, b);
+            }
+            max_n_edge = new_max_n_edge;
+        }
+
         void add_to_edge(
                 int ne, float prob_val,
                 unsigned id1, unsigned rot1, 
                 unsigned id2, unsigned rot2) {
             int32_t idx;
             if(nodes_to_edge.find_or_insert(idx,id1,id2)){
+                if(idx >= max_n_edge) grow(max(2*max_n_edge,16));
                 edge_indices1[idx] = id1;
                 edge_indices2[idx] = id2;
             }
@@ -512,23 +583,37 @@ struct EdgeHolder {
 
                 int n_edge = nodes_to_edge.n_edge;
 
-                for(int ne=0; ne<n_edge; ++ne) {
-                    int i1 = edge_indices1[ne]*4*w1;
-                    int i2 = edge_indices2[ne]*4*w2;
+                // The edge beliefs only depend on the old beliefs, so they are computed in blocks of
+                // edges (as tasks when running with several threads)
+                for_each_block(n_edge, edge_block_size, [&](int start, int stop) {
+                    for(int ne=start; ne<stop; ++ne) {
+                        int i1 = edge_indices1[ne]*4*w1;
+                        int i2 = edge_indices2[ne]*4*w2;
 
-                    auto old_edge_belief1 = read4vec<w1>(old_belief.x + ne*4*ws + 0);
-                    auto old_edge_belief2 = read4vec<w2>(old_belief.x + ne*4*ws + 4*w1);
+                        auto old_edge_belief1 = read4vec<w1>(old_belief.x + ne*4*ws + 0);
+                        auto old_edge_belief2 = read4vec<w2>(old_belief.x + ne*4*ws + 4*w1);
 
-                    auto old_node_belief1 = read4vec<w1>(vec_old_node_belief1 + i1);
-                    auto old_node_belief2 = read4vec<w2>(vec_old_node_belief2 + i2);
+                        auto old_node_belief1 = read4vec<w1>(vec_old_node_belief1 + i1);
+                        auto old_node_belief2 = read4vec<w2>(vec_old_node_belief2 + i2);
 
-                    auto v1 = old_node_belief1 * vec_rcp(Float4(1e-10f) + old_edge_belief1);
-                    auto v2 = old_node_belief2 * vec_rcp(Float4(1e-10f) + old_edge_belief2);
+                        auto v1 = old_node_belief1 * vec_rcp(Float4(1e-10f) + old_edge_belief1);
+                        auto v2 = old_node_belief2 * vec_rcp(Float4(1e-10f) + old_edge_belief2);
 
-                    // load the edge probability matrix
-                    auto eprob = PaddedMatrix<N_ROT1,N_ROT2>(prob.x + ne*N_ROT1*4*w2);
-                    auto cur_edge_belief1 = eprob.apply_left (v2);
-                    auto cur_edge_belief2 = eprob.apply_right(v1);
+                        // load the edge probability matrix
+                        auto eprob = PaddedMatrix<N_ROT1,N_ROT2>(prob.x + ne*N_ROT1*4*w2);
+                        store4vec<w1>(cur_belief.x + ne*4*ws + 0,    eprob.apply_left (v2));
+                        store4vec<w2>(cur_belief.x + ne*4*ws + 4*w1, eprob.apply_right(v1));
+                    }
+                });
+
+                // Each node belief is a product over the edges of the node, so the products are
+                // accumulated serially
+                for(int ne=0; ne<n_edge; ++ne) {
+                    int i1 = edge_indices1[ne]*4*w1;
+                    int i2 = edge_indices2[ne]*4*w2;
+
+                    auto cur_edge_belief1 = read4vec<w1>(cur_belief.x + ne*4*ws + 0);
+                    auto cur_edge_belief2 = read4vec<w2>(cur_belief.x + ne*4*ws + 4*w1);
 
                     auto cur_node_belief1 = cur_edge_belief1 * read4vec<w1>(vec_cur_node_belief1 + i1);
                     auto cur_node_belief2 = cur_edge_belief2 * read4vec<w2>(vec_cur_node_belief2 + i2);
@@ -539,8 +624,6 @@ struct EdgeHolder {
                     cur_node_belief1 *= rcp(sum(cur_node_belief1).sum_in_all_entries());
                     cur_node_belief2 *= rcp(sum(cur_node_belief2).sum_in_all_entries());
 
-                    store4vec<w1>(cur_belief.x + ne*4*ws + 0,    cur_edge_belief1);
-                    store4vec<w2>(cur_belief.x + ne*4*ws + 4*w1, cur_edge_belief2);
                     store4vec<w1>(vec_cur_node_belief1 + i1,     cur_node_belief1);
                     store4vec<w2>(vec_cur_node_belief2 + i2,     cur_node_belief2);
                 }
@@ -550,22 +633,24 @@ struct EdgeHolder {
                 // middle of the algorithm.  The hope is that the processor will expose much more instruction
                 // parallelism in this loop.  The loop process 2 edges at a time to fully utilize the horizontal
                 // adds.
-                for(int ne=0; ne<n_edge; ne+=2) {
-                    auto cb11 = read4vec<w1>(cur_belief.x + ne*4*ws + 0);
-                    auto cb12 = read4vec<w2>(cur_belief.x + ne*4*ws + 4*w1);
-                    auto cb21 = read4vec<w1>(cur_belief.x + ne*4*ws + 4*ws);
-                    auto cb22 = read4vec<w2>(cur_belief.x + ne*4*ws + 4*(ws+w1));
-
-                    // let's approximately l1 normalize everything edges to avoid any numerical problems later
-                    Float4 scales_for_unit_l1 = approx_rcp(horizontal_add(
-                                horizontal_add(sum(cb11), sum(cb12)),
-                                horizontal_add(sum(cb21), sum(cb22))));
-
-                    store4vec<w1>(cur_belief.x + ne*4*ws + 0,         cb11*scales_for_unit_l1.broadcast<0>());
-                    store4vec<w2>(cur_belief.x + ne*4*ws + 4*w1,      cb12*scales_for_unit_l1.broadcast<1>());
-                    store4vec<w1>(cur_belief.x + ne*4*ws + 4*ws,      cb21*scales_for_unit_l1.broadcast<2>());
-                    store4vec<w2>(cur_belief.x + ne*4*ws + 4*(ws+w1), cb22*scales_for_unit_l1.broadcast<3>());
-                }
+                for_each_block(n_edge, edge_block_size, [&](int start, int stop) {
+                    for(int ne=start; ne<stop; ne+=2) {
+                        auto cb11 = read4vec<w1>(cur_belief.x + ne*4*ws + 0);
+                        auto cb12 = read4vec<w2>(cur_belief.x + ne*4*ws + 4*w1);
+                        auto cb21 = read4vec<w1>(cur_belief.x + ne*4*ws + 4*ws);
+                        auto cb22 = read4vec<w2>(cur_belief.x + ne*4*ws + 4*(ws+w1));
+
+                        // let's approximately l1 normalize everything edges to avoid any numerical problems later
+                        Float4 scales_for_unit_l1 = approx_rcp(horizontal_add(
+                                    horizontal_add(sum(cb11), sum(cb12)),
+                                    horizontal_add(sum(cb21), sum(cb22))));
+
+                        store4vec<w1>(cur_belief.x + ne*4*ws + 0,         cb11*scales_for_unit_l1.broadcast<0>());
+                        store4vec<w2>(cur_belief.x + ne*4*ws + 4*w1,      cb12*scales_for_unit_l1.broadcast<1>());
+                        store4vec<w1>(cur_belief.x + ne*4*ws + 4*ws,      cb21*scales_for_unit_l1.broadcast<2>());
+                        store4vec<w2>(cur_belief.x + ne*4*ws + 4*(ws+w1), cb22*scales_for_unit_l1.broadcast<3>());
+                    }
+                });
             }
 };
 
@@ -647,10 +732,16 @@ struct RotamerSidechain: public PotentialNode {
     int   max_iter;
     float tol;
     int   iteration_chunk_size;
+    float max_damping;  // damping is raised toward max_damping while the residual grows
+    bool  warm_start;   // start from the beliefs of the previous solve
 
     bool energy_fresh_relative_to_derivative;
+    bool have_saved_beliefs;
 
     long n_bad_solve;
+    long n_solve;
+    long n_iter_cumulative;
+    int  last_n_iter;
 
     RotamerSidechain(hid_t grp, CoordNode &pos_node_, vector<CoordNode*> prob_nodes_):
         PotentialNode(),
@@ -682,15 +773,27 @@ struct RotamerSidechain: public PotentialNode {
         max_iter(read_attribute<int  >(grp, ".", "max_iter")),
         tol     (read_attribute<float>(grp, ".", "tol")),
         iteration_chunk_size(read_attribute<int>(grp, ".", "iteration_chunk_size")),
+        max_damping(max(damping, read_attribute<float>(grp, ".", "max_damping", damping))),
+        warm_start(read_attribute<int>(grp, ".", "warm_start", 0)),
 
         energy_fresh_relative_to_derivative(false),
-        n_bad_solve(0)
+        have_saved_beliefs(false),
+        n_bad_solve(0),
+        n_solve(0),
+        n_iter_cumulative(0),
+        last_n_iter(0)
     {
         for(int i: range(UPPER_ROT)) node_holders_matrix[i] = nullptr;
         node_holders_matrix[1] = &nodes1;
         node_holders_matrix[3] = &nodes3;
         node_holders_matrix[6] = &nodes6;
 
+        // the solver divides by 1-damping, so a damping of 1 or more would never converge
+        if(!(0.f<=damping && damping<1.f))
+            throw string("rotamer damping must be in [0,1) but is ") + to_string(damping);
+        if(!(max_damping<1.f))
+            throw string("rotamer max_damping must be less than 1 but is ") + to_string(max_damping);
+
         for(int i: range(UPPER_ROT)) for(int j: range(UPPER_ROT)) edge_holders_matrix[i][j] = nullptr;
         edge_holders_matrix[1][1] = &edges11;
         edge_holders_matrix[1][3] = &edges13;
@@ -709,6 +812,14 @@ struct RotamerSidechain: public PotentialNode {
             default_logger->add_logger<long>("rotamer_bad_solves_cumulative", {1},
                     [&](long* buffer) {buffer[0]=n_bad_solve;});
 
+        // iterations of the last solve, then the cumulative iterations and solves
+        if(logging(LOG_DETAILED))
+            default_logger->add_logger<long>("rotamer_solve_iterations", {3},
+                    [&](long* buffer) {
+                        buffer[0] = last_n_iter;
+                        buffer[1] = n_iter_cumulative;
+                        buffer[2] = n_solve;});
+
         if(logging(LOG_DETAILED)) {
             default_logger->add_logger<float>("rotamer_free_energy", {nodes1.n_elem+nodes3.n_elem+nodes6.n_elem}, 
                     [&](float* buffer) {
@@ -750,8 +861,6 @@ struct RotamerSidechain: public PotentialNode {
             }
 
             return result;
-        } else if(!strcmp(log_name, "count_edges_by_type")) {
-            return igraph.count_edges_by_type();
         } else if(!strcmp(log_name, "n_node")) {
             vector<float> ret(1, float(n_node));
             return ret;
@@ -828,8 +937,10 @@ struct RotamerSidechain: public PotentialNode {
             vector<float> ret(1, float(n_bad_solve));
             n_bad_solve = 0;
             return ret;
+        } else if(!strcmp(log_name, "read solve iterations")) {
+            return vector<float>{float(last_n_iter), float(n_iter_cumulative), float(n_solve)};
         } else {
-            throw string("Value ") + log_name + string(" not implemented");
+            return igraph.get_value_by_name(log_name);
         }
     }
 
@@ -844,6 +955,9 @@ struct RotamerSidechain: public PotentialNode {
         auto solve_results = solve_for_marginals();
         if(solve_results.first >= max_iter - iteration_chunk_size - 1)
             n_bad_solve++;
+        last_n_iter = solve_results.first;
+        n_iter_cumulative += solve_results.first;
+        n_solve++;
 
         propagate_derivatives();
         if(mode==PotentialAndDerivMode) potential = calculate_energy_from_marginals();
@@ -1105,13 +1219,15 @@ struct RotamerSidechain: public PotentialNode {
 
     pair<int,float> solve_for_marginals() {
         Timer timer(std::string("rotamer_solve"));
-        // first initialize old node beliefs to just be probability
+        // first initialize old node beliefs to just be probability, or to the marginals of the
+        // previous solve for a warm start
         // this may affect the final answer since belief propagation is minimizing a non-convex function
+        bool warm = warm_start && have_saved_beliefs;
         for(auto nh: node_holders_matrix)
             if(nh)
                 for(int no: range(nh->n_rot))
                     for(int ne: range(nh->n_elem))
-                        nh->old_belief(no,ne) = nh->prob(no,ne);
+                        nh->old_belief(no,ne) = warm && nh->n_rot>1 ? nh->cur_belief(no,ne) : nh->prob(no,ne);
 
         alignas(16) float start_belief3 [4] = {1.f,1.f,1.f,0.f}; auto sb3  = Float4(start_belief3);
         alignas(16) float start_belief6a[4] = {1.f,1.f,1.f,1.f}; auto sb6a = Float4(start_belief6a);
@@ -1131,9 +1247,16 @@ struct RotamerSidechain: public PotentialNode {
             sb6a.store(edges66.old_belief.x+ne*16+ 8);
             sb6b.store(edges66.old_belief.x+ne*16+12);
         }
+        if(warm) {
+            // edges that are new since the last solve keep the start beliefs
+            edges33.restore_beliefs();
+            edges36.restore_beliefs();
+            edges66.restore_beliefs();
+        }
 
         calculate_new_beliefs(0.f, true);
         float max_deviation = 1e10f;
+        float damping_now = damping;
         int iter = 0;
 
         for(; max_deviation>tol && iter<max_iter; iter+=iteration_chunk_size) {
@@ -1143,12 +1266,24 @@ struct RotamerSidechain: public PotentialNode {
                 edges33.swap_beliefs();
                 edges36.swap_beliefs();
                 edges66.swap_beliefs();
-                calculate_new_beliefs(damping);
+                calculate_new_beliefs(damping_now);
             }
 
             // compute max deviation
             // printf("(%i,%.3f,%.3f)\n", iter, nodes3.max_deviation(), nodes6.max_deviation());
-            max_deviation = max(nodes3.max_deviation(), nodes6.max_deviation());
+            // The change in each iteration is proportional to 1-damping, so the deviation is
+            // rescaled to the configured damping to keep the same tolerance while damping is adjusted
+            float last_deviation = max_deviation;
+            max_deviation = max(nodes3.max_deviation(), nodes6.max_deviation()) *
+                (1.f-damping) * rcp(1.f-damping_now);
+
+            if(max_damping > damping) {
+                // a growing residual indicates oscillation, which more damping suppresses; otherwise
+                // the damping relaxes back to the configured value
+                damping_now = max_deviation > last_deviation
+                    ? 0.5f*(damping_now + max_damping)
+                    : damping + 0.5f*(damping_now - damping);
+            }
         }
 
         nodes1 .calculate_marginals<1>  ();
@@ -1158,6 +1293,14 @@ struct RotamerSidechain: public PotentialNode {
         edges33.calculate_marginals<3,3>();
         edges36.calculate_marginals<3,6>();
         edges66.calculate_marginals<6,6>();
+
+        if(warm_start) {
+            // a failed solve is not a useful starting point
+            have_saved_beliefs = std::isfinite(max_deviation);
+            edges33.save_beliefs();
+            edges36.save_beliefs();
+            edges66.save_beliefs();
+        }
         return make_pair(iter, max_deviation);
     }
 
@@ -101,6 +101,10 @@ struct SidechainRadialPairs : public PotentialNode
                 potential += igraph.edge_value[ne];
         }
     }
+
+    virtual std::vector<float> get_value_by_name(const char* log_name) override {
+        return igraph.get_value_by_name(log_name);
+    }
 };
 
 struct HBondSidechainRadialPairs : public PotentialNode
@@ -132,6 +136,10 @@ struct HBondSidechainRadialPairs : public PotentialNode
     virtual std::vector<float> get_param_deriv() override {return igraph.get_param_deriv();}
 #endif
     virtual void set_param(const std::vector<float>& new_param) override {igraph.set_param(new_param);}
+
+    virtual std::vector<float> get_value_by_name(const char* log_name) override {
+        return igraph.get_value_by_name(log_name);
+    }
 };
 
 template <bool is_symmetric>
@@ -204,6 +212,10 @@ struct SymmContactNListEnergy : public PotentialNode
     virtual std::vector<float> get_param_deriv() override {return igraph.get_param_deriv();}
 #endif
     virtual void set_param(const std::vector<float>& new_param) override {igraph.set_param(new_param);}
+
+    virtual std::vector<float> get_value_by_name(const char* log_name) override {
+        return igraph.get_value_by_name(log_name);
+    }
 };
 
 struct NoSymmContactNListEnergy : public PotentialNode
@@ -229,6 +241,10 @@ struct NoSymmContactNListEnergy : public PotentialNode
     virtual std::vector<float> get_param_deriv() override {return igraph.get_param_deriv();}
 #endif
     virtual void set_param(const std::vector<float>& new_param) override {igraph.set_param(new_param);}
+
+    virtual std::vector<float> get_value_by_name(const char* log_name) override {
+        return igraph.get_value_by_name(log_name);
+    }
 };
 
 struct WallSpring : public PotentialNode
@@ -1,3 +1,4 @@
 #include "state_logger.h"
 
 std::shared_ptr<H5Logger> default_logger;
+std::mutex hdf5_write_mutex;
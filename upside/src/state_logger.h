@@ -5,11 +5,25 @@
 #include "h5_support.h"
 #include <initializer_list>
 #include <memory>
+#include <cmath>
+#include <limits>
+#include <thread>
+#include <mutex>
+#include <condition_variable>
 #include "timing.h"
 
+// HDF5 is often built non-thread-safe, so every write by a logger holds this lock
+extern std::mutex hdf5_write_mutex;
+
+// Each logger has two buffers.  The integration loop collects samples into the collect buffer,
+// swap_buffers moves them to the write buffer (which must be empty), and write_samples appends
+// the write buffer to the dataset, possibly from another thread.
 struct SingleLogger {
     virtual void collect_samples() = 0;
-    virtual void dump_samples   () = 0;
+    virtual void swap_buffers   () = 0;
+    virtual void write_samples  () = 0;
+    virtual size_t collected_bytes() const = 0;
+    void dump_samples() {swap_buffers(); write_samples();}
     virtual ~SingleLogger() {};
 };
 
@@ -19,6 +33,7 @@ struct SpecializedSingleLogger: public SingleLogger {
     h5::H5Obj data_set;
     std::vector<hsize_t> dims;
     std::vector<T> data_buffer;
+    std::vector<T> write_buffer;
     F sample_function;
     hsize_t row_size;
 
@@ -43,9 +58,18 @@ struct SpecializedSingleLogger: public SingleLogger {
         sample_function(current_data);
     }
 
-    virtual void dump_samples() {
-        if(data_buffer.size()) h5::append_to_dset(data_set.get(), data_buffer, 0);
-        data_buffer.resize(0);
+    virtual void swap_buffers() {
+        // the empty write buffer keeps its capacity, so the buffers are only allocated once
+        std::swap(data_buffer, write_buffer);
+    }
+
+    virtual void write_samples() {
+        if(write_buffer.size()) h5::append_to_dset(data_set.get(), write_buffer, 0);
+        write_buffer.resize(0);
+    }
+
+    virtual size_t collected_bytes() const {
+        return data_buffer.size()*sizeof(T);
     }
 
     virtual ~SpecializedSingleLogger() {
@@ -53,6 +77,51 @@ struct SpecializedSingleLogger: public SingleLogger {
     }
 };
 
+// Fixed-point encoding of one frame of n_elem 3-vectors as int16 values q, where the decoded
+// value is offset[d] + scale*q.  The offset is the center of the bounding box of the frame.  The
+// scale is the requested quantum unless the frame is too wide for the int16 range at that quantum,
+// in which case it is widened just enough to hold the frame.  Values that are not finite are
+// stored as missing.
+struct QuantizedFrame {
+    static const int16_t missing = std::numeric_limits<int16_t>::min();
+    float quantum;
+    std::vector<float> values;  // (n_elem,3) values of the current frame
+    float offset[3];
+    float scale;
+
+    QuantizedFrame(int n_elem, float quantum_):
+        quantum(quantum_), values(n_elem*3, 0.f), offset{0.f,0.f,0.f}, scale(quantum_) {}
+
+    void encode(int16_t* q) {
+        int n_elem = values.size()/3;
+        float lo[3], hi[3];
+        for(int d=0; d<3; ++d) {lo[d] = std::numeric_limits<float>::infinity(); hi[d] = -lo[d];}
+        for(int ne=0; ne<n_elem; ++ne) {
+            for(int d=0; d<3; ++d) {
+                float x = values[ne*3+d];
+                if(std::isfinite(x)) {lo[d] = std::min(lo[d],x); hi[d] = std::max(hi[d],x);}
+            }
+        }
+
+        float half_span = 0.f;
+        for(int d=0; d<3; ++d) {
+            if(lo[d] > hi[d]) lo[d] = hi[d] = 0.f;  // no finite values
+            offset[d] = 0.5f*(lo[d]+hi[d]);
+            half_span = std::max(half_span, 0.5f*(hi[d]-lo[d]));
+        }
+        // leave a margin of one quantum for the rounding of the offset
+        scale = std::max(quantum, half_span/(std::numeric_limits<int16_t>::max()-1));
+
+        float inv_scale = 1.f/scale;
+        for(int ne=0; ne<n_elem; ++ne) {
+            for(int d=0; d<3; ++d) {
+                float x = values[ne*3+d];
+                q[ne*3+d] = std::isfinite(x) ? int16_t(lrintf((x-offset[d])*inv_scale)) : missing;
+            }
+        }
+    }
+};
+
 enum LogLevel : int {
     // LOG_BASIC just logs regular simulation output, like position, time, and kinetic energy
     LOG_BASIC     = 0,
@@ -65,6 +134,11 @@ enum LogLevel : int {
     LOG_EXTENSIVE = 2
 };
 
+// The samples are handed to the writer every flush_interval samples.  With a background writer,
+// a thread writes the handed-off samples to HDF5 while the integration loop collects the next
+// ones, so the loop only waits for the disk when the collected samples reach max_buffer_bytes
+// before the writer has finished.  The memory of the buffered samples is at most about twice
+// max_buffer_bytes.  Without a background writer, the loop writes the samples itself.
 struct H5Logger {
     LogLevel  level;
     h5::H5Obj config;
@@ -72,14 +146,30 @@ struct H5Logger {
     std::vector<std::unique_ptr<SingleLogger>> state_loggers;
     std::vector<std::unique_ptr<SingleLogger>> state_dense_loggers;
     size_t n_samples_buffered;
+    size_t flush_interval;
+
+    bool   background_writer;
+    size_t max_buffer_bytes;
+    std::thread writer;
+    std::mutex  writer_mutex;
+    std::condition_variable writer_cv;
+    bool write_pending;  // the write buffers hold samples that the writer has not written
+    bool stop_writer;
+    std::string writer_error;
 
     // H5Logger(): level(LOG_BASIC), config(0u), logging_group(0u), n_samples_buffered(0u) {}
 
-    H5Logger(h5::H5Obj& config_, const char* loc, LogLevel level_): 
+    H5Logger(h5::H5Obj& config_, const char* loc, LogLevel level_,
+            bool background_writer_ = true, size_t max_buffer_bytes_ = size_t(64)<<20): 
         level(level_),
         config(h5::duplicate_obj(config_)),
         logging_group(h5::ensure_group(config.get(), loc)),
-        n_samples_buffered(0u)
+        n_samples_buffered(0u),
+        flush_interval(100u),
+        background_writer(background_writer_),
+        max_buffer_bytes(max_buffer_bytes_),
+        write_pending(false),
+        stop_writer(false)
     {}
 
     void collect_samples() {
@@ -88,7 +178,16 @@ struct H5Logger {
             sl->collect_samples();
 
         n_samples_buffered++;
-        if(!(n_samples_buffered % 100)) flush();
+        bool full = collected_bytes() >= max_buffer_bytes;
+        if(n_samples_buffered >= flush_interval || full) {
+            if(!background_writer) {
+                flush();
+            } else if(!hand_off(false) && full) {
+                // the writer is behind and the buffer is full, so the loop must wait for the disk
+                Timer wait_timer(std::string("logger_backpressure"));
+                hand_off(true);
+            }
+        }
     }
 
     void collect_dense_samples() {
@@ -97,18 +196,86 @@ struct H5Logger {
             sl->collect_samples();
     }
 
+    size_t collected_bytes() const {
+        size_t n_bytes = 0u;
+        for(auto &sl: state_loggers)       n_bytes += sl->collected_bytes();
+        for(auto &sl: state_dense_loggers) n_bytes += sl->collected_bytes();
+        return n_bytes;
+    }
+
+    // Hand the collected samples to the writer thread if it is idle (or after waiting for it if
+    // wait is true).  Returns true if the samples were handed off.
+    bool hand_off(bool wait) {
+        std::unique_lock<std::mutex> lock(writer_mutex, std::defer_lock);
+        if(wait) {
+            lock.lock();
+            writer_cv.wait(lock, [&]{return !write_pending;});
+        } else if(!lock.try_lock() || write_pending) {
+            return false;
+        }
+        if(writer_error.size()) throw writer_error;
+
+        if(!writer.joinable()) writer = std::thread(&H5Logger::write_loop, this);
+        swap_buffers();
+        write_pending = true;
+        lock.unlock();
+        writer_cv.notify_all();
+        return true;
+    }
+
+    void swap_buffers() {
+        for(auto &sl: state_loggers)       sl->swap_buffers();
+        for(auto &sl: state_dense_loggers) sl->swap_buffers();
+        n_samples_buffered = 0u;
+    }
+
+    void write_samples() {
+        std::lock_guard<std::mutex> hdf5_lock(hdf5_write_mutex);
+        for(auto &sl: state_loggers) 
+            sl->write_samples();
+        for(auto &sl: state_dense_loggers) 
+            sl->write_samples();
+        H5Fflush(config.get(), H5F_SCOPE_LOCAL);
+    }
+
+    void write_loop() {
+        std::unique_lock<std::mutex> lock(writer_mutex);
+        while(true) {
+            writer_cv.wait(lock, [&]{return write_pending || stop_writer;});
+            if(!write_pending) break;
+
+            lock.unlock();
+            std::string error;
+            try {
+                Timer timer(std::string("logger_write"));
+                write_samples();
+            } catch(const std::string& e) {
+                error = e;
+            } catch(...) {
+                error = "unknown error while writing the output";
+            }
+            lock.lock();
+
+            if(error.size() && writer_error.empty()) writer_error = error;
+            write_pending = false;
+            writer_cv.notify_all();
+        }
+    }
+
+    // Write all collected samples and wait until they are on disk
     void flush() {
-        // HDF5 is often built non-thread-safe, so we must serialize access with a OpenMP critical section
-        #pragma omp critical (hdf5_write_access)
-        {
-            if(n_samples_buffered) {
-                for(auto &sl: state_loggers) 
-                    sl->dump_samples();
-                for(auto &sl: state_dense_loggers) 
-                    sl->dump_samples();
-                n_samples_buffered = 0u;
-                H5Fflush(config.get(), H5F_SCOPE_LOCAL);
+        if(background_writer && writer.joinable()) {
+            {
+                std::unique_lock<std::mutex> lock(writer_mutex);
+                writer_cv.wait(lock, [&]{return !write_pending;});
             }
+            if(n_samples_buffered) hand_off(true);
+            std::unique_lock<std::mutex> lock(writer_mutex);
+            writer_cv.wait(lock, [&]{return !write_pending;});
+            if(writer_error.size()) throw writer_error;
+        } else if(n_samples_buffered) {
+            swap_buffers();
+            write_samples();
         }
     }
 
@@ -132,6 +299,36 @@ struct H5Logger {
         state_dense_loggers.emplace_back(std::move(logger));
     }
 
+    // Log an (n_elem,3) float array as int16 values (see QuantizedFrame) at relative_path, along
+    // with the offset of each frame at relative_path_offset and its scale at relative_path_scale.
+    // The datasets have the same leading frame and system axes as a float logger of shape
+    // {1,n_elem,3}.  The attributes of the int16 dataset record the encoding and the quantum.
+    template <typename F>
+    void add_quantized_logger(
+            const char* relative_path,
+            int n_elem,
+            float quantum,
+            const F&& sample_function) {
+        if(!(quantum > 0.f)) throw std::string("quantum of a quantized logger must be positive");
+        auto frame = std::make_shared<QuantizedFrame>(n_elem, quantum);
+        std::string path(relative_path);
+
+        // the loggers collect in order, so the offset and scale loggers see the frame just encoded
+        add_logger<int16_t>(relative_path, {1, n_elem, 3}, [frame,sample_function](int16_t* buffer) {
+                sample_function(frame->values.data());
+                frame->encode(buffer);});
+        add_logger<float>((path+"_offset").c_str(), {1, 3}, [frame](float* buffer) {
+                for(int d=0; d<3; ++d) buffer[d] = frame->offset[d];});
+        add_logger<float>((path+"_scale").c_str(), {1}, [frame](float* buffer) {
+                buffer[0] = frame->scale;});
+
+        h5::write_string_attribute(logging_group.get(), relative_path, "encoding", "int16_offset_scale");
+        auto quantum_attr = h5::h5_obj(H5Aclose, H5Acreate_by_name(logging_group.get(), relative_path, "quantum",
+                    H5T_NATIVE_FLOAT, h5::h5_obj(H5Sclose, H5Screate(H5S_SCALAR)).get(),
+                    H5P_DEFAULT, H5P_DEFAULT, H5P_DEFAULT));
+        h5::h5_noerr(H5Awrite(quantum_attr.get(), H5T_NATIVE_FLOAT, &quantum));
+    }
+
     template <typename T, typename F>
     void log_once(
             const char* relative_path, 
@@ -149,13 +346,33 @@ struct H5Logger {
         std::vector<T> data_buffer(data_size);
         sample_function(data_buffer.data());
 
+        std::lock_guard<std::mutex> hdf5_lock(hdf5_write_mutex);
         auto data_set = h5::create_earray(logging_group.get(), relative_path, h5::select_predtype<T>(), 
                 fake_dims, dims);
         h5::append_to_dset(data_set.get(), data_buffer, 0);
     }
 
     virtual ~H5Logger() {
-        flush();
+        try {
+            flush();
+        } catch(const std::string& e) {
+            fprintf(stderr, "ERROR: unable to write the output: %s\n", e.c_str());
+        }
+        if(writer.joinable()) {
+            {
+                std::lock_guard<std::mutex> lock(writer_mutex);
+                stop_writer = true;
+            }
+            writer_cv.notify_all();
+            writer.join();
+        }
+        // closing the datasets and the file are HDF5 calls as well, and the writers of other
+        // systems may still be running
+        std::lock_guard<std::mutex> hdf5_lock(hdf5_write_mutex);
+        state_loggers.clear();
+        state_dense_loggers.clear();
+        logging_group.reset();
+        config.reset();
     }
 };
 
@@ -8,6 +8,15 @@ TimeKeeper global_time_keeper(1);
 
 using namespace std;
 
+vector<pair<string,TimeKeeper::TimeRecord>> TimeKeeper::sorted_records() const {
+    vector<pair<string,TimeRecord>> ret(begin(records), end(records));
+    sort(begin(ret), end(ret), [](const pair<string,TimeRecord>& a, const pair<string,TimeRecord>& b) {
+            return a.second.total_elapsed!=b.second.total_elapsed
+                ? a.second.total_elapsed > b.second.total_elapsed
+                : a.first < b.first;});
+    return ret;
+}
+
 void TimeKeeper::print_report(int n_steps) {
     struct S {
         string name; 
@@ -4,41 +4,61 @@
 #include <unordered_map>
 #include <string>
 #include <chrono>
+#include <vector>
 
 struct TimeKeeper {
     // ignore some number of initial timing events to avoid cache-warming and 
     // delayed-initialization effects as much as possible
-    const int n_ignore;
+    int n_ignore;
 
     struct TimeRecord {
         long n_invoke = 0;
         double total_elapsed = 0.;
     };
 
-    TimeKeeper(int n_ignore_ = -1): n_ignore(n_ignore_) {}
+    // Timers record nothing unless enabled, which is the default only when compiled with
+    // COLLECT_PROFILE.  Otherwise upside enables it with --profile.
+    bool enabled;
+
+#ifdef COLLECT_PROFILE
+    TimeKeeper(int n_ignore_ = -1, bool enabled_ = true): n_ignore(n_ignore_), enabled(enabled_) {}
+#else
+    TimeKeeper(int n_ignore_ = -1, bool enabled_ = false): n_ignore(n_ignore_), enabled(enabled_) {}
+#endif
 
     std::unordered_map<std::string, TimeRecord> records;
 
     void add_time(const std::string &name, double t_elapsed) {
-        TimeRecord& record = records[name];
-        record.n_invoke++;
-        if(record.n_invoke<n_ignore) return; 
-        record.total_elapsed += t_elapsed;
+        // timers may stop on several threads at once
+        #pragma omp critical (time_keeper_add_time)
+        {
+            TimeRecord& record = records[name];
+            record.n_invoke++;
+            if(record.n_invoke>=n_ignore)
+                record.total_elapsed += t_elapsed;
+        }
     }
 
+    //! Records in order of decreasing total time
+    std::vector<std::pair<std::string,TimeRecord>> sorted_records() const;
+
     void print_report(int n_steps);
 };
 extern TimeKeeper global_time_keeper;
 
-#ifdef COLLECT_PROFILE
 struct Timer {
     TimeKeeper &time_keeper;
-    const std::string name;
-    const std::chrono::time_point<std::chrono::high_resolution_clock> tstart;
+    std::string name;
+    std::chrono::time_point<std::chrono::high_resolution_clock> tstart;
     bool  active;
 
     Timer(const std::string &name_, TimeKeeper& time_keeper_ = global_time_keeper): 
-        time_keeper(time_keeper_), name(name_), tstart(std::chrono::high_resolution_clock::now()), active(true) {}
+        time_keeper(time_keeper_), active(time_keeper_.enabled) {
+            if(active) {
+                name = name_;
+                tstart = std::chrono::high_resolution_clock::now();
+            }
+        }
 
     void stop() {
         if(active) {
@@ -52,13 +72,6 @@ struct Timer {
 
     ~Timer() {stop();}
 };
-#else
-struct Timer {
-    Timer(const std::string &name_, TimeKeeper& time_keeper_ = global_time_keeper) {}
-    void stop () {}
-    void abort() {}
-};
-#endif
 
 
 #endif